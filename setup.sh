@@ -12,7 +12,6 @@ python3 -m pip install --upgrade sympy
 python3 -m pip install --upgrade pyfiglet
 python3 -m pip install --upgrade google-api-python-client
 python3 -m pip install --upgrade pillow
-python3 -m pip install --upgrade imgurpython
 python3 -m pip install --upgrade pytz
 
 # modules used by history UI
@@ -4,11 +4,69 @@ import time, json, sys, re
 from datetime import datetime
 import traceback
 import logging
-from collections import deque
+from collections import deque, OrderedDict
 from functools import lru_cache
 
 from slackclient import SlackClient
 
+class ConnectionLostError(ConnectionError):
+    """Raised by `SlackBot.start` when the realtime messaging connection stops answering pings, which makes `SlackBot.start_loop` reconnect immediately."""
+    pass
+
+class EventDeduplicator:
+    """
+    Remembers recently seen message events for `horizon` seconds (up to `max_entries` of them), in order to detect events that were already dispatched.
+
+    The realtime messaging API can redeliver events after reconnecting, and Slack sends `message_changed` events for edits as well as link unfurls, which would otherwise make plugins handle the same command again. `edit_policy` decides which edits get through: "all" lets every edit through, "changed" only lets edits through if they change the message text, and "none" drops all edits.
+    """
+    def __init__(self, horizon=600, max_entries=20000, edit_policy="changed"):
+        assert float(horizon) > 0, "`horizon` must be a positive number rather than \"{}\"".format(horizon)
+        assert isinstance(max_entries, int) and max_entries > 0, "`max_entries` must be a positive integer rather than \"{}\"".format(max_entries)
+        assert edit_policy in {"all", "changed", "none"}, "`edit_policy` must be one of \"all\", \"changed\", or \"none\" rather than \"{}\"".format(edit_policy)
+        self.horizon, self.max_entries, self.edit_policy = horizon, max_entries, edit_policy
+        self.entries = OrderedDict() # mapping from keys to (time last seen, value) tuples, ordered from least to most recently seen
+        self.duplicates_dropped = 0 # number of events that were reported as duplicates
+
+    def expire(self):
+        """Forget entries that are older than the time horizon, as well as the oldest entries past `max_entries`."""
+        cutoff = time.monotonic() - self.horizon
+        while self.entries:
+            key, (seen_time, _) = next(iter(self.entries.items()))
+            if seen_time >= cutoff and len(self.entries) <= self.max_entries: break
+            del self.entries[key]
+
+    def remember(self, key, value=None):
+        """Remember `key` with associated value `value`, returning the previously remembered value, or `None` if `key` wasn't remembered."""
+        previous = self.entries.pop(key, (None, None))[1]
+        self.entries[key] = (time.monotonic(), value)
+        return previous
+
+    def check_key(self, key):
+        """Returns `True` if `key` was seen within the time horizon, `False` otherwise. Either way, `key` is remembered as seen."""
+        self.expire()
+        if key in self.entries: return True
+        self.remember(key, True)
+        return False
+
+    def is_duplicate(self, message_dict):
+        """Returns `True` if `message_dict` is a message event that was already seen within the time horizon or an edit rejected by the edit policy, `False` otherwise. The event is remembered either way."""
+        if message_dict.get("type") != "message": return False
+        channel_id, timestamp, subtype = message_dict.get("channel"), message_dict.get("ts"), message_dict.get("subtype")
+        if not isinstance(timestamp, str): return False
+        if self.check_key((channel_id, timestamp, subtype)):
+            self.duplicates_dropped += 1
+            return True
+
+        # keep track of message text by the timestamp of the original message, so that edits can be compared against it
+        submessage = message_dict.get("message") if subtype == "message_changed" else message_dict
+        if not isinstance(submessage, dict) or not isinstance(submessage.get("text"), str): return False
+        previous_text_hash = self.remember((channel_id, submessage.get("ts", timestamp), "text"), hash(submessage["text"]))
+        if subtype != "message_changed": return False
+        if self.edit_policy == "none" or (self.edit_policy == "changed" and previous_text_hash == hash(submessage["text"])):
+            self.duplicates_dropped += 1
+            return True
+        return False
+
 class SlackBot:
     """
     Slack bot base class. Includes lots of useful functionality that bots often require, such as messaging, connection management, and interfacing with APIs.
@@ -17,9 +75,12 @@ class SlackBot:
 
     This class is intended to be subclassed, with the `on_step` and `on_message` methods overridden to do more useful things.
     """
-    def __init__(self, token, logger=None):
+    def __init__(self, token, logger=None, *, ping_interval=5, pong_timeout=5, max_missed_pongs=2):
         assert isinstance(token, str), "`token` must be a valid Slack API token"
         assert logger is None or not isinstance(logger, logging.Logger), "`logger` must be `None` or a logging function"
+        assert float(ping_interval) > 0, "`ping_interval` must be a positive number rather than \"{}\"".format(ping_interval)
+        assert float(pong_timeout) > 0, "`pong_timeout` must be a positive number rather than \"{}\"".format(pong_timeout)
+        assert isinstance(max_missed_pongs, int) and max_missed_pongs > 0, "`max_missed_pongs` must be a positive integer rather than \"{}\"".format(max_missed_pongs)
 
         self.client = SlackClient(token)
         if logger is None: self.logger = logging.getLogger(self.__class__.__name__)
@@ -36,6 +97,15 @@ class SlackBot:
         self.last_say_time = 0 # store last message send timestamp to rate limit sending
         self.bot_user_id = None # ID of this bot user
 
+        # connection liveness fields
+        self.ping_interval = ping_interval # number of seconds between pings sent to the server
+        self.pong_timeout = pong_timeout # number of seconds to wait for the pong corresponding to a ping before considering the ping missed
+        self.max_missed_pongs = max_missed_pongs # number of consecutive missed pongs after which the connection is considered dead
+        self.pending_pings = {} # mapping from message IDs of unanswered pings to the time they were sent
+        self.missed_pongs = 0 # number of consecutive pings that didn't get a pong in time
+        self.ping_round_trip_times = deque(maxlen=200) # round trip times of the most recent pings, in seconds
+        self.ping_round_trip_time_average = None # exponential moving average of ping round trip times, in seconds
+
     def on_step(self):
         self.logger.info("step handler called")
     def on_message(self, message_dict):
@@ -45,23 +115,29 @@ class SlackBot:
         while True:
             try: self.start() # start the main loop
             except KeyboardInterrupt: break
+            except ConnectionLostError as e:
+                self.logger.warning("{}, reconnecting immediately...".format(e))
             except Exception:
                 self.logger.error("main loop threw exception:\n{}".format(traceback.format_exc()))
                 self.logger.info("restarting in 5 seconds...")
                 time.sleep(5)
         self.logger.info("shutting down...")
 
+    def read_events(self):
+        """Returns a list of events that were received since the last call, without blocking."""
+        return self.client.rtm_read()
+
     def retrieve_unprocessed_incoming_messages(self):
-        result = list(self.unprocessed_incoming_messages) + self.client.rtm_read()
+        result = list(self.unprocessed_incoming_messages) + self.read_events()
         self.unprocessed_incoming_messages.clear()
         return result
 
     def peek_unprocessed_incoming_messages(self):
-        self.unprocessed_incoming_messages.extend(self.client.rtm_read())
+        self.unprocessed_incoming_messages.extend(self.read_events())
         return list(self.unprocessed_incoming_messages)
 
     def peek_new_messages(self):
-        new_messages = self.client.rtm_read()
+        new_messages = self.read_events()
         self.unprocessed_incoming_messages.extend(new_messages)
         return list(new_messages)
 
@@ -76,42 +152,91 @@ class SlackBot:
         assert authentication["ok"], "Could not authenticate with Slack API"
         self.bot_user_id = authentication["user_id"]
 
+        # pings sent over a previous connection will never be answered
+        self.pending_pings.clear()
+        self.missed_pongs = 0
+
         last_ping = time.monotonic()
         while True:
-            # call all the step callbacks
-            try: self.on_step()
-            except Exception:
-                self.logger.error("step processing threw exception:\n{}".format(traceback.format_exc()))
-
-            # call all the message callbacks for each newly received message
-            for message_dict in self.retrieve_unprocessed_incoming_messages():
-                try: self.on_message(message_dict)
-                except KeyboardInterrupt: raise
-                except Exception:
-                    self.logger.error("message processing threw exception:\n{}\n\nmessage contents:\n{}".format(traceback.format_exc(), message_dict))
+            self.step()
 
             # ping the server periodically to make sure our connection is kept alive
-            if time.monotonic() - last_ping > 5:
-                self.client.server.ping()
+            if time.monotonic() - last_ping > self.ping_interval:
+                self.ping()
                 last_ping = time.monotonic()
 
+            # steps can block for a while (e.g., waiting for the send budget), so pongs that arrived in the meantime have to be read before deciding whether any were missed
+            for message_dict in self.peek_unprocessed_incoming_messages():
+                if message_dict.get("type") == "pong": self.process_pong(message_dict)
+
+            # drop the connection as soon as enough pings go unanswered, rather than waiting for the socket to error out
+            self.check_pending_pings()
+
             # delay to avoid checking the socket too often
             time.sleep(0.01)
 
+    def step(self):
+        """Call the step handler, then call the message handler for each newly received message."""
+        # call all the step callbacks
+        try: self.on_step()
+        except Exception:
+            self.logger.error("step processing threw exception:\n{}".format(traceback.format_exc()))
+
+        # call all the message callbacks for each newly received message
+        for message_dict in self.retrieve_unprocessed_incoming_messages():
+            if message_dict.get("type") == "pong": self.process_pong(message_dict)
+            try: self.on_message(message_dict)
+            except KeyboardInterrupt: raise
+            except Exception:
+                self.logger.error("message processing threw exception:\n{}\n\nmessage contents:\n{}".format(traceback.format_exc(), message_dict))
+
+    def ping(self):
+        """Send a ping over the realtime messaging connection, returning the message ID of the ping. The server answers with a pong referencing that ID, which is handled by `process_pong`."""
+        # `self.client.server.ping()` doesn't send a message ID, so pongs couldn't be matched up with their pings
+        message_id = self.max_message_id
+        self.max_message_id += 1
+        self.pending_pings[message_id] = time.monotonic()
+        self.client.server.send_to_websocket({"id": message_id, "type": "ping"})
+        return message_id
+
+    def process_pong(self, message_dict):
+        """Record the round trip time for the ping answered by the pong event `message_dict`."""
+        sent_time = self.pending_pings.pop(message_dict.get("reply_to"), None)
+        if sent_time is None: return # pong for a ping that already counted as missed, or that wasn't sent by us
+        round_trip_time = time.monotonic() - sent_time
+        self.ping_round_trip_times.append(round_trip_time)
+        if self.ping_round_trip_time_average is None: self.ping_round_trip_time_average = round_trip_time
+        else: self.ping_round_trip_time_average += 0.2 * (round_trip_time - self.ping_round_trip_time_average)
+        self.missed_pongs = 0
+
+    def check_pending_pings(self):
+        """Count pings that weren't answered within `self.pong_timeout` seconds as missed, raising a `ConnectionLostError` once `self.max_missed_pongs` consecutive pings have been missed."""
+        current_time = time.monotonic()
+        for message_id, sent_time in list(self.pending_pings.items()):
+            if current_time - sent_time > self.pong_timeout:
+                del self.pending_pings[message_id]
+                self.missed_pongs += 1
+                self.logger.warning("no pong received for ping {} after {} seconds ({} missed in a row)".format(message_id, self.pong_timeout, self.missed_pongs))
+        if self.missed_pongs >= self.max_missed_pongs:
+            raise ConnectionLostError("Realtime messaging connection missed {} pongs in a row".format(self.missed_pongs))
+
+    def get_ping_statistics(self):
+        """Returns a dictionary of statistics about recent ping round trip times in seconds (these are `None` if no pongs have been received yet), as well as the number of unanswered and consecutively missed pings."""
+        samples = sorted(self.ping_round_trip_times)
+        def percentile(p): return samples[min(len(samples) - 1, int(len(samples) * p / 100))] if samples else None
+        return {
+            "average": self.ping_round_trip_time_average,
+            "p50": percentile(50), "p90": percentile(90), "p99": percentile(99),
+            "samples": len(samples), "pending": len(self.pending_pings), "missed": self.missed_pongs,
+        }
+
     def say(self, sendable_text, *, channel_id, thread_id = None):
         """Say `sendable_text` in the channel with ID `channel_id`, returning the message ID (unique within each `SlackBot` instance)."""
         assert self.get_channel_name_by_id(channel_id) is not None, "`channel_id` must be a valid channel ID rather than \"{}\"".format(channel_id)
         assert isinstance(thread_id, str) or thread_id is None, "`thread_id` must be a valid Slack timestamp or None, rather than \"{}\"".format(thread_id)
         assert isinstance(sendable_text, str), "`text` must be a string rather than \"{}\"".format(sendable_text)
 
-        # rate limit sending to 1 per second, since that's the Slack API limit
-        current_time = time.monotonic()
-        if current_time - self.last_say_time < 1:
-            time.sleep(max(0, 1 - (current_time - self.last_say_time)))
-            self.last_say_time += 1
-        else:
-            self.last_say_time = current_time
-
+        self.wait_for_send_budget()
         self.logger.info("sending message to channel {}: {}".format(self.get_channel_name_by_id(channel_id), sendable_text))
 
         # the correct method to use here is `rtm_send_message`, but it's technically broken since it doesn't send the message ID so we're going to do this properly ourselves
@@ -136,6 +261,19 @@ class SlackBot:
             })
         return message_id
 
+    def wait_for_send_budget(self):
+        """Block until another message can be sent without exceeding the Slack API limit of 1 message per second."""
+        current_time = time.monotonic()
+        if current_time - self.last_say_time < 1:
+            time.sleep(max(0, 1 - (current_time - self.last_say_time)))
+            self.last_say_time += 1
+        else:
+            self.last_say_time = current_time
+
+    def has_send_budget(self):
+        """Returns `True` if a message can be sent right now without waiting for the send budget, `False` otherwise. Useful for skipping optional messages rather than waiting to send them."""
+        return time.monotonic() - self.last_say_time >= 1
+
     def say_complete(self, sendable_text, *, channel_id, thread_id = None, timeout = 5):
         """Say `sendable_text` in the channel with ID `channel_id`, waiting for the message to finish sending (raising a `TimeoutError` if this takes more than `timeout` seconds), returning the message timestamp."""
         assert float(timeout) > 0, "`timeout` must be a positive number rather than \"{}\"".format(timeout)
@@ -155,6 +293,17 @@ class SlackBot:
         if message_timestamp is None: raise TimeoutError("Message sending timed out")
         return message_timestamp
 
+    def update_message(self, sendable_text, *, channel_id, timestamp):
+        """Replace the text of the message with timestamp `timestamp` in the channel with ID `channel_id`, which must have been sent by this bot, with `sendable_text`. Edits count towards the same send budget as new messages."""
+        assert self.get_channel_name_by_id(channel_id) is not None, "`channel_id` must be a valid channel ID rather than \"{}\"".format(channel_id)
+        assert isinstance(timestamp, str), "`timestamp` must be a string rather than \"{}\"".format(timestamp)
+        assert isinstance(sendable_text, str), "`text` must be a string rather than \"{}\"".format(sendable_text)
+
+        self.wait_for_send_budget()
+        self.logger.info("updating message with timestamp {} in channel {}: {}".format(timestamp, self.get_channel_name_by_id(channel_id), sendable_text))
+        response = self.client.api_call("chat.update", channel=channel_id, ts=timestamp, text=sendable_text, as_user=True) # the realtime messaging API can't edit messages, so this uses the Web API
+        if not response.get("ok"): raise ValueError("Message updating error: {}".format(response.get("error")))
+
     def react(self, channel_id, timestamp, emoticon):
         """React with `emoticon` to the message with timestamp `timestamp` in channel with ID `channel_id`."""
         assert self.get_channel_name_by_id(channel_id) is not None, "`channel_id` must be a valid channel ID rather than \"{}\"".format(channel_id)
@@ -475,6 +624,21 @@ class SlackDebugBot(SlackBot):
         self.say(sendable_text, channel_id=channel_id, thread_id=thread_id)
         return self.messages[-1]["ts"]
 
+    def has_send_budget(self): return True
+
+    def update_message(self, sendable_text, *, channel_id, timestamp):
+        assert self.get_channel_name_by_id(channel_id) is not None, "`channel_id` must be a valid channel ID rather than \"{}\"".format(channel_id)
+        assert isinstance(timestamp, str), "`timestamp` must be a string rather than \"{}\"".format(timestamp)
+        assert isinstance(sendable_text, str), "`sendable_text` must be a string rather than \"{}\"".format(sendable_text)
+
+        target_message = next((m for m in self.messages if m["ts"] == timestamp), None)
+        assert target_message is not None, "Invalid timestamp - can't find message with timestamp \"{}\"".format(timestamp)
+        target_message["text"] = sendable_text
+
+        self.logger.info("updating message with timestamp {} in channel {}: {}".format(timestamp, self.get_channel_name_by_id(channel_id), sendable_text))
+        print("\r\033[K" + "#{:<11}| Botty edited a message: {}".format(self.get_channel_name_by_id(channel_id), sendable_text)) # clear the current line using Erase in Line ANSI escape code
+        print("#{:<11}| Me: ".format(self.channel_name), end="", flush=True)
+
     def react(self, channel_id, timestamp, emoticon):
         assert self.get_channel_name_by_id(channel_id) is not None, "`channel_id` must be a valid channel ID rather than \"{}\"".format(channel_id)
         assert isinstance(timestamp, str), "`timestamp` must be a string rather than \"{}\"".format(timestamp)
@@ -1,9 +1,22 @@
 #!/usr/bin/env python3
 
-import sys, logging
-from collections import deque
+import os, re, sys, time, logging
+from collections import deque, Counter
 
-from bot import SlackBot
+from bot import SlackBot, EventDeduplicator
+from plugins.state import MemoryStateBackend, SQLiteStateBackend
+
+STATE_DATABASE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "state.db") # plugin state, shared by all Botty processes
+
+# mapping from plugin class names to (command pattern, per-user limit, per-channel limit) tuples, where the command pattern is a case-insensitive regular expression matching messages that invoke the plugin's command, and each limit is either `None` (unlimited) or a tuple `(COMMANDS, SECONDS)` allowing bursts of up to COMMANDS commands, refilling at COMMANDS per SECONDS seconds
+# commands from a user or channel over the limit are dropped before any plugin sees them, so expensive commands can't monopolize the send budget or the CPU
+PLUGIN_RATE_LIMITS = {
+    "ArithmeticPlugin": (r"^\s*\b(?:ca(?:lc(?:ulate)?)?|eval(?:uate)?)\s+\S", (5, 60), (10, 60)),
+    "BigTextPlugin":    (r"^\s*\bbiggify\s+\S",                               (3, 60), (6, 60)),
+    "SnekPlugin":       (r"\bs+n+[aeiou]*k+e*s*\b",                           (3, 60), (6, 60)),
+    "SpaaacePlugin":    (r"\bquote\s+me\b",                                   (2, 60), (4, 60)),
+    "HaikuPlugin":      (r"\b(?:pls\s+haiku\s+me|haiku\s+me\s+pls)\b",        (3, 60), (6, 60)),
+}
 
 # process settings
 #logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
@@ -26,7 +39,8 @@ def initialize_plugins(botty):
     from plugins.agario import AgarioPlugin; botty.register_plugin(AgarioPlugin(botty))
     from plugins.snek import SnekPlugin; botty.register_plugin(SnekPlugin(botty))
 
-if len(sys.argv) > 2 or (len(sys.argv) == 2 and sys.argv[1] in {"--help", "-h", "-?"}):
+EVENTS_API = len(sys.argv) >= 2 and sys.argv[1] == "--events-api"
+if (EVENTS_API and not 4 <= len(sys.argv) <= 6) or (not EVENTS_API and len(sys.argv) > 2) or (len(sys.argv) == 2 and sys.argv[1] in {"--help", "-h", "-?"}):
     print("Usage: {} --help".format(sys.argv[0]))
     print("    Show this help message")
     print("Usage: {}".format(sys.argv[0]))
@@ -34,30 +48,51 @@ if len(sys.argv) > 2 or (len(sys.argv) == 2 and sys.argv[1] in {"--help", "-h",
     print("Usage: {} SLACK_BOT_TOKEN".format(sys.argv[0]))
     print("    Start the Botty chatbot for the Slack chat associated with SLACK_BOT_TOKEN, and enter the in-process Python REPL")
     print("    SLACK_BOT_TOKEN is a Slack API token (can be obtained from https://api.slack.com/)")
+    print("Usage: {} --events-api SLACK_BOT_TOKEN SLACK_SIGNING_SECRET [PORT] [WORKERS]".format(sys.argv[0]))
+    print("    Start the Botty chatbot for the Slack chat associated with SLACK_BOT_TOKEN, receiving events from the Slack Events API rather than the realtime messaging API")
+    print("    SLACK_SIGNING_SECRET is the signing secret of the Slack app, used to verify incoming requests")
+    print("    PORT is the port to serve the Events API endpoint on (defaults to 3000)")
+    print("    WORKERS is the number of worker processes handling events (defaults to the number of CPUs)")
     sys.exit(1)
 
 DEBUG = len(sys.argv) < 2
 if DEBUG:
     from bot import SlackDebugBot as SlackBot
     SLACK_TOKEN = ""
-    print("No Slack API token specified in command line arguments; starting in local debug mode...")
-    print()
+    if __name__ == "__main__":
+        print("No Slack API token specified in command line arguments; starting in local debug mode...")
+        print()
+elif EVENTS_API:
+    from events_api import EventsAPIBot as SlackBot
+    SLACK_TOKEN, SLACK_SIGNING_SECRET = sys.argv[2], sys.argv[3]
+    EVENTS_API_PORT = int(sys.argv[4]) if len(sys.argv) >= 5 else 3000
+    EVENTS_API_WORKERS = int(sys.argv[5]) if len(sys.argv) >= 6 else None
 else:
     SLACK_TOKEN = sys.argv[1]
 
 class Botty(SlackBot):
-    def __init__(self, token):
-        super().__init__(token)
+    def __init__(self, token, *, edit_policy="changed", state_backend=None, **kwargs):
+        super().__init__(token, **kwargs)
+        self.state_backend = MemoryStateBackend() if state_backend is None else state_backend # plugin state storage, see `src/plugins/state.py`
         self.plugins = []
         self.last_message_timestamp = None
         self.last_message_thread_id = None
         self.last_message_channel_id = None
         self.recent_events = deque(maxlen=2000) # store the last 2000 events
+        self.event_deduplicator = EventDeduplicator(edit_policy=edit_policy) # drops redelivered events and edits that plugins already handled (see `EventDeduplicator` for edit policies)
+
+        # rate limiting fields
+        self.rate_limiters = { # mapping from plugin class names to (compiled command pattern, per-user limiter, per-channel limiter) tuples, where limiters are `None` if there's no limit
+            plugin_name: (re.compile(pattern, re.IGNORECASE),) + tuple(None if limit is None else TokenBucketRateLimiter(*limit) for limit in limits)
+            for plugin_name, (pattern, *limits) in PLUGIN_RATE_LIMITS.items()
+        }
+        self.rate_limited_messages = Counter() # mapping from (plugin class name, "user" or "channel") pairs to the number of commands for that plugin that were dropped for being over that limit
 
     def register_plugin(self, plugin_instance):
         self.plugins.append(plugin_instance)
 
     def on_step(self):
+        self.state_backend.flush_if_due()
         for plugin in self.plugins:
             if plugin.on_step(): break
 
@@ -68,6 +103,11 @@ class Botty(SlackBot):
         user_id = message_dict.get("user", message_dict.get("message", {}).get("user"))
         if isinstance(user_id, str) and self.get_user_is_bot(user_id): return
 
+        # ignore events that were already dispatched, so plugins don't redo work and resend responses
+        if self.event_deduplicator.is_duplicate(message_dict):
+            self.logger.info("ignoring duplicate event {}".format(message_dict))
+            return
+
         message = IncomingMessage(message_dict, is_bot_message=False)
         try:
             # we need to set all of these in one statement because if any of the accessors fail, none of the variables should be updated
@@ -77,11 +117,35 @@ class Botty(SlackBot):
         # save recent message events
         if message.is_action_message: self.recent_events.append(message)
 
+        # drop over-limit commands before dispatching them, so that no plugin does any work for them
+        if message.is_user_text_message and not self.consume_rate_limits(message):
+            self.logger.info("dropping rate limited message {}".format(message))
+            return
+
         for plugin in self.plugins:
             if plugin.on_message(message):
                 self.logger.info("message handled by {}: {}".format(plugin.__class__.__name__, message))
                 break
 
+    def consume_rate_limits(self, message):
+        """Use up a token from the user's and channel's buckets for each rate limited command that the user text message `message` invokes, returning `True`. If the user or channel is over the limit for any of those commands, nothing is used up and `False` is returned instead."""
+        invoked_limiters = [
+            (plugin_name, user_limiter, channel_limiter)
+            for plugin_name, (pattern, user_limiter, channel_limiter) in self.rate_limiters.items()
+            if pattern.search(message.text)
+        ]
+        for plugin_name, user_limiter, channel_limiter in invoked_limiters:
+            if user_limiter is not None and not user_limiter.is_available(message.user_id):
+                self.rate_limited_messages[(plugin_name, "user")] += 1
+                return False
+            if channel_limiter is not None and not channel_limiter.is_available(message.channel_id):
+                self.rate_limited_messages[(plugin_name, "channel")] += 1
+                return False
+        for plugin_name, user_limiter, channel_limiter in invoked_limiters:
+            if user_limiter is not None: user_limiter.consume(message.user_id)
+            if channel_limiter is not None: channel_limiter.consume(message.channel_id)
+        return True
+
     def respond(self, sendable_text, *, as_thread=True):
         """Say `sendable_text` in the channel/thread that most recently received a message, returning the message ID (unique within each `SlackBot` instance). If `as_thread` is truthy, this will create a thread for the message being responsed to if it wasn't in a thread."""
         assert self.last_message_channel_id is not None, "No message to respond to"
@@ -104,6 +168,30 @@ class Botty(SlackBot):
         assert self.last_message_channel_id is not None and self.last_message_timestamp is not None, "No message to unreply to"
         return self.unreact(self.last_message_channel_id, self.last_message_timestamp, emoticon)
 
+class TokenBucketRateLimiter:
+    """Rate limiter that allows bursts of up to `count` actions per key, refilling at a rate of `count` actions per `period` seconds, using a token bucket for each key."""
+    def __init__(self, count, period):
+        assert isinstance(count, int) and count > 0, "`count` must be a positive integer rather than \"{}\"".format(count)
+        assert float(period) > 0, "`period` must be a positive number rather than \"{}\"".format(period)
+        self.capacity, self.refill_rate = count, count / period
+        self.buckets = {} # mapping from keys to [tokens, time of last refill] lists, for keys with buckets that aren't full
+
+    def get_tokens(self, key):
+        """Returns the number of tokens in the bucket for `key`, after refilling it. Full buckets are discarded, since they're the same as new ones."""
+        if key not in self.buckets: return self.capacity
+        bucket, current_time = self.buckets[key], time.monotonic()
+        bucket[0], bucket[1] = min(self.capacity, bucket[0] + (current_time - bucket[1]) * self.refill_rate), current_time
+        if bucket[0] >= self.capacity: del self.buckets[key]
+        return bucket[0]
+
+    def is_available(self, key):
+        """Returns `True` if an action for `key` is currently allowed, `False` otherwise."""
+        return self.get_tokens(key) >= 1
+
+    def consume(self, key):
+        """Record an action for `key`, using up one token."""
+        self.buckets[key] = [self.get_tokens(key) - 1, time.monotonic()]
+
 class IncomingMessage:
     """Represents a single incoming message event."""
     def __init__(self, message_dict, is_bot_message):
@@ -211,67 +299,82 @@ class IncomingMessage:
         if not isinstance(reaction, str): raise ValueError("Message reaction value should be a string, but is \"{}\" instead".format(repr(reaction)))
         return reaction
 
-botty = Botty(SLACK_TOKEN)
-initialize_plugins(botty)
-
-# start administrator console in production mode
-if not DEBUG:
-    def say(channel, text):
-        """Say `text` in `channel` where `text` is a sendable text string and `channel` is a channel name like #general."""
-        botty.say(text, channel_id=botty.get_channel_id_by_name(channel))
-
-    def reload_plugin(package_name, class_name):
-        """Reload plugin from its plugin class `class_name` from package `package_name`."""
-        # obtain the new plugin
-        import importlib
-        plugin_module = importlib.import_module(package_name) # this will not re-initialize the module, since it's been previously imported
-        importlib.reload(plugin_module) # re-initialize the module
-        PluginClass = getattr(plugin_module, class_name)
-
-        # replace the old plugin with the new one
-        for i, plugin in enumerate(botty.plugins):
-            if isinstance(plugin, PluginClass):
-                del botty.plugins[i]
-                break
-        botty.register_plugin(PluginClass(botty))
-
-    def sane():
-        """Force the administrator's console into a reasonable default - useful for recovering from weird terminal states."""
-        import os
-        os.system("stty sane")
-
-    from datetime import datetime
-    from plugins.utilities import BasePlugin
-    def on_message_default(plugin, message): return False
-    def on_message_disabled(plugin, message): return True
-    def on_message_print(plugin, message):
-        """Print out all incoming events - useful for interactive RTM API debugging."""
-        if message.get("type") == "message":
-            timestamp = datetime.fromtimestamp(int(message["ts"].split(".")[0]))
-            channel_name = botty.get_channel_name_by_id(message.get("channel", message.get("previous_message", {}).get("channel")))
-            user_name = botty.get_user_name_by_id(message.get("user", message.get("previous_message", {}).get("user")))
-            text = message.get("text", message.get("previous_message", {}).get("text"))
-            new_text = message.get("message", {}).get("text")
-            if new_text:
-                print("{timestamp} #{channel} | @{user} {subtype}: {text} -> {new_text}".format(
-                    timestamp=timestamp, channel=channel_name, user=user_name,
-                    subtype=message.get("subtype", "message"), text=text, new_text=new_text
-                ))
-            else:
-                print("{timestamp} #{channel} | @{user} {subtype}: {text}".format(
-                    timestamp=timestamp, channel=channel_name, user=user_name,
-                    subtype=message.get("subtype", "message"), text=text
-                ))
-        elif message.get("type") not in {"ping", "pong", "presence_change", "user_typing", "reconnect_url"}:
-            print(message)
-        return False
-    on_message = on_message_default
-    class AdHocPlugin(BasePlugin):
-        def __init__(self, bot): super().__init__(bot)
-        def on_message(self, message): return on_message(self, message)
-    if not any(isinstance(plugin, AdHocPlugin) for plugin in botty.plugins): # plugin hasn't already been added
-        botty.plugins.insert(0, AdHocPlugin(botty)) # the plugin should go before everything else to be able to influence every message
-
-    botty.administrator_console(globals())
-
-botty.start_loop()
+def create_worker_botty(event_queue, last_say_time):
+    """Create the Botty instance for an Events API worker process. This has to be defined at the top level, since workers are started from a fork server and look it up by name."""
+    worker_botty = Botty(SLACK_TOKEN, event_queue=event_queue, last_say_time=last_say_time, state_backend=SQLiteStateBackend(STATE_DATABASE))
+    initialize_plugins(worker_botty)
+    return worker_botty
+
+# processes started with the "forkserver" or "spawn" methods (such as the Events API workers and the arithmetic plugin's evaluator processes) import this file again as `__mp_main__`, which mustn't start another bot
+if __name__ == "__main__":
+    # in Events API mode, this process only serves the endpoint, and each worker process runs its own Botty instance
+    if EVENTS_API:
+        from events_api import start_events_api
+        start_events_api(create_worker_botty, SLACK_SIGNING_SECRET, port=EVENTS_API_PORT, worker_count=EVENTS_API_WORKERS)
+        sys.exit(0)
+
+    botty = Botty(SLACK_TOKEN, state_backend=None if DEBUG else SQLiteStateBackend(STATE_DATABASE))
+    initialize_plugins(botty)
+
+    # start administrator console in production mode
+    if not DEBUG:
+        def say(channel, text):
+            """Say `text` in `channel` where `text` is a sendable text string and `channel` is a channel name like #general."""
+            botty.say(text, channel_id=botty.get_channel_id_by_name(channel))
+
+        def reload_plugin(package_name, class_name):
+            """Reload plugin from its plugin class `class_name` from package `package_name`."""
+            # obtain the new plugin
+            import importlib
+            plugin_module = importlib.import_module(package_name) # this will not re-initialize the module, since it's been previously imported
+            importlib.reload(plugin_module) # re-initialize the module
+            PluginClass = getattr(plugin_module, class_name)
+
+            # replace the old plugin with the new one, stopping anything the old one started (the old plugin is an instance of the class from before the reload, so it's found by name)
+            for i, plugin in enumerate(botty.plugins):
+                if plugin.__class__.__name__ == class_name:
+                    plugin.on_unload()
+                    del botty.plugins[i]
+                    break
+            botty.register_plugin(PluginClass(botty))
+
+        def sane():
+            """Force the administrator's console into a reasonable default - useful for recovering from weird terminal states."""
+            import os
+            os.system("stty sane")
+
+        from datetime import datetime
+        from plugins.utilities import BasePlugin
+        def on_message_default(plugin, message): return False
+        def on_message_disabled(plugin, message): return True
+        def on_message_print(plugin, message):
+            """Print out all incoming events - useful for interactive RTM API debugging."""
+            if message.get("type") == "message":
+                timestamp = datetime.fromtimestamp(int(message["ts"].split(".")[0]))
+                channel_name = botty.get_channel_name_by_id(message.get("channel", message.get("previous_message", {}).get("channel")))
+                user_name = botty.get_user_name_by_id(message.get("user", message.get("previous_message", {}).get("user")))
+                text = message.get("text", message.get("previous_message", {}).get("text"))
+                new_text = message.get("message", {}).get("text")
+                if new_text:
+                    print("{timestamp} #{channel} | @{user} {subtype}: {text} -> {new_text}".format(
+                        timestamp=timestamp, channel=channel_name, user=user_name,
+                        subtype=message.get("subtype", "message"), text=text, new_text=new_text
+                    ))
+                else:
+                    print("{timestamp} #{channel} | @{user} {subtype}: {text}".format(
+                        timestamp=timestamp, channel=channel_name, user=user_name,
+                        subtype=message.get("subtype", "message"), text=text
+                    ))
+            elif message.get("type") not in {"ping", "pong", "presence_change", "user_typing", "reconnect_url"}:
+                print(message)
+            return False
+        on_message = on_message_default
+        class AdHocPlugin(BasePlugin):
+            def __init__(self, bot): super().__init__(bot)
+            def on_message(self, message): return on_message(self, message)
+        if not any(isinstance(plugin, AdHocPlugin) for plugin in botty.plugins): # plugin hasn't already been added
+            botty.plugins.insert(0, AdHocPlugin(botty)) # the plugin should go before everything else to be able to influence every message
+
+        botty.administrator_console(globals())
+
+    botty.start_loop()
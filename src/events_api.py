@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+"""
+Slack Events API ingestion for Slack bots.
+
+Rather than reading events from a single realtime messaging connection, events are pushed by Slack to an HTTP endpoint, verified, and placed on a local queue. The queue is consumed by several worker processes, each running its own `EventsAPIBot` instance, which allows event processing to use multiple cores and keep going if a single worker dies.
+
+See https://api.slack.com/events-api for more details about the Events API.
+"""
+
+import time, json, hmac, hashlib
+import logging
+import threading, queue
+import multiprocessing
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+from bot import SlackBot, EventDeduplicator
+
+def verify_request_signature(signing_secret, timestamp, body, signature, max_age=300):
+    """Returns `True` if `signature` is a valid Slack request signature for a request with body `body` (a bytes object) sent at UNIX time `timestamp`, `False` otherwise. See https://api.slack.com/docs/verifying-requests-from-slack for details."""
+    assert isinstance(signing_secret, str), "`signing_secret` must be a string rather than \"{}\"".format(signing_secret)
+    assert isinstance(body, bytes), "`body` must be a bytes object rather than \"{}\"".format(body)
+    if not isinstance(timestamp, str) or not isinstance(signature, str): return False
+    try:
+        if abs(time.time() - int(timestamp)) > max_age: return False # reject old requests, since they could be replayed by an attacker
+    except ValueError:
+        return False
+    expected_signature = "v0=" + hmac.new(signing_secret.encode("utf-8"), b"v0:" + timestamp.encode("utf-8") + b":" + body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected_signature, signature)
+
+def sign_request(signing_secret, timestamp, body):
+    """Returns the Slack request signature for a request with body `body` (a bytes object) sent at UNIX time `timestamp`. This is the counterpart of `verify_request_signature`, used for simulating requests from Slack."""
+    return "v0=" + hmac.new(signing_secret.encode("utf-8"), b"v0:" + str(timestamp).encode("utf-8") + b":" + body, hashlib.sha256).hexdigest()
+
+class EventsAPIRequestHandler(BaseHTTPRequestHandler):
+    """Handles requests to the Events API endpoint, enqueueing the events in verified event callbacks and answering URL verification challenges."""
+    def do_POST(self):
+        try: body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        except ValueError: return self.send_plain_response(400, "bad content length")
+        if not verify_request_signature(self.server.signing_secret, self.headers.get("X-Slack-Request-Timestamp"), body, self.headers.get("X-Slack-Signature")):
+            self.server.logger.warning("rejected request with invalid signature from {}".format(self.client_address[0]))
+            return self.send_plain_response(401, "invalid signature")
+        try: payload = json.loads(body.decode("utf-8"))
+        except ValueError: return self.send_plain_response(400, "malformed payload")
+
+        if payload.get("type") == "url_verification": # sent by Slack when setting the request URL
+            return self.send_plain_response(200, str(payload.get("challenge", "")))
+        if payload.get("type") == "event_callback" and isinstance(payload.get("event"), dict):
+            # Slack retries events that weren't acknowledged quickly enough, so the same event can arrive more than once
+            event_id = payload.get("event_id")
+            with self.server.lock: is_duplicate = event_id is not None and self.server.event_deduplicator.check_key(event_id)
+            if not is_duplicate: self.server.event_queue.put(payload["event"])
+        return self.send_plain_response(200, "") # acknowledge the event right away, since Slack expects a response within 3 seconds
+
+    def send_plain_response(self, status, text):
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        self.server.logger.debug("{} - {}".format(self.client_address[0], format % args))
+
+class EventsAPIServer(ThreadingMixIn, HTTPServer):
+    """HTTP server for the Events API endpoint, which places verified events on `event_queue`."""
+    daemon_threads = True
+
+    def __init__(self, server_address, signing_secret, event_queue, logger):
+        super().__init__(server_address, EventsAPIRequestHandler)
+        self.signing_secret = signing_secret
+        self.event_queue = event_queue
+        self.logger = logger
+        self.event_deduplicator = EventDeduplicator(horizon=3600) # keyed by event ID, since Slack can retry events for up to an hour
+        self.lock = threading.Lock() # requests are handled in separate threads, but the deduplicator isn't thread safe
+
+class EventsAPIBot(SlackBot):
+    """
+    Slack bot that processes events taken from `event_queue` (filled by an `EventsAPIServer`) rather than the realtime messaging API.
+
+    Messages are sent using the Web API, since there's no realtime messaging connection to send them over. If `last_say_time` (a `multiprocessing.Value` of type "d", as created by `start_events_api`) is given, the send budget is shared with every other bot using the same value, so several worker processes together still stay within the Slack API limit of 1 message per second. Otherwise, this behaves just like `SlackBot`, and can be subclassed in the same way.
+    """
+    def __init__(self, token, logger=None, *, event_queue, last_say_time=None, metadata_refresh_interval=600, **kwargs):
+        super().__init__(token, logger, **kwargs)
+        self.event_queue = event_queue
+        self.shared_last_say_time = last_say_time # time of the last message sent by any worker, or `None` if the send budget isn't shared (`time.monotonic` uses the same clock in every process)
+        self.metadata_refresh_interval = metadata_refresh_interval # number of seconds between refreshes of the channel and user listings
+        self.last_metadata_refresh_time = 0
+
+    def start(self):
+        # obtain the bot credentials
+        authentication = self.client.api_call("auth.test")
+        assert authentication["ok"], "Could not authenticate with Slack API"
+        self.bot_user_id = authentication["user_id"]
+
+        while True:
+            # there's no realtime messaging connection to load these, so we need to request them ourselves
+            if time.monotonic() - self.last_metadata_refresh_time > self.metadata_refresh_interval:
+                self.refresh_metadata()
+                self.last_metadata_refresh_time = time.monotonic()
+
+            self.step()
+
+            # delay to avoid checking the queue too often
+            time.sleep(0.01)
+
+    def refresh_metadata(self):
+        """Load channel, private group, direct message, and user listings, which are used for looking up channels and users."""
+        self.logger.info("refreshing channel and user listings...")
+        for method, field in [("channels.list", "channels"), ("groups.list", "groups"), ("im.list", "ims")]:
+            response = self.client.api_call(method)
+            assert response.get("ok"), "Listing request {} failed: error {}".format(method, response.get("error"))
+            self.client.server.parse_channel_data(response[field])
+        response = self.client.api_call("users.list")
+        assert response.get("ok"), "Listing request users.list failed: error {}".format(response.get("error"))
+        self.client.server.parse_user_data(response["members"])
+
+    def read_events(self):
+        # only take one event at a time, so that the remaining events are left for other workers
+        try: return [self.event_queue.get_nowait()]
+        except queue.Empty: return []
+
+    def wait_for_send_budget(self):
+        if self.shared_last_say_time is None: return super().wait_for_send_budget()
+        with self.shared_last_say_time.get_lock(): # reserve the next free send time, then wait for it without holding the lock
+            send_time = max(time.monotonic(), self.shared_last_say_time.value + 1)
+            self.shared_last_say_time.value = send_time
+        time.sleep(max(0, send_time - time.monotonic()))
+
+    def has_send_budget(self):
+        if self.shared_last_say_time is None: return super().has_send_budget()
+        return time.monotonic() - self.shared_last_say_time.value >= 1
+
+    def post_message(self, sendable_text, *, channel_id, thread_id = None):
+        """Post `sendable_text` in the channel with ID `channel_id` using the Web API, returning the message timestamp."""
+        assert self.get_channel_name_by_id(channel_id) is not None, "`channel_id` must be a valid channel ID rather than \"{}\"".format(channel_id)
+        assert isinstance(thread_id, str) or thread_id is None, "`thread_id` must be a valid Slack timestamp or None, rather than \"{}\"".format(thread_id)
+        assert isinstance(sendable_text, str), "`text` must be a string rather than \"{}\"".format(sendable_text)
+
+        self.wait_for_send_budget()
+        self.logger.info("sending message to channel {}: {}".format(self.get_channel_name_by_id(channel_id), sendable_text))
+        if thread_id is not None: # message in a thread
+            response = self.client.api_call("chat.postMessage", channel=channel_id, text=sendable_text, thread_ts=thread_id, as_user=True)
+        else: # top-level message
+            response = self.client.api_call("chat.postMessage", channel=channel_id, text=sendable_text, as_user=True)
+        if not response.get("ok"): raise ValueError("Message sending error: {}".format(response.get("error")))
+        assert isinstance(response.get("ts"), str), "Invalid message timestamp: {}".format(response.get("ts"))
+        return response["ts"]
+
+    def say(self, sendable_text, *, channel_id, thread_id = None):
+        self.post_message(sendable_text, channel_id=channel_id, thread_id=thread_id)
+        message_id = self.max_message_id
+        self.max_message_id += 1
+        return message_id
+
+    def say_complete(self, sendable_text, *, channel_id, thread_id = None, timeout = 5):
+        return self.post_message(sendable_text, channel_id=channel_id, thread_id=thread_id)
+
+def run_worker(create_bot, event_queue, last_say_time):
+    bot = create_bot(event_queue, last_say_time)
+    bot.start_loop()
+
+def start_events_api(create_bot, signing_secret, *, host="", port=3000, worker_count=None, logger=None):
+    """
+    Serve the Events API endpoint on `host`:`port` and process events using `worker_count` worker processes (defaults to the number of CPUs), blocking until interrupted.
+
+    Each worker process calls `create_bot(event_queue, last_say_time)` to obtain an `EventsAPIBot` instance created with those `event_queue` and `last_say_time` arguments, then runs it. Workers that exit are restarted. Workers are started from a fork server rather than forked from this process, so `create_bot` must be picklable (e.g., a function defined at the top level of a module), and the main module must only start the endpoint under an `if __name__ == "__main__":` guard. All workers share the same send budget through `last_say_time`, so the bot as a whole sends at most 1 message per second no matter how many workers there are.
+    """
+    assert callable(create_bot), "`create_bot` must be a function that returns an `EventsAPIBot` instance"
+    assert isinstance(signing_secret, str), "`signing_secret` must be a Slack signing secret"
+    if worker_count is None: worker_count = multiprocessing.cpu_count()
+    assert isinstance(worker_count, int) and worker_count > 0, "`worker_count` must be a positive integer rather than \"{}\"".format(worker_count)
+    if logger is None: logger = logging.getLogger("EventsAPI")
+
+    # forking this process while the server threads are running could leave a worker holding a copy of a lock that another thread had acquired at that moment (e.g., a logging handler lock), deadlocking that worker, so workers are started from a single-threaded fork server instead
+    context = multiprocessing.get_context("forkserver")
+    event_queue = context.Queue()
+    last_say_time = context.Value("d", 0.0) # send budget shared by all workers, see `EventsAPIBot`
+
+    server = EventsAPIServer((host, port), signing_secret, event_queue, logger)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    logger.info("serving Events API endpoint on port {} with {} workers".format(port, worker_count))
+
+    workers = [None] * worker_count
+    try:
+        while True:
+            for i, worker in enumerate(workers):
+                if worker is not None and worker.is_alive(): continue
+                if worker is not None: logger.warning("worker {} exited with code {}, restarting...".format(i, worker.exitcode))
+                workers[i] = context.Process(target=run_worker, args=(create_bot, event_queue, last_say_time), daemon=True)
+                workers[i].start()
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    logger.info("shutting down...")
+    server.shutdown()
+    for worker in workers:
+        if worker is not None: worker.terminate()
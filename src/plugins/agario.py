@@ -1,41 +1,252 @@
 #!/usr/bin/env python3
 
-import re, json, time, random
+import os, re, json, time, random
 from math import floor, ceil
 from collections import namedtuple
 
 from .utilities import BasePlugin
 from .utilities import untag_word
 
+TICK_INTERVAL = 0.2 # seconds of game time simulated by each physics step
+MAX_CATCH_UP_TICKS = 10 # maximum number of physics steps to run at once after falling behind, so a long pause doesn't stall the bot
+FRAME_INTERVAL = 1 # minimum number of seconds between frames, which matches the Slack API limit of 1 message per second
+GAME_LIST_REFRESH_INTERVAL = 1 # number of seconds between scans of the plugin state for games started by other processes (which can be taken over if their owner stops stepping them) and for commands queued by other processes
+
+MAP_SIZE = 150 # minimum number of cells in the map
+MAP_SIZE_PER_PLAYER = 20 # number of cells in the map for each player, so games with lots of players don't start out crowded
+EMPTY, FOOD = " ", "\u25E6" # characters used to render empty cells and cells with food in them
+SPLIT_COOLDOWN = 20 # number of physics steps after splitting or joining before a player's blobs join back together
+
+def create_game(players):
+    """
+    Returns a new game between the players named in the list `players`, placed on the map from left to right in that order.
+
+    Blobs are stored as parallel lists, one entry per blob: the index of the player owning the blob in `game["players"]`, the position of the blob's center, and the blob's size (the distance from its center to either edge).
+    """
+    map_size = max(MAP_SIZE, MAP_SIZE_PER_PLAYER * len(players))
+    game = {
+        "map_size": map_size, "food": [1 if random.random() < 0.3 else 0 for i in range(map_size)],
+        "players": list(players), "player_movement": [0] * len(players), "player_split_cooldown": [0] * len(players),
+        "blob_players": [], "blob_positions": [], "blob_sizes": [],
+    }
+    current_position = random.randrange(0, 8)
+    for player_index in range(len(players)):
+        game["blob_players"].append(player_index)
+        game["blob_positions"].append(current_position)
+        game["blob_sizes"].append(1)
+        current_position = (current_position + random.randrange(10, 30)) % map_size
+    return game
+
+def get_live_players(game):
+    """Returns the set of indices of players in `game` that still have at least one blob."""
+    return set(game["blob_players"])
+
+def get_overlapping_blobs(game):
+    """
+    Returns a list of `(blob1, blob2, position1, position2)` tuples for each pair of blobs in `game` that overlap, sorted by blob indices, where `blob1 < blob2`, and `position1` and `position2` are the positions of their centers unwrapped so that they're next to each other (positions can be outside the map when blobs wrap around its edges).
+
+    This sorts the blobs by their left edges and sweeps across the map, only comparing blobs whose extents overlap, rather than comparing every pair of blobs.
+    """
+    map_size, positions, sizes = game["map_size"], game["blob_positions"], game["blob_sizes"]
+
+    # blobs that extend past either edge of the map also get an entry shifted by the map size, so the sweep sees them on both sides
+    entries = []
+    for blob, (position, size) in enumerate(zip(positions, sizes)):
+        entries.append((position - size, position + size, blob, position))
+        if position - size < 0: entries.append((position - size + map_size, position + size + map_size, blob, position + map_size))
+        if position + size >= map_size: entries.append((position - size - map_size, position + size - map_size, blob, position - map_size))
+    entries.sort()
+
+    overlaps, active = {}, [] # mapping from blob pairs to their unwrapped positions, entries that might overlap the current one
+    for left, right, blob, position in entries:
+        active = [entry for entry in active if entry[1] >= left]
+        for _, _, other_blob, other_position in active:
+            if other_blob == blob: continue
+            pair = (other_blob, blob) if other_blob < blob else (blob, other_blob)
+            if pair not in overlaps: overlaps[pair] = (other_position, position) if other_blob < blob else (position, other_position)
+        active.append((left, right, blob, position))
+    return [(blob1, blob2, position1, position2) for (blob1, blob2), (position1, position2) in sorted(overlaps.items())]
+
+def eat_food(game):
+    """Have each blob in `game` eat the food in every cell it covers, sweeping across the cells with food and the blobs sorted by their left edges. When several blobs cover the same cell, the one that comes first in the blob lists gets the food."""
+    map_size, food, positions, sizes = game["map_size"], game["food"], game["blob_positions"], game["blob_sizes"]
+    entries = []
+    for blob, (position, size) in enumerate(zip(positions, sizes)):
+        for shift in (0, map_size, -map_size): # also consider blobs that wrap around either edge of the map
+            left, right = ceil(position - size + shift), floor(position + size + shift)
+            if right >= 0 and left < map_size: entries.append((max(left, 0), min(right, map_size - 1), blob))
+    entries.sort()
+
+    next_entry, active = 0, []
+    for cell in [cell for cell, has_food in enumerate(food) if has_food]:
+        while next_entry < len(entries) and entries[next_entry][0] <= cell:
+            active.append(entries[next_entry])
+            next_entry += 1
+        active = [entry for entry in active if entry[1] >= cell]
+        if active:
+            food[cell] = 0
+            sizes[min(blob for _, _, blob in active)] += 0.25
+
+def remove_blobs(game, removed_blobs):
+    """Remove the blobs with indices in the set `removed_blobs` from `game`."""
+    for field in ("blob_players", "blob_positions", "blob_sizes"):
+        game[field] = [value for blob, value in enumerate(game[field]) if blob not in removed_blobs]
+
+def step_game(game):
+    """Advance `game` by one physics step, returning `False` if the game ended because fewer than two players are left, `True` otherwise."""
+    map_size, players = game["map_size"], game["players"]
+
+    # occasionally spawn food in random places
+    if random.random() < 0.3:
+        game["food"][random.randrange(map_size)] = 1
+
+    # apply joining after splitting, merging each player's blobs in pairs from smallest to largest
+    player_blobs = [[] for _ in players]
+    for blob, player_index in enumerate(game["blob_players"]): player_blobs[player_index].append(blob)
+    removed_blobs = set()
+    for player_index, blobs in enumerate(player_blobs):
+        if game["player_split_cooldown"][player_index] <= 0 and len(blobs) > 1:
+            blobs.sort(key=lambda blob: game["blob_sizes"][blob])
+            for blob1, blob2 in zip(blobs[0::2], blobs[1::2]):
+                if game["blob_sizes"][blob1] > game["blob_sizes"][blob2]: game["blob_positions"][blob2] = game["blob_positions"][blob1]
+                game["blob_sizes"][blob2] += game["blob_sizes"][blob1]
+                removed_blobs.add(blob1)
+            game["player_split_cooldown"][player_index] = SPLIT_COOLDOWN
+        game["player_split_cooldown"][player_index] -= 1
+    if removed_blobs: remove_blobs(game, removed_blobs)
+
+    # apply movement
+    positions, sizes = game["blob_positions"], game["blob_sizes"]
+    for blob, player_index in enumerate(game["blob_players"]):
+        positions[blob] = (positions[blob] + game["player_movement"][player_index] / sizes[blob]) % map_size
+
+    eat_food(game)
+
+    # apply blobs from different players eating each other, when one blob's center is inside of another blob
+    blob_players, removed_blobs = game["blob_players"], set()
+    for blob1, blob2, position1, position2 in get_overlapping_blobs(game):
+        if blob_players[blob1] == blob_players[blob2] or blob1 in removed_blobs or blob2 in removed_blobs: continue
+        size1, size2 = sizes[blob1], sizes[blob2]
+        if abs(position1 - position2) > max(size1, size2): continue # overlapping, but neither blob is halfway inside the other
+        if size1 < size2 * 0.8: # blob 1 can be eaten by blob 2
+            sizes[blob2] += size1
+            removed_blobs.add(blob1)
+        elif size2 < size1 * 0.8: # blob 2 can be eaten by blob 1
+            sizes[blob1] += size2
+            removed_blobs.add(blob2)
+    if removed_blobs: remove_blobs(game, removed_blobs)
+    if len(get_live_players(game)) < 2: return False # last player standing, player wins
+
+    # apply collision among blobs of a single player, nudging the smaller blob out of the way
+    positions, sizes, blob_players = game["blob_positions"], game["blob_sizes"], game["blob_players"]
+    for blob1, blob2, position1, position2 in get_overlapping_blobs(game):
+        if blob_players[blob1] != blob_players[blob2]: continue
+        size1, size2 = sizes[blob1], sizes[blob2]
+        amount = min((position2 + size2) - (position1 - size1), (position1 + size1) - (position2 - size2))
+        if size1 < size2: positions[blob1] = (positions[blob1] - amount) % map_size
+        else: positions[blob2] = (positions[blob2] + amount) % map_size
+    return True
+
+def fire(game, player_index, offset):
+    """Have the largest blob of the player with index `player_index` in `game` fire some of its mass as food, `offset` cells past its edge (to the left if negative)."""
+    blobs = [blob for blob, blob_player in enumerate(game["blob_players"]) if blob_player == player_index]
+    blob = max(blobs, key=lambda blob: game["blob_sizes"][blob])
+    size = game["blob_sizes"][blob]
+    if size < 2: return # too small to fire
+    if offset < 0: offset -= size
+    else: offset += size
+    game["blob_sizes"][blob] -= 0.25
+    game["food"][round(game["blob_positions"][blob] + offset) % game["map_size"]] = 1
+
+def split(game, player_index, offset):
+    """Split each blob of the player with index `player_index` in `game` that's large enough in half, placing the new half `offset` cells past its edge (to the left if negative)."""
+    for blob, blob_player in enumerate(list(game["blob_players"])):
+        if blob_player != player_index or game["blob_sizes"][blob] < 2: continue # splitting isn't possible
+        size = game["blob_sizes"][blob]
+        game["blob_sizes"][blob] = size / 2
+        actual_offset = offset - size if offset < 0 else offset + size
+        game["blob_players"].append(player_index)
+        game["blob_positions"].append((game["blob_positions"][blob] + actual_offset) % game["map_size"])
+        game["blob_sizes"].append(size / 2)
+    game["player_split_cooldown"][player_index] = SPLIT_COOLDOWN
+
+def render_map(game):
+    map_size = game["map_size"]
+    result = [FOOD if has_food else EMPTY for has_food in game["food"]]
+    for player_index, position, size in zip(game["blob_players"], game["blob_positions"], game["blob_sizes"]):
+        result[round(position - size) % map_size] = "("
+        result[round(position) % map_size] = str(player_index + 1)
+        result[round(position + size) % map_size] = ")"
+    return "".join(result)
+
 class AgarioPlugin(BasePlugin):
     """
     1D agar.io game plugin for Botty.
+
+    Each channel or thread can have its own game going on. All of the games are stepped together by `on_step`, in fixed physics steps of `TICK_INTERVAL` seconds, independently of how often frames are shown. Frames are shown by editing each game's message whenever the send budget allows it (at most once every `FRAME_INTERVAL` seconds), and only if the map changed, so games never wait on sending messages.
+
+    Games are kept in the plugin state under "game:GAME_ID", where the game ID is "CHANNEL_ID/THREAD_ID" (with an empty thread ID for games outside of threads), so they survive plugin reloads. When several bot processes share the state, each game is only stepped by the process that owns it, and commands received by other processes are queued in the plugin state under "command:GAME_ID:TIME:PROCESS_ID:PLAYER" for the owner to apply. If the owner stops stepping a game, another process takes it over.
     """
     def __init__(self, bot):
         super().__init__(bot)
 
         self.last_step_time = 0
-        self.player_locations = {}
-        self.player_movement = {}
-        self.player_index = {}
-        self.player_split_cooldown = {}
-        self.game_map = []
-        self.game_channel, self.game_thread = None, None
+        self.owner_timeout = 5 # number of seconds after the owner of a game stops stepping it before another process can take over
+        self.game_ids = set() # IDs of games that might need stepping, kept in memory so that the plugin state doesn't need to be scanned on every step
+        self.last_game_list_refresh_time = 0
+        self.command_scan_due = False # whether commands queued by other processes should be looked for on this step
+        self.locally_queued_game_ids = set() # IDs of games that this process queued commands for since their commands were last applied, which are looked for right away
 
-        self.map_size = 150
-        self.empty = " "
-        self.food = "\u25E6"
+        # discard the game and commands left over from older versions of this plugin, which only supported one game at a time
+        self.state.delete("game")
+        for key in self.state.keys("command:"):
+            if "/" not in key.split(":")[1]: self.state.delete(key)
 
     def on_step(self):
         current_time = time.time()
-        if current_time - self.last_step_time < 0.2: return False
+        if current_time - self.last_step_time < TICK_INTERVAL: return False
         self.last_step_time = current_time
 
-        if self.game_channel is None: return # no game going on
-
-        self.step_game()
-
-        return True
+        # pick up games started and commands queued by other processes every now and then, rather than listing keys in the plugin state on every step
+        self.command_scan_due = current_time - self.last_game_list_refresh_time >= GAME_LIST_REFRESH_INTERVAL
+        if self.command_scan_due:
+            self.last_game_list_refresh_time = current_time
+            self.game_ids.update(key[len("game:"):] for key in self.state.keys("game:"))
+
+        # step games with the oldest frames first, so they all get a fair share of the send budget
+        games = []
+        for game_id in list(self.game_ids):
+            game = self.state.get("game:{}".format(game_id))
+            if game is None: # game was ended, possibly by another process
+                self.game_ids.discard(game_id)
+                self.locally_queued_game_ids.discard(game_id)
+                continue
+            if game["owner"] != os.getpid() and current_time - game["last_step_time"] < self.owner_timeout: continue # game is being stepped by another process
+            games.append((game["frame_time"], game_id, game))
+        for _, game_id, game in sorted(games, key=lambda entry: entry[0]):
+            self.step_session(game_id, game, current_time)
+
+        return False # let other plugins step too
+
+    def step_session(self, game_id, game, current_time):
+        game["owner"], game["last_step_time"] = os.getpid(), current_time
+        if not self.apply_queued_commands(game_id, game): return
+
+        # run however many physics steps are due, dropping any beyond the catch-up limit
+        ticks = int((current_time - game["tick_time"]) / TICK_INTERVAL)
+        game["tick_time"] += ticks * TICK_INTERVAL
+        for _ in range(min(ticks, MAX_CATCH_UP_TICKS)):
+            if not step_game(game):
+                self.end_game(game_id, game)
+                return
+
+        # show the latest frame if it changed and it can be sent without waiting
+        frame = render_map(game)
+        if frame != game["frame"] and current_time - game["frame_time"] >= FRAME_INTERVAL and self.has_send_budget():
+            self.update_message("{}\n`{}`".format(game["title"], frame), channel_id=game["channel"], timestamp=game["frame_timestamp"])
+            game["frame"], game["frame_time"] = frame, current_time
+
+        self.state.set("game:{}".format(game_id), game)
 
     def on_message(self, m):
         if not m.is_user_text_message: return False
@@ -59,43 +270,72 @@ class AgarioPlugin(BasePlugin):
             self.initialize_game(m.channel_id, m.thread_id, players)
             return True
 
-        if self.game_channel is None: return False # no game going on
-        if m.channel_id != self.game_channel: return False # message isn't in the right channel
+        # find the game in the message's thread, or in its channel if there isn't one in the thread
+        game_id = "{}/{}".format(m.channel_id, m.thread_id or "")
+        game = self.state.get("game:{}".format(game_id))
+        if game is None and m.thread_id is not None:
+            game_id = "{}/".format(m.channel_id)
+            game = self.state.get("game:{}".format(game_id))
+        if game is None: return False # no game going on
 
         # game stop command
         match = re.search(r"\b(stop|end|terminate|off|disable)\b", text, re.IGNORECASE)
         if match:
-            self.end_game()
+            self.queue_command(game_id, user_name, "stop")
             return True
 
-        if user_name not in self.player_locations: return False # player isn't in the game
+        if user_name not in game["players"] or game["players"].index(user_name) not in get_live_players(game): return False # player isn't in the game
 
         # directional commands
         match = re.search(r"^\s*([<v>])\s*(-|/|)\s*$", text, re.IGNORECASE)
         if match:
-            direction, action = match.groups()
+            self.queue_command(game_id, user_name, match.group(1) + match.group(2))
+            return True
+
+        return False
+
+    def queue_command(self, game_id, player, command):
+        """Queue `command` from `player` to be applied by the process that steps the game with ID `game_id`. Each command gets its own key, so concurrent commands from different processes never overwrite each other."""
+        self.state.set("command:{}:{:.6f}:{}:{}".format(game_id, time.time(), os.getpid(), player), command)
+        self.locally_queued_game_ids.add(game_id)
+
+    def apply_queued_commands(self, game_id, game):
+        """Apply queued commands to `game`, which has ID `game_id`, returning `False` if the game was stopped, `True` otherwise."""
+        if not self.command_scan_due and game_id not in self.locally_queued_game_ids: return True # nothing new was queued by this process, and commands from other processes are only looked for every `GAME_LIST_REFRESH_INTERVAL` seconds
+        self.locally_queued_game_ids.discard(game_id)
+        live_players = get_live_players(game)
+        for key in sorted(self.state.keys("command:{}:".format(game_id)), key=lambda key: float(key.split(":")[2])):
+            player, command = key.split(":", 4)[4], self.state.get(key)
+            self.state.delete(key)
+            if command == "stop":
+                self.end_game(game_id, game)
+                return False
+            player_index = game["players"].index(player) if player in game["players"] else None
+            if player_index not in live_players: continue # player was eaten after sending the command
+
+            direction, action = command[0], command[1:]
             offset = {"<": -1, "v": 0, ">": 1}[direction]
             if action == "-": # fire some mass in the desired direction
-                self.fire(user_name, offset * 2)
+                fire(game, player_index, offset * 2)
             elif action == "/":
-                self.split(user_name, offset * 4)
+                split(game, player_index, offset * 4)
             else:
-                self.player_movement[user_name] = offset
-            return True
-
-        return False
+                game["player_movement"][player_index] = offset
+        return True
 
-    def end_game(self):
-        self.game_channel, self.game_thread = None, None
+    def end_game(self, game_id, game):
+        self.state.delete("game:{}".format(game_id))
+        self.game_ids.discard(game_id)
+        self.locally_queued_game_ids.discard(game_id)
+        total_masses = {}
+        for player_index, size in zip(game["blob_players"], game["blob_sizes"]):
+            total_masses[player_index] = total_masses.get(player_index, 0) + size
         masses = sorted(
-            (
-                (player, sum(location[1] for location in locations))
-                for player, locations in self.player_locations.items()
-            ),
+            ((game["players"][player_index], total_mass) for player_index, total_mass in total_masses.items()),
             key = lambda pair: -pair[1]
         )
 
-        self.respond(
+        self.say(
             "*{} wins!*\n"
             "{}".format(
                 untag_word(masses[0][0]),
@@ -103,140 +343,39 @@ class AgarioPlugin(BasePlugin):
                     "> *{}* has total mass {}".format(untag_word(player), total_mass)
                     for player, total_mass in masses
                 )
-            )
-        )
-
-    def initialize_game(self, channel, thread, players):
-        self.game_channel, self.game_thread = channel, thread
-        self.player_locations = {}
-        self.player_movement = {}
-        self.player_index = {}
-        self.player_split_cooldown = {}
-        current_position = random.randrange(0, 8)
-        for i, player in enumerate(players):
-            self.player_locations[player] = [[current_position, 1]]
-            self.player_movement[player] = 0
-            self.player_index[player] = i
-            self.player_split_cooldown[player] = 0
-            current_position = (current_position + random.randrange(10, 30)) % self.map_size
-        self.game_map = [self.food if random.random() < 0.3 else self.empty for i in range(self.map_size)]
-
-        self.say(
-            "*AGAR.IO GAME STARTED* (players from left to right: {})\nSTARTING MAP: `{}`".format(
-                ", ".join(players), self.render_map()
             ),
-            channel_id=channel, thread_id=thread
+            channel_id=game["channel"], thread_id=game["thread"]
         )
 
-    def step_game(self):
-        # occasionally spawn food in random places
-        if random.random() < 0.3:
-            self.game_map[random.randrange(self.map_size)] = self.food
-
-        # apply joining after splitting
-        for player, locations in self.player_locations.items():
-            if self.player_split_cooldown[player] <= 0 and len(locations) > 1:
-                locations = sorted(locations, key=lambda pair: pair[1])
-                new_locations = []
-                for i in range(0, len(locations) - 1, 2):
-                    (position1, size1), (position2, size2) = locations[i], locations[i + 1]
-                    new_locations.append([position1 if size1 > size2 else position2, size1 + size2])
-                self.player_locations[player] = new_locations
-                self.player_split_cooldown[player] = 20
-            self.player_split_cooldown[player] -= 1
-
-        # apply movement
-        for player, movement in self.player_movement.items():
-            for blob, (position, size) in enumerate(self.player_locations[player]):
-                self.player_locations[player][blob][0] = (position + movement / size) % self.map_size
-
-        # apply food eating
-        for player, locations in self.player_locations.items():
-            for blob, (position, size) in enumerate(locations):
-                for i in range(ceil(position - size), floor(position + size + 1)):
-                    if self.game_map[i % self.map_size] == self.food:
-                        self.game_map[i % self.map_size] = self.empty
-                        self.player_locations[player][blob][1] += 0.25
-
-        # apply blobs from different players eating each other
-        pairs = list(self.player_locations.items())
-        for i, (player1, locations1) in enumerate(pairs):
-            for blob1, location1 in enumerate(locations1):
-                if location1 is None: continue
-                position1, size1 = location1
-                for player2, locations2 in pairs[i + 1:]:
-                    for blob2, location2 in enumerate(locations2):
-                        if location2 is None: continue
-                        position2, size2 = location2
-                        if (
-                            position1 - size1 <= position2 <= position1 + size1 or
-                            position2 - size2 <= position1 <= position2 + size2
-                        ): # one blob is halfway or more inside of another blob, so it is being eaten
-                            if size1 < size2 * 0.8: # blob 1 can be eaten by blob 2
-                                self.player_locations[player2][blob2][1] += size1
-                                self.player_locations[player1][blob1] = None
-                            elif size2 < size1 * 0.8: # blob 2 can be eaten by blob 1
-                                self.player_locations[player1][blob1][1] += size2
-                                self.player_locations[player2][blob2] = None
-
-        # remove dead player blobs
-        new_player_locations = {}
-        for player, locations in self.player_locations.items():
-            new_locations = [location for location in locations if location is not None]
-            if len(new_locations) > 0:
-                new_player_locations[player] = new_locations
-            else:
-                del self.player_index[player]
-                del self.player_movement[player]
-        self.player_locations = new_player_locations
-        if len(new_player_locations) < 2: # last player standing, player wins
-            self.end_game()
-            return
-
-        # apply collision among blobs of a single player
-        for player, locations in self.player_locations.items():
-            for blob1, (position1, size1) in enumerate(locations):
-                for blob2, (position2, size2) in enumerate(locations):
-                    if blob1 == blob2: continue
-                    if (
-                        position1 - size1 <= position2 + size2 and
-                        position2 - size2 <= position1 + size1
-                    ): # a blob is colliding with another blob in the same player, nudge it out of the way
-                        amount = min((position2 + size2) - (position1 - size1), (position1 + size1) - (position2 - size2))
-                        if size1 < size2:
-                            self.player_locations[player][blob1][0] = (position1 - amount) % self.map_size
-                        else:
-                            self.player_locations[player][blob2][0] = (position2 + amount) % self.map_size
-
-        self.say("`{}`".format(self.render_map()), channel_id=self.game_channel, thread_id=self.game_thread)
-
-    def fire(self, player, offset):
-        locations = self.player_locations[player]
-        location = max(locations, key=lambda location: location[1])
-        if location[1] < 2: return # too small to fire
-        if offset < 0: offset -= location[1]
-        else: offset += location[1]
-        location[1] -= 0.25
-        self.game_map[round(location[0] + offset) % self.map_size] = self.food
-
-    def split(self, player, offset):
-        locations = self.player_locations[player]
-        new_locations = []
-        for i, location in enumerate(locations):
-            if location[1] >= 2: # splitting is possible
-                new_size = location[1] / 2
-                locations[i][1] = new_size
-                if offset < 0: actual_offset = offset - location[1]
-                else: actual_offset = offset + location[1]
-                new_locations.append([(location[0] + actual_offset) % self.map_size, new_size])
-        self.player_locations[player] += new_locations
-        self.player_split_cooldown[player] = 20
-
-    def render_map(self):
-        result = list(self.game_map)
-        for player, locations in self.player_locations.items():
-            for position, size in locations:
-                result[round(position - size) % self.map_size] = "("
-                result[round(position) % self.map_size] = str(self.player_index[player] + 1)
-                result[round(position + size) % self.map_size] = ")"
-        return "".join(result)
+    def initialize_game(self, channel, thread, players):
+        game_id = "{}/{}".format(channel, thread or "")
+        for key in self.state.keys("command:{}:".format(game_id)): self.state.delete(key) # discard commands left over from previous games
+        game = create_game(players)
+        game.update({
+            "channel": channel, "thread": thread,
+            "owner": os.getpid(), "last_step_time": time.time(), "tick_time": time.time(),
+            "title": "*AGAR.IO GAME STARTED* (players from left to right: {})".format(", ".join(players)),
+            "frame": render_map(game), "frame_time": time.time(),
+        })
+        game["frame_timestamp"] = self.say_complete("{}\n`{}`".format(game["title"], game["frame"]), channel_id=channel, thread_id=thread) # this message is edited to show each frame
+        self.state.set("game:{}".format(game_id), game)
+        self.game_ids.add(game_id)
+
+if __name__ == "__main__":
+    # benchmark the simulation with different numbers of players, with everyone moving around and splitting randomly
+    # run this from the `src` directory with `python3 -m plugins.agario`
+    print("{:>8} {:>10} {:>12}".format("players", "blobs", "ticks/s"))
+    for player_count in [2, 4, 8, 16, 32, 64, 128]:
+        random.seed(0)
+        game = create_game(["player{}".format(i) for i in range(player_count)])
+        tick_count, blob_count, elapsed_time = 0, 0, 0
+        while elapsed_time < 2:
+            for player_index in get_live_players(game):
+                if random.random() < 0.1: game["player_movement"][player_index] = random.choice([-1, 0, 1])
+                if random.random() < 0.02: split(game, player_index, random.choice([-4, 4]))
+            start_time = time.perf_counter()
+            game_continues = step_game(game)
+            elapsed_time += time.perf_counter() - start_time
+            tick_count, blob_count = tick_count + 1, blob_count + len(game["blob_sizes"])
+            if not game_continues: game = create_game(["player{}".format(i) for i in range(player_count)]) # start over once someone wins
+        print("{:>8} {:>10.1f} {:>12.0f}".format(player_count, blob_count / tick_count, tick_count / elapsed_time))
@@ -1,17 +1,28 @@
 #!/usr/bin/env python3
 
-import re, random
+import re, random, time, io
 import token
+import collections
 import multiprocessing
 
 import sympy
 from sympy.core import numbers
 from sympy.parsing.sympy_parser import parse_expr, standard_transformations, implicit_multiplication, implicit_application
-from sympy.parsing.sympy_tokenize import TokenError
+from sympy.parsing.sympy_tokenize import TokenError, generate_tokens
 from sympy.physics import units
 
 from .utilities import BasePlugin
 
+EVALUATOR_PROCESSES = 2 # number of evaluator processes, which is the number of expressions that can be evaluated at the same time
+EVALUATION_TIME_LIMIT = 1 # maximum time in seconds that an expression can take to evaluate
+RESULT_CACHE_SIZE = 1000 # maximum number of expression results to remember
+TIMEOUT_CACHE_DURATION = 3600 # time in seconds to remember that an expression timed out, after which it can be tried again (timeouts can also be caused by the machine being busy)
+
+# evaluator processes are started by a fork server process rather than forked from the bot, since the bot has other threads running, and forking while another thread holds a lock leaves that lock held forever in the child
+# the fork server imports this module (and Sympy) once, so starting each evaluator process is still fast
+EVALUATOR_CONTEXT = multiprocessing.get_context("forkserver")
+EVALUATOR_CONTEXT.set_forkserver_preload([__name__])
+
 ALLOWED_TOKENS = {
     token.ENDMARKER,  token.NAME,      token.NUMBER,     token.STRING,       token.LPAR,
     token.RPAR,       token.LSQB,      token.RSQB,       token.COMMA,        token.PLUS,
@@ -40,35 +51,148 @@ def whitelist_tokens(tokens, local_dict, global_dict):
         raise TokenError("forbidden token {}".format(token_type))
     return tokens
 
-def evaluate_with_time_limit(text, time_limit=1):
-    def evaluate(queue, text):
-        subs = {
-            sympy.Symbol(k): v for k, v in units.__dict__.items()
-            if (isinstance(v, sympy.Expr) and v.has(units.Unit)) or isinstance(v, sympy.Integer)
+TRANSFORMATIONS = (whitelist_tokens,) + standard_transformations + (implicit_multiplication, implicit_application)
+
+def get_cache_key(text):
+    """Returns the token stream of the expression `text` as a tuple of `(token_type, token_value)` tuples, which is the same for expressions that only differ in whitespace, or `None` if it contains forbidden tokens or can't be tokenized."""
+    try: return tuple(whitelist_tokens([(token_type, token_value) for token_type, token_value, _, _, _ in generate_tokens(io.StringIO(text.strip()).readline)], None, None))
+    except (TokenError, SyntaxError): return None
+
+def evaluate(text):
+    """Returns the result of evaluating the expression `text`, as an `(expression, value)` tuple, where `expression` is the simplified expression as text (or `None` if it looks the same as `value`), and `value` is its numerical value to 80 digits (or `None` if it doesn't have one)."""
+    expression = sympy.simplify(parse_expr(text, local_dict=ALLOWED_NAMESPACE, global_dict={}, transformations=TRANSFORMATIONS))
+    if not hasattr(expression, "evalf") or isinstance(expression, numbers.Integer) or isinstance(expression, numbers.Float):
+        return str(expression), None
+    value = expression.evalf(80)
+    if value == sympy.zoo: formatted_value = "(complex infinity)"
+    elif value == sympy.oo: formatted_value = "\u221e"
+    else: formatted_value = str(value)
+    return (None if str(value) == str(expression) else str(expression)), formatted_value
+
+def run_evaluator(connection):
+    """Evaluate expressions received over `connection` forever, sending back `(True, result)` for each one that succeeds, or `(False, error_message)` for each one that fails."""
+    try: evaluate("sqrt(2) * x") # warm up Sympy's caches and lazily imported modules before accepting any expressions
+    except Exception: pass
+    connection.send(None) # let the pool know this process is ready
+    while True:
+        try: text = connection.recv()
+        except EOFError: return # pool was closed
+        try: result = (True, evaluate(text))
+        except Exception as e: result = (False, str(e))
+        connection.send(result)
+
+class Evaluator:
+    """Evaluator process started ahead of time by an `EvaluatorPool`, running `run_evaluator`."""
+    def __init__(self):
+        self.connection, child_connection = EVALUATOR_CONTEXT.Pipe()
+        self.process = EVALUATOR_CONTEXT.Process(target=run_evaluator, args=(child_connection,), daemon=True)
+        self.process.start()
+        child_connection.close() # only the child process uses this end, so closing it here lets us notice if the child process dies
+        self.ready = False
+        self.task_id, self.deadline = None, None # task being evaluated, if any, and the time by which it must be finished
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+class EvaluatorPool:
+    """
+    Pool of `process_count` evaluator processes, which are started ahead of time so that evaluating an expression doesn't need to wait for a new process to start.
+
+    Expressions are submitted with `submit`, and their results are collected later with `poll`, so the caller never waits for an evaluation to finish. Each expression is given `time_limit` seconds from when an evaluator process starts evaluating it, after which that process is killed and replaced, without affecting the other processes.
+    """
+    def __init__(self, process_count, time_limit):
+        self.time_limit = time_limit
+        self.evaluators = [Evaluator() for _ in range(process_count)]
+        self.pending_tasks = collections.deque() # `(task_id, text)` tuples waiting for an evaluator process to become available
+        self.next_task_id = 0
+
+    def submit(self, text):
+        """Queue the expression `text` for evaluation, returning a task ID that its result will be returned with by `poll`."""
+        task_id = self.next_task_id
+        self.next_task_id += 1
+        self.pending_tasks.append((task_id, text))
+        self.dispatch()
+        return task_id
+
+    def poll(self):
+        """Returns a list of `(task_id, result)` tuples for each expression that finished evaluating since the last call, where `result` is `(True, result)` or `(False, error_message)` (see `run_evaluator`), or `None` if evaluation timed out."""
+        finished_tasks = []
+        for index, evaluator in enumerate(self.evaluators):
+            try: message_available = evaluator.connection.poll()
+            except (EOFError, OSError): message_available = True # the process died, so `recv` will fail below
+            if message_available:
+                try: result = evaluator.connection.recv()
+                except (EOFError, OSError): # the process died, possibly while evaluating something
+                    if evaluator.task_id is not None: finished_tasks.append((evaluator.task_id, (False, "evaluator crashed")))
+                    evaluator.kill()
+                    self.evaluators[index] = Evaluator()
+                    continue
+                if not evaluator.ready: evaluator.ready = True # this is the message saying the process is ready
+                else: finished_tasks.append((evaluator.task_id, result))
+                evaluator.task_id, evaluator.deadline = None, None
+            elif evaluator.task_id is not None and time.monotonic() > evaluator.deadline:
+                finished_tasks.append((evaluator.task_id, None))
+                evaluator.kill()
+                self.evaluators[index] = Evaluator()
+        self.dispatch()
+        return finished_tasks
+
+    def dispatch(self):
+        """Start evaluating pending expressions on any evaluator processes that are ready and idle."""
+        for evaluator in self.evaluators:
+            if not self.pending_tasks: break
+            if not evaluator.ready or evaluator.task_id is not None: continue
+            evaluator.task_id, text = self.pending_tasks.popleft()
+            evaluator.deadline = time.monotonic() + self.time_limit
+            evaluator.connection.send(text)
+
+    def close(self):
+        for evaluator in self.evaluators: evaluator.kill()
+
+class ResultCache:
+    """
+    Least recently used cache of up to `max_entries` evaluation results, keyed by the token streams returned by `get_cache_key`.
+
+    Timeouts are cached too, so that known pathological expressions don't keep tying up evaluator processes, but they're only remembered for `timeout_duration` seconds.
+    """
+    def __init__(self, max_entries, timeout_duration):
+        assert isinstance(max_entries, int) and max_entries > 0, "`max_entries` must be a positive integer rather than \"{}\"".format(max_entries)
+        self.max_entries, self.timeout_duration = max_entries, timeout_duration
+        self.entries = collections.OrderedDict() # mapping from keys to `(result, expiry time)` tuples, ordered from least to most recently used
+        self.hits, self.timeout_hits, self.misses = 0, 0, 0
+
+    def get(self, key):
+        """Returns the cached result for `key` (`None` if it timed out), in the same form as the results returned by `EvaluatorPool.poll`, raising `KeyError` if it isn't cached."""
+        result, expiry_time = self.entries.get(key, (None, 0))
+        if expiry_time is not None and expiry_time <= time.monotonic(): # missing or expired
+            self.entries.pop(key, None)
+            self.misses += 1
+            raise KeyError(key)
+        self.entries.move_to_end(key)
+        if result is None: self.timeout_hits += 1
+        else: self.hits += 1
+        return result
+
+    def put(self, key, result):
+        self.entries[key] = (result, time.monotonic() + self.timeout_duration if result is None else None)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries: self.entries.popitem(last=False)
+
+    def get_statistics(self):
+        """Returns a dictionary of statistics about cache usage, including the hit rate (`None` if the cache hasn't been used yet) and the number of hits that were cached timeouts."""
+        lookups = self.hits + self.timeout_hits + self.misses
+        return {
+            "hit_rate": (self.hits + self.timeout_hits) / lookups if lookups else None,
+            "hits": self.hits, "timeout_hits": self.timeout_hits, "misses": self.misses, "entries": len(self.entries),
         }
-        try:
-            transformations = (whitelist_tokens,) + standard_transformations + (implicit_multiplication, implicit_application)
-            expression = parse_expr(text, local_dict=ALLOWED_NAMESPACE, global_dict={}, transformations=transformations)
-            simplified_expression = sympy.simplify(expression)
-            queue.put(simplified_expression)
-        except Exception as e:
-            queue.put(e)
-
-    # run the evaluator in a separate process in order to enforce time limits
-    queue = multiprocessing.SimpleQueue()
-    process = multiprocessing.Process(target=evaluate, args=(queue, text))
-    process.start()
-    process.join(time_limit)
-    if process.is_alive() or queue.empty():
-        process.terminate()
-        return None
-    return queue.get()
 
 class ArithmeticPlugin(BasePlugin):
     """
     Symbolic mathematics plugin for Botty.
 
-    This uses Sympy for computation and implements evaluation timeouts by spawning a child process and killing it if it takes too much time.
+    This uses Sympy for computation. Expressions are evaluated in a pool of evaluator processes that are started along with the plugin, and results are sent from `on_step` when they're ready, so the bot keeps running while expressions are being evaluated. Evaluation timeouts are implemented by killing and replacing evaluator processes that take too much time. Results (including timeouts) are cached by the expression's tokens, so repeated expressions are answered immediately.
 
     Example invocations:
 
@@ -83,6 +207,19 @@ class ArithmeticPlugin(BasePlugin):
     """
     def __init__(self, bot):
         super().__init__(bot)
+        self.evaluator_pool = EvaluatorPool(EVALUATOR_PROCESSES, EVALUATION_TIME_LIMIT)
+        self.pending_queries = {} # mapping from evaluator task IDs to `(query, message, cache key)` tuples for the expressions being evaluated
+        self.result_cache = ResultCache(RESULT_CACHE_SIZE, TIMEOUT_CACHE_DURATION)
+
+    def on_step(self):
+        for task_id, result in self.evaluator_pool.poll():
+            query, m, cache_key = self.pending_queries.pop(task_id)
+            if cache_key is not None and (result is None or result[0]): self.result_cache.put(cache_key, result) # errors aren't cached, since they're fast anyways
+            self.respond_with_result(query, m, result)
+        return False
+
+    def on_unload(self):
+        self.evaluator_pool.close()
 
     def on_message(self, m):
         if not m.is_user_text_message: return False
@@ -90,25 +227,36 @@ class ArithmeticPlugin(BasePlugin):
         if not match: return False
         query = self.sendable_text_to_text(match.group(1)) # get query as plain text in order to make things like < and > work (these are usually escaped)
 
-        expression = evaluate_with_time_limit(query)
-        if isinstance(expression, Exception): # evaluation resulted in error
-            message = random.choice(["s a d e x p r e s s i o n s", "wat", "results hazy, try again later", "cloudy with a chance of thunderstorms", "oh yeah, I learned all about that in my sociology class", "eh too lazy, get someone else to do it", "would you prefer the truth or a lie?", "nice try", "you call that an expression?"])
-            self.respond_raw("{} ({})".format(message, expression), as_thread=True)
-        elif expression is None: # evaluation timed out
-            self.respond_raw("tl;dr", as_thread=True)
-        else: # evaluation completed successfully
-            if hasattr(expression, "evalf") and not isinstance(expression, numbers.Integer) and not isinstance(expression, numbers.Float):
-                value = expression.evalf(80)
-                if value == sympy.zoo: formatted_value = "(complex infinity)"
-                elif value == sympy.oo: formatted_value = "\u221e"
-                else: formatted_value = str(value)
-                if str(value) == str(expression) or str(query) == str(expression): self.respond_raw("{} :point_right: {}".format(query, formatted_value))
-                else: self.respond_raw("{} :point_right: {} :point_right: {}".format(query, expression, formatted_value))
+        cache_key = get_cache_key(query)
+        if cache_key is not None:
+            try: result = self.result_cache.get(cache_key)
+            except KeyError: pass
             else:
-                self.respond_raw("{} :point_right: {}".format(query, expression))
+                self.logger.debug("answered \"{}\" from cache ({})".format(query, self.result_cache.get_statistics()))
+                self.respond_with_result(query, m, result)
+                return True
+        self.pending_queries[self.evaluator_pool.submit(query)] = (query, m, cache_key) # the response is sent from `on_step` once the expression is evaluated
         return True
 
+    def respond_with_result(self, query, m, result):
+        """Respond to the message `m` containing the expression `query` with `result`, a result returned by `EvaluatorPool.poll`."""
+        if result is None: # evaluation timed out
+            self.say_raw("tl;dr", channel_id=m.channel_id, thread_id=m.thread_id or m.timestamp)
+        elif not result[0]: # evaluation resulted in error
+            message = random.choice(["s a d e x p r e s s i o n s", "wat", "results hazy, try again later", "cloudy with a chance of thunderstorms", "oh yeah, I learned all about that in my sociology class", "eh too lazy, get someone else to do it", "would you prefer the truth or a lie?", "nice try", "you call that an expression?"])
+            self.say_raw("{} ({})".format(message, result[1]), channel_id=m.channel_id, thread_id=m.thread_id or m.timestamp)
+        else: # evaluation completed successfully
+            expression, value = result[1]
+            if value is None: self.say_raw("{} :point_right: {}".format(query, expression), channel_id=m.channel_id, thread_id=m.thread_id)
+            elif expression is None or query == expression: self.say_raw("{} :point_right: {}".format(query, value), channel_id=m.channel_id, thread_id=m.thread_id)
+            else: self.say_raw("{} :point_right: {} :point_right: {}".format(query, expression, value), channel_id=m.channel_id, thread_id=m.thread_id)
+
+    def get_cache_statistics(self): return self.result_cache.get_statistics()
+
 if __name__ == "__main__":
-    print(evaluate_with_time_limit("integrate(1/x, x)"))
-    print(evaluate_with_time_limit("1+/a"))
-    print(evaluate_with_time_limit("1kg meter/second**2 + 2 newtons"))
+    pool = EvaluatorPool(EVALUATOR_PROCESSES, EVALUATION_TIME_LIMIT)
+    queries = {pool.submit(text): text for text in ["integrate(1/x, x)", "1+/a", "1kg meter/second**2 + 2 newtons"]}
+    while queries:
+        for task_id, result in pool.poll(): print(queries.pop(task_id), result)
+        time.sleep(0.01)
+    pool.close()
@@ -1,45 +1,116 @@
 #!/usr/bin/env python3
 
-import re, random, sqlite3
+import os, re, sqlite3, time
+import threading
 from os import path
+from collections import deque, Counter
 
 from ..utilities import BasePlugin
-from .markov import Markov
+from .markov import Markov, CompiledMarkov, MappedMarkov, speak_db, train_db, SUFFIX_INDEX_SCHEMA, UPDATED_KEYS_SCHEMA
 
 SQLITE_DATABASE = path.join(path.dirname(path.realpath(__file__)), "chains.db") # Markov chain values, generated by `src/plugins/generate_text/generate_chains_db.py`
+MODEL_FILE = path.join(path.dirname(path.realpath(__file__)), "chains.bin") # memory-mapped copy of the Markov chain values, exported by `src/plugins/generate_text/generate_chains_db.py`
 LOOKBEHIND_LENGTH = 2
+LOW_MEMORY_MODE = False # set this to `True` to query the chain database for every generated token, rather than loading the whole chain into memory at startup when the model file isn't available
+TRAINING_FLUSH_INTERVAL = 60 # number of seconds between writes of newly received messages to the chain database
+PREGENERATED_SENTENCES_PER_SEED = 8 # number of sentences to keep pre-generated for each seed
+PREGENERATED_SEED_COUNT = 10 # number of most frequently requested seeds to keep sentences pre-generated for, besides the empty seed
+PREGENERATION_TRACKED_SEEDS = 10000 # maximum number of distinct seeds to keep request counts for when choosing which seeds to pre-generate sentences for
+RELOAD_CHECK_INTERVAL = 5 # number of seconds between checks for a rebuilt chain database or model file
+
+def get_chain_files():
+    """Returns a tuple identifying the current chain database and model file, which changes whenever either of them is rebuilt (since they're rebuilt by renaming a new file over the old one)."""
+    identities = []
+    for file_path in [SQLITE_DATABASE, MODEL_FILE]:
+        try: file_stat = os.stat(file_path)
+        except FileNotFoundError: identities.append(None)
+        else: identities.append((file_stat.st_dev, file_stat.st_ino)) # the inode of the old file can't be reused while we still have it open
+    return tuple(identities)
+
+class SentencePool:
+    """
+    Pools of pre-generated sentence continuations for the empty seed and the `seed_count` most frequently requested seeds, each holding up to `pool_size` continuations.
+
+    A background thread keeps the pools full by calling `generate(seed)`, where `seed` is a tuple of tokens, so that most replies are just a pop rather than generating text on the main thread. Errors from `generate` are logged to `logger`.
 
-def speak_db(db_connection, lookbehind_length, initial_state = ()):
-    # generate a message based on probability chains
-    current_key = tuple(initial_state)[-lookbehind_length:]
-    token_list = []
-    while True:
-        row = db_connection.execute("SELECT count FROM counts WHERE key = ?", ("\n".join(current_key),)).fetchone()
-        if row is None: raise KeyError("Key not in chain: {}".format(current_key))
-        count = row[0]
-        random_choice = random.randrange(0, count)
-        choices = db_connection.execute("SELECT next_word, occurrences FROM chain WHERE key = ?", ("\n".join(current_key),))
-        for current_choice, occurrences in choices:
-            random_choice -= occurrences
-            if random_choice < 0:
-                new_token = current_choice
-                break
-        else: # couldn't find the choice somehow
-            raise ValueError("Bad choice for key: {}".format(current_key)) # this should never happen but would otherwise be hard to detect if it did
-
-        # add the token to the message
-        if new_token == None: break
-        token_list.append(new_token)
-
-        if len(current_key) < lookbehind_length: current_key += (new_token,) # add current token to key if just starting
-        else: current_key = current_key[1:] + (new_token,) # shift token onto key if inside message
-    return token_list
+    Request counts are kept for at most `max_tracked_seeds` seeds. Whenever there are more, all counts are halved and seeds that fall to zero are forgotten, so rarely requested seeds don't accumulate forever and recent requests count for more than old ones.
+    """
+    def __init__(self, generate, *, pool_size, seed_count, max_tracked_seeds, logger):
+        self.generate = generate
+        self.pool_size, self.seed_count, self.max_tracked_seeds = pool_size, seed_count, max_tracked_seeds
+        self.logger = logger
+        self.pools = {(): deque()} # mapping from seeds to deques of continuations
+        self.seed_requests = Counter() # mapping from seeds to the number of times they've been requested, recently
+        self.unknown_seeds = set() # seeds that the chain can't generate continuations for
+        self.generation = 0 # incremented whenever the pools are invalidated, so continuations generated before then are discarded
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def pop(self, seed):
+        """Returns a pre-generated continuation for `seed`, or `None` if there aren't any available."""
+        with self.lock:
+            self.seed_requests[seed] += 1
+            if len(self.seed_requests) > self.max_tracked_seeds: self.prune_seed_requests()
+            if seed not in self.pools and seed not in self.unknown_seeds:
+                # start pre-generating for this seed if it's now one of the most frequently requested ones
+                pooled_seeds = [pooled_seed for pooled_seed in self.pools if pooled_seed != ()]
+                if len(pooled_seeds) < self.seed_count:
+                    self.pools[seed] = deque()
+                else:
+                    least_requested_seed = min(pooled_seeds, key=lambda pooled_seed: self.seed_requests[pooled_seed])
+                    if self.seed_requests[seed] > self.seed_requests[least_requested_seed]:
+                        del self.pools[least_requested_seed]
+                        self.pools[seed] = deque()
+            pool = self.pools.get(seed)
+            continuation = pool.popleft() if pool else None
+        self.wakeup.set()
+        return continuation
+
+    def prune_seed_requests(self):
+        """Halve all request counts, forgetting seeds that end up with none (except pooled ones), then keep only the most requested half of `max_tracked_seeds` seeds if there are still too many. Must be called with `self.lock` held."""
+        self.seed_requests = Counter({seed: count // 2 for seed, count in self.seed_requests.items() if count // 2 > 0 or seed in self.pools})
+        if len(self.seed_requests) > self.max_tracked_seeds // 2:
+            self.seed_requests = Counter(dict(self.seed_requests.most_common(self.max_tracked_seeds // 2)))
+
+    def invalidate(self):
+        """Discard all pre-generated continuations, such as after the chain changes."""
+        with self.lock:
+            self.generation += 1
+            for pool in self.pools.values(): pool.clear()
+            self.pools.setdefault((), deque())
+            self.unknown_seeds.clear()
+        self.wakeup.set()
+
+    def run(self):
+        while True:
+            with self.lock:
+                generation = self.generation
+                seed = next((seed for seed, pool in self.pools.items() if len(pool) < self.pool_size), None)
+            if seed is None: # all pools are full, wait for one to be consumed
+                self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+
+            try: continuation = self.generate(seed)
+            except KeyError:
+                with self.lock:
+                    self.pools.pop(seed, None)
+                    self.unknown_seeds.add(seed)
+                continue
+            except Exception: # such as a database error while the chain is being replaced, so log it and keep the thread running
+                self.logger.exception("sentence pre-generation failed for seed {}".format(seed))
+                time.sleep(1) # avoid spinning if the error keeps happening
+                continue
+            with self.lock:
+                if generation == self.generation and seed in self.pools: self.pools[seed].append(continuation)
 
 class GenerateTextPlugin(BasePlugin):
     """
     Text generation plugin for Botty.
 
-    This is implemented with a Markov chain with 2 token lookbehind.
+    This is implemented with a Markov chain with 2 token lookbehind. The chain is trained on new messages as they arrive, which are written to the chain database every `TRAINING_FLUSH_INTERVAL` seconds. Sentences for common seeds are generated ahead of time on a background thread. When the chain database or model file is rebuilt, the new chain is loaded on a background thread and swapped in without restarting.
 
     Example invocations:
 
@@ -52,26 +123,105 @@ class GenerateTextPlugin(BasePlugin):
     """
     def __init__(self, bot):
         super().__init__(bot)
-
+        self.connection, self.model = None, None
+        self.pending_training = Markov(LOOKBEHIND_LENGTH) # messages received since the last write to the chain database
+        self.last_training_flush_time = time.monotonic()
+        self.last_reload_check_time = time.monotonic()
+        self.pool_connection = None # SQLite connections can't be shared between threads, so the sentence pool's thread gets its own
+        self.sentence_pool = None # started once there's a chain to generate sentences from
+        self.chain_loader = None # thread loading a rebuilt chain, if any
+        self.loaded_chain = None # `(connection, model)` tuple loaded by `self.chain_loader`, or `None` if it failed
+        self.chain_files = get_chain_files()
+        self.swap_chain(*self.open_chain())
+
+    def open_chain(self):
+        """Returns the chain database connection and model as a `(connection, model)` tuple, where `connection` is `None` if there's no usable database. This doesn't change the plugin's state, so it's safe to call from another thread."""
         if not path.exists(SQLITE_DATABASE):
             self.logger.warning("can't find SQLite Markov chain database `{}` - try running `python3 src/plugins/generate_text/generate_chains_db.py`".format(SQLITE_DATABASE))
-            self.connection = None
-            return
-
-        self.connection = sqlite3.connect(SQLITE_DATABASE)
+            return None, None
+
+        connection = sqlite3.connect(SQLITE_DATABASE, check_same_thread=False) # might be opened on the chain loader thread, but is only used by the main thread afterwards
+        if connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'vocab'").fetchone() is None:
+            self.logger.warning("SQLite Markov chain database `{}` is out of date - try running `python3 src/plugins/generate_text/generate_chains_db.py --migrate`".format(SQLITE_DATABASE))
+            connection.close()
+            return None, None
+
+        connection.execute(SUFFIX_INDEX_SCHEMA)
+        connection.execute(UPDATED_KEYS_SCHEMA)
+        connection.commit()
+
+        start_time = time.monotonic()
+        try: model = MappedMarkov(MODEL_FILE, LOOKBEHIND_LENGTH) if path.exists(MODEL_FILE) else None # the model file is shared between processes, so use it whenever it's available
+        except ValueError as e:
+            self.logger.warning("can't use Markov chain model file `{}` ({}) - try running `python3 src/plugins/generate_text/generate_chains_db.py --export-only`".format(MODEL_FILE, e))
+            model = None
+        if model is not None:
+            updated_key_count = model.load_updated_keys(connection)
+            self.logger.info("mapped Markov chain with {} keys, plus {} keys trained since it was exported, in {:.2f} seconds".format(len(model.keys), updated_key_count, time.monotonic() - start_time))
+        elif not LOW_MEMORY_MODE:
+            model = CompiledMarkov.from_database(connection, LOOKBEHIND_LENGTH)
+            self.logger.info("loaded Markov chain with {} keys and {} tokens in {:.2f} seconds".format(len(model.chain), len(model.tokens), time.monotonic() - start_time))
+        return connection, model
+
+    def run_chain_loader(self):
+        try: self.loaded_chain = self.open_chain()
+        except Exception:
+            self.logger.exception("reloading the Markov chain failed, keeping the current one")
+            self.loaded_chain = None
+
+    def swap_chain(self, connection, model):
+        """Start using the chain database connection `connection` (`None` if there's no usable database) and model `model`, discarding sentences generated from the previous ones."""
+        self.connection, self.model, self.pool_connection = connection, model, None
+        if self.sentence_pool is not None: self.sentence_pool.invalidate()
+        elif connection is not None: self.sentence_pool = SentencePool(self.generate_pooled_continuation, pool_size=PREGENERATED_SENTENCES_PER_SEED, seed_count=PREGENERATED_SEED_COUNT, max_tracked_seeds=PREGENERATION_TRACKED_SEEDS, logger=self.logger)
+
+    def on_step(self):
+        # rebuilt chains are loaded on a separate thread, since building a model from the database can take several seconds, and swapped in here once they're ready
+        if self.chain_loader is not None:
+            if self.chain_loader.is_alive(): return False # hold off on writing training until the new chain is loaded, so it isn't written to a database that's been replaced
+            self.chain_loader = None
+            if self.loaded_chain is not None: self.swap_chain(*self.loaded_chain)
+            self.loaded_chain = None
+
+        # check for a rebuilt chain periodically, and always right before writing training to the database
+        flush_due = time.monotonic() - self.last_training_flush_time >= TRAINING_FLUSH_INTERVAL
+        if flush_due or time.monotonic() - self.last_reload_check_time >= RELOAD_CHECK_INTERVAL:
+            self.last_reload_check_time = time.monotonic()
+            chain_files = get_chain_files()
+            if chain_files != self.chain_files:
+                self.logger.info("Markov chain database or model file was rebuilt, reloading")
+                self.chain_files = chain_files
+                self.chain_loader = threading.Thread(target=self.run_chain_loader, daemon=True)
+                self.chain_loader.start()
+                return False
+        if self.connection is None or not flush_due: return False
+        self.last_training_flush_time = time.monotonic()
+        if not self.pending_training.chain: return False
+
+        # write the pending training to the database, then bring the in-memory model up to date for the affected keys
+        start_time = time.monotonic()
+        updated_successors = train_db(self.connection, self.pending_training)
+        if self.model is not None:
+            for key, (next_words, weights) in updated_successors.items():
+                self.model.update_key(key, next_words, weights)
+        self.logger.info("trained {} Markov chain keys on new messages in {:.2f} seconds".format(len(updated_successors), time.monotonic() - start_time))
+        self.pending_training = Markov(LOOKBEHIND_LENGTH)
+        self.sentence_pool.invalidate()
+        return False
 
     def on_message(self, m):
         if not m.is_user_text_message: return False
+        if self.connection is not None: self.pending_training.train(Markov.tokenize_text(self.sendable_text_to_text(m.text)))
         match = re.search(r"\bbotty(?:[\s,\.]+(.*)|$)", m.text, re.IGNORECASE)
         if not match: return False
         query = self.sendable_text_to_text(match.group(1) or "")
 
         # fail gracefully if user has not configured this plugin yet
         if self.connection is None:
-            self.respond_raw("oops, I can't find the Markov chain database `chains.db` :( try running `python3 src/plugins/generate_text/generate_chains_db.py`")
+            self.respond_raw("oops, I can't find an up-to-date Markov chain database `chains.db` :( try running `python3 src/plugins/generate_text/generate_chains_db.py`")
             return True
 
-        # use markov chain to complete given phrase
+        # use markov chain to complete given phrase, or generate a new one if the chain has never seen the phrase's last word
         try: self.respond_raw(self.generate_sentence_starting_with(query))
         except KeyError: self.respond_raw(self.generate_sentence_starting_with())
         return True
@@ -79,4 +229,16 @@ class GenerateTextPlugin(BasePlugin):
     def generate_sentence_starting_with(self, first_part = ""):
         first_part = first_part.strip()
         words = Markov.tokenize_text(first_part) if first_part != "" else []
-        return Markov.format_words(words + speak_db(self.connection, LOOKBEHIND_LENGTH, words))
+        continuation = self.sentence_pool.pop(tuple(words[-LOOKBEHIND_LENGTH:])) # only the last few words affect the continuation
+        if continuation is None:
+            if self.model is None: continuation = speak_db(self.connection, LOOKBEHIND_LENGTH, words)
+            else: continuation = self.model.speak(words)
+        return Markov.format_words(words + continuation)
+
+    def generate_pooled_continuation(self, seed):
+        """Returns a continuation of `seed` for the sentence pool. This is called from the sentence pool's thread."""
+        if self.connection is None: raise KeyError(seed) # the chain was replaced by one that can't be used
+        model, connection = self.model, self.pool_connection # either of these might be replaced by the main thread at any time
+        if model is not None: return model.speak(seed)
+        if connection is None: connection = self.pool_connection = sqlite3.connect(SQLITE_DATABASE)
+        return speak_db(connection, LOOKBEHIND_LENGTH, seed)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for Markov chain text generation, reporting generated tokens per second for each way of sampling the chain in `chains.db`.
+
+The linear scan samplers are the implementations used before alias tables were added, and are kept here as a baseline.
+
+Usage: `python3 src/plugins/generate_text/benchmark_generation.py [CHAINS_DATABASE] [SECONDS_PER_BENCHMARK]`. If there's a model file next to the database (with the same name, but ending in `.bin`), it's benchmarked too.
+"""
+
+import os, sys, time, random
+import sqlite3
+
+from markov import Markov, CompiledMarkov, MappedMarkov, speak_db
+
+def speak_linear(markov, initial_state = ()):
+    current_key = tuple(initial_state)[-markov.lookbehind_length:]
+    token_list = []
+    while True:
+        random_choice = random.randrange(0, markov.counts[current_key])
+        for new_token, occurrences in markov.chain[current_key].items():
+            random_choice -= occurrences
+            if random_choice < 0: break
+        if new_token == None: break
+        token_list.append(new_token)
+        current_key = (current_key + (new_token,))[-markov.lookbehind_length:]
+    return token_list
+
+def speak_db_linear(db_connection):
+    key1, key2, token_list = 0, 0, []
+    while True:
+        count, = db_connection.execute("SELECT count FROM counts WHERE key1 = ? AND key2 = ?", (key1, key2)).fetchone()
+        random_choice = random.randrange(0, count)
+        for next_id, occurrences in db_connection.execute("SELECT next_id, occurrences FROM chain WHERE key1 = ? AND key2 = ?", (key1, key2)):
+            random_choice -= occurrences
+            if random_choice < 0: break
+        if next_id == 0: break
+        token_list.append(db_connection.execute("SELECT token FROM vocab WHERE id = ?", (next_id,)).fetchone()[0])
+        key1, key2 = key2, next_id
+    return token_list
+
+def benchmark(name, generate, duration):
+    random.seed(0)
+    token_count, message_count, start_time = 0, 0, time.perf_counter()
+    while time.perf_counter() - start_time < duration:
+        token_count += len(generate()) + 1 # include the end of message token
+        message_count += 1
+    elapsed_time = time.perf_counter() - start_time
+    print("{:<36} {:>12.0f} tokens/s {:>10.0f} messages/s".format(name, token_count / elapsed_time, message_count / elapsed_time))
+
+if __name__ == "__main__":
+    database = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.realpath(__file__)), "chains.db")
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    connection = sqlite3.connect(database)
+
+    # load the chain into a regular Markov model
+    markov = Markov(2)
+    for key1, key2, next_word, occurrences in connection.execute("SELECT key1_vocab.token, key2_vocab.token, next_vocab.token, occurrences FROM chain LEFT JOIN vocab key1_vocab ON key1_vocab.id = key1 LEFT JOIN vocab key2_vocab ON key2_vocab.id = key2 LEFT JOIN vocab next_vocab ON next_vocab.id = next_id"):
+        key = tuple(token for token in (key1, key2) if token is not None)
+        markov.chain[key][next_word] += occurrences
+        markov.counts[key] += occurrences
+    compiled_markov = CompiledMarkov.from_database(connection, 2)
+    print("{} keys, largest fan-out {} successors".format(len(markov.chain), max(len(next_mapping) for next_mapping in markov.chain.values())))
+
+    benchmark("Markov.speak, linear scan", lambda: speak_linear(markov), duration)
+    benchmark("Markov.speak, alias tables", lambda: markov.speak(), duration)
+    benchmark("CompiledMarkov.speak, alias tables", lambda: compiled_markov.speak(), duration)
+    model_file = os.path.splitext(database)[0] + ".bin"
+    if os.path.exists(model_file):
+        mapped_markov = MappedMarkov(model_file, 2)
+        benchmark("MappedMarkov.speak, alias tables", lambda: mapped_markov.speak(), duration)
+    benchmark("speak_db, linear scan", lambda: speak_db_linear(connection), duration)
+    benchmark("speak_db, alias tables", lambda: speak_db(connection, 2), duration)
@@ -1,12 +1,20 @@
 #!/usr/bin/env python3
 
-import os, re, json
+import os, re, sys, json, time
+import argparse
+import resource
 import sqlite3
+import multiprocessing
+from collections import Counter
+from itertools import groupby
 
-from markov import Markov
+from markov import Markov, build_alias_table, write_model_file, SUFFIX_INDEX_SCHEMA, UPDATED_KEYS_SCHEMA
 
 SQLITE_DATABASE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "chains.db")
+MODEL_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "chains.bin")
 CHAT_HISTORY_DIRECTORY = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "..", "@history")
+LOOKBEHIND_LENGTH = 2 # the database schema has a column for each token ID in a key, so changing this also requires changing the schema
+TRANSITION_SIZE_ESTIMATE = 150 # approximate number of bytes used by each entry in a transition counter, used to apply the memory budget
 
 def get_metadata():
     with open(os.path.join(CHAT_HISTORY_DIRECTORY, "metadata", "users.json"), "r") as f:
@@ -62,30 +70,172 @@ def get_history_files():
         return result
     return {}
 
-connection = sqlite3.connect(SQLITE_DATABASE)
-connection.execute("DROP TABLE IF EXISTS counts")
-connection.execute("DROP TABLE IF EXISTS chain")
-connection.execute("CREATE TABLE counts (key TEXT PRIMARY KEY, count INTEGER)")
-connection.execute("CREATE TABLE chain (key TEXT, next_word TEXT, occurrences INTEGER)")
-connection.execute("CREATE INDEX chain_key_index ON chain (key)")
+def count_transitions(history_file):
+    """
+    Returns the chain transitions in the history file `history_file`, as a tuple containing a list of the tokens it uses and a `Counter` mapping transitions to the number of times they occur.
 
-markov = Markov(2) # Markov model with 2 word look-behind
-for channel_id, history_file in get_history_files().items():
+    Tokens are represented by their index in the token list plus one, since 0 represents the start or end of a message. Transitions are packed into single integers, 32 bits per token ID: the key (left-padded with 0 to `LOOKBEHIND_LENGTH` token IDs), followed by the next token ID.
+    """
+    tokens, token_ids, transitions = [], {}, Counter()
+    key_mask = (1 << (32 * LOOKBEHIND_LENGTH)) - 1
     with open(history_file, "r") as f:
         for entry in f:
             text = get_message_text(json.loads(entry))
-            if text is not None:
-                markov.train(Markov.tokenize_text(text))
-
-connection.executemany(
-    "INSERT INTO counts VALUES (?, ?)",
-    (("\n".join(key), occurrences) for key, occurrences in markov.counts.items())
-)
-connection.executemany(
-    "INSERT INTO chain VALUES (?, ?, ?)",
-    (("\n".join(key), next_word, occurrences) for key, next_mapping in markov.chain.items()
-                                   for next_word, occurrences in next_mapping.items())
-)
-
-connection.commit()
-connection.close()
+            if text is None: continue
+            key = 0
+            for token in Markov.tokenize_text(text):
+                token_id = token_ids.get(token)
+                if token_id is None:
+                    tokens.append(token)
+                    token_id = token_ids[token] = len(tokens)
+                transitions[(key << 32) | token_id] += 1
+                key = ((key << 32) | token_id) & key_mask
+            transitions[key << 32] += 1 # end of message
+    return tokens, transitions
+
+def read_legacy_chain(connection, chunk_size = 1000000):
+    """Yields the transitions in the `chain` table of a chain database generated by an older version of this script (which stored keys as newline-separated tokens), in chunks of `chunk_size` transitions of the same form that `count_transitions` returns."""
+    tokens, token_ids, transitions = [], {}, Counter()
+    def get_token_id(token):
+        if token is None: return 0
+        token_id = token_ids.get(token)
+        if token_id is None:
+            tokens.append(token)
+            token_id = token_ids[token] = len(tokens)
+        return token_id
+    for key_text, next_word, occurrences in connection.execute("SELECT key, next_word, occurrences FROM chain"):
+        key_ids = [get_token_id(token) for token in key_text.split("\n")] if key_text != "" else []
+        transition = 0
+        for token_id in [0] * (LOOKBEHIND_LENGTH - len(key_ids)) + key_ids + [get_token_id(next_word)]:
+            transition = (transition << 32) | token_id
+        transitions[transition] += occurrences
+        if len(transitions) >= chunk_size:
+            yield tokens, transitions
+            tokens, token_ids, transitions = [], {}, Counter()
+    yield tokens, transitions
+
+def spill_transitions(connection, transitions):
+    """Add the counts in `transitions` to the temporary `spill` table, which accumulates counts that didn't fit in the memory budget."""
+    connection.executemany(
+        "INSERT INTO spill VALUES (?, ?) ON CONFLICT (transition) DO UPDATE SET occurrences = occurrences + excluded.occurrences",
+        (("{:0{}x}".format(transition, 8 * (LOOKBEHIND_LENGTH + 1)), occurrences) for transition, occurrences in transitions.items()) # transitions don't fit in SQLite integers, so they're stored as fixed-width hexadecimal text, which sorts in the same order
+    )
+    transitions.clear()
+
+def create_chain_tables(connection):
+    for table in ["vocab", "counts", "chain", "alias", "updated_keys"]: connection.execute("DROP TABLE IF EXISTS {}".format(table))
+    connection.execute("CREATE TABLE vocab (id INTEGER PRIMARY KEY, token TEXT UNIQUE)") # token ID 0 isn't stored, since it represents the start or end of a message
+    connection.execute("CREATE TABLE counts (key1 INTEGER, key2 INTEGER, count INTEGER, successors INTEGER, PRIMARY KEY (key1, key2)) WITHOUT ROWID") # keys are left-padded with token ID 0
+    connection.execute("CREATE TABLE chain (key1 INTEGER, key2 INTEGER, next_id INTEGER, occurrences INTEGER, PRIMARY KEY (key1, key2, next_id)) WITHOUT ROWID")
+    connection.execute("CREATE TABLE alias (key1 INTEGER, key2 INTEGER, position INTEGER, next_id INTEGER, threshold INTEGER, alias_id INTEGER, PRIMARY KEY (key1, key2, position)) WITHOUT ROWID") # Walker alias table for each key, see `markov.build_alias_table`
+    connection.execute(UPDATED_KEYS_SCHEMA)
+
+def write_chain(connection, tokens, sorted_transitions):
+    """Write the chain tables, given the token list `tokens` and an iterable of `(transition, occurrences)` tuples sorted by transition. Returns the number of keys and the number of transitions written."""
+    connection.executemany("INSERT INTO vocab VALUES (?, ?)", enumerate(tokens, 1))
+
+    def write_rows(counts_rows, chain_rows, alias_rows):
+        connection.executemany("INSERT INTO counts VALUES (?, ?, ?, ?)", counts_rows)
+        connection.executemany("INSERT INTO chain VALUES (?, ?, ?, ?)", chain_rows)
+        connection.executemany("INSERT INTO alias VALUES (?, ?, ?, ?, ?, ?)", alias_rows)
+
+    # write rows in batches, since the transitions might not fit in memory all at once
+    key_count, transition_count = 0, 0
+    counts_rows, chain_rows, alias_rows = [], [], []
+    for key, key_transitions in groupby(sorted_transitions, lambda entry: entry[0] >> 32):
+        key1, key2 = key >> 32, key & 0xFFFFFFFF
+        next_ids, weights = zip(*((transition & 0xFFFFFFFF, occurrences) for transition, occurrences in key_transitions))
+        thresholds, aliases = build_alias_table(weights)
+        counts_rows.append((key1, key2, sum(weights), len(next_ids)))
+        chain_rows.extend((key1, key2, next_id, occurrences) for next_id, occurrences in zip(next_ids, weights))
+        alias_rows.extend((key1, key2, position, next_id, threshold, next_ids[alias]) for position, (next_id, threshold, alias) in enumerate(zip(next_ids, thresholds, aliases)))
+        key_count += 1
+        transition_count += len(next_ids)
+        if len(chain_rows) >= 100000:
+            write_rows(counts_rows, chain_rows, alias_rows)
+            counts_rows, chain_rows, alias_rows = [], [], []
+    write_rows(counts_rows, chain_rows, alias_rows)
+    return key_count, transition_count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the Markov chain database used by the text generation plugin from the chat history in `@history`.")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="Number of worker processes that read history files (defaults to the number of CPUs).")
+    parser.add_argument("-m", "--memory-budget", type=int, default=1024, help="Approximate number of megabytes of transition counts to keep in memory before spilling them to disk.")
+    parser.add_argument("--migrate", action="store_true", help="Rather than building the chain from the chat history, convert an existing chain database generated by an older version of this script to the current format.")
+    parser.add_argument("--export-only", action="store_true", help="Rather than building the chain, only export the existing chain database to the memory-mapped model file, which includes everything trained since it was last exported.")
+    args = parser.parse_args()
+    start_time = time.monotonic()
+    max_transitions = max(1, args.memory_budget * 1024 * 1024 // TRANSITION_SIZE_ESTIMATE)
+
+    if args.export_only:
+        connection = sqlite3.connect(SQLITE_DATABASE)
+        if connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'vocab'").fetchone() is None:
+            parser.error("can't find an up-to-date chain database to export at `{}`".format(SQLITE_DATABASE))
+        connection.execute(SUFFIX_INDEX_SCHEMA)
+        connection.execute(UPDATED_KEYS_SCHEMA)
+        key_count, transition_count = write_model_file(connection, MODEL_FILE)
+        print("Exported {} keys and {} transitions to `{}` in {:.1f} seconds".format(key_count, transition_count, MODEL_FILE, time.monotonic() - start_time))
+        sys.exit(0)
+
+    # build the new database in a temporary file, and only rename it over the existing one once it's complete, so a running bot can keep using the existing one in the meantime
+    temporary_database = SQLITE_DATABASE + ".tmp"
+    for leftover_path in [temporary_database, temporary_database + "-journal"]: # left behind by an interrupted build
+        if os.path.exists(leftover_path): os.remove(leftover_path)
+    connection = sqlite3.connect(temporary_database)
+    connection.execute("CREATE TEMP TABLE spill (transition TEXT PRIMARY KEY, occurrences INTEGER) WITHOUT ROWID")
+    if args.migrate:
+        if not os.path.exists(SQLITE_DATABASE):
+            parser.error("can't find an existing chain database to migrate at `{}`".format(SQLITE_DATABASE))
+        legacy_connection = sqlite3.connect(SQLITE_DATABASE)
+        if legacy_connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'chain'").fetchone() is None:
+            parser.error("can't find an existing chain database to migrate at `{}`".format(SQLITE_DATABASE))
+        if legacy_connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'vocab'").fetchone() is not None:
+            parser.error("chain database `{}` is already in the current format".format(SQLITE_DATABASE))
+        pool, chunks = None, read_legacy_chain(legacy_connection, max_transitions)
+    else:
+        pool = multiprocessing.Pool(args.workers)
+        chunks = pool.imap_unordered(count_transitions, get_history_files().values())
+
+    # count transitions in each history file in parallel, then merge them using a single token numbering
+    tokens, token_ids, transitions, spilled = [], {}, Counter(), False
+    for chunk_tokens, chunk_transitions in chunks:
+        token_id_mapping = [0] # mapping from token IDs in the chunk to token IDs in the merged chain
+        for token in chunk_tokens:
+            token_id = token_ids.get(token)
+            if token_id is None:
+                tokens.append(token)
+                token_id = token_ids[token] = len(tokens)
+            token_id_mapping.append(token_id)
+        for transition, occurrences in chunk_transitions.items():
+            merged_transition = 0
+            for i in reversed(range(LOOKBEHIND_LENGTH + 1)):
+                merged_transition = (merged_transition << 32) | token_id_mapping[(transition >> (32 * i)) & 0xFFFFFFFF]
+            transitions[merged_transition] += occurrences
+        if len(transitions) > max_transitions:
+            spill_transitions(connection, transitions)
+            spilled = True
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    with connection: # commits the transaction if successful, rolls it back otherwise
+        create_chain_tables(connection)
+        if spilled:
+            spill_transitions(connection, transitions)
+            sorted_transitions = ((int(transition, 16), occurrences) for transition, occurrences in connection.execute("SELECT transition, occurrences FROM spill ORDER BY transition"))
+        else:
+            sorted_transitions = sorted(transitions.items())
+        key_count, transition_count = write_chain(connection, tokens, sorted_transitions)
+        connection.execute(SUFFIX_INDEX_SCHEMA) # created after writing the chain, since that's faster than updating it on every insert
+    connection.close()
+    os.replace(temporary_database, SQLITE_DATABASE) # atomic, so a running bot sees either the old database or the new one, and reloads when it notices the new one
+
+    # export from the database in its final location, since a running bot might have trained it since the rename
+    connection = sqlite3.connect(SQLITE_DATABASE)
+    write_model_file(connection, MODEL_FILE)
+    connection.close()
+
+    main_peak_rss, worker_peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss # in kilobytes on Linux
+    print("{} chain with {} tokens, {} keys, and {} transitions in {:.1f} seconds{}".format("Migrated" if args.migrate else "Built", len(tokens), key_count, transition_count, time.monotonic() - start_time, " (spilled to disk)" if spilled else ""))
+    if args.migrate: print("Peak RSS: {:.1f} MiB".format(main_peak_rss / 1024))
+    else: print("Peak RSS: {:.1f} MiB in main process, {:.1f} MiB in largest worker process".format(main_peak_rss / 1024, worker_peak_rss / 1024))
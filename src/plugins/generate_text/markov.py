@@ -1,6 +1,104 @@
-import re, random
+import os, re, mmap, struct, random, bisect
+from array import array
+from itertools import groupby
 from collections import defaultdict
 
+def build_alias_table(weights):
+    """
+    Returns a Walker alias table for the positive integer weights `weights`, as a tuple of a threshold list and an alias list, both indexed by position.
+
+    To sample a position with probability proportional to its weight, choose a position `i` uniformly at random and an integer `r` uniformly at random from `[0, sum(weights))`, then take `i` if `r < thresholds[i]` and `aliases[i]` otherwise. Everything is done with integers, so the sampled distribution is exact.
+    """
+    count, total = len(weights), sum(weights)
+    scaled_weights = [weight * count for weight in weights]
+    thresholds, aliases = [total] * count, list(range(count))
+    small = [i for i, weight in enumerate(scaled_weights) if weight < total]
+    large = [i for i, weight in enumerate(scaled_weights) if weight >= total]
+    while small and large:
+        small_index, large_index = small.pop(), large.pop()
+        thresholds[small_index], aliases[small_index] = scaled_weights[small_index], large_index # fill the rest of the small position's column with the large position
+        scaled_weights[large_index] -= total - scaled_weights[small_index]
+        (small if scaled_weights[large_index] < total else large).append(large_index)
+    return thresholds, aliases
+
+def speak_db(db_connection, lookbehind_length, initial_state = ()):
+    assert lookbehind_length == 2, "Chain databases only support a lookbehind length of 2 rather than {}".format(lookbehind_length)
+    initial_state = tuple(initial_state)[-lookbehind_length:]
+    key_ids = []
+    for token in initial_state:
+        row = db_connection.execute("SELECT id FROM vocab WHERE token = ?", (token,)).fetchone()
+        key_ids.append(None if row is None else row[0])
+    key1, key2 = ([0, 0] + key_ids)[-2:] # keys are left-padded with the end of message token ID
+
+    # if the key isn't in the chain, back off to a key that ends with the same token, chosen with probability proportional to its number of occurrences
+    if None in key_ids or db_connection.execute("SELECT 1 FROM counts WHERE key1 = ? AND key2 = ?", (key1, key2)).fetchone() is None:
+        candidates = [] if key2 is None else db_connection.execute("SELECT key1, count FROM counts WHERE key2 = ?", (key2,)).fetchall()
+        if not candidates: raise KeyError("Key not in chain: {}".format(initial_state))
+        random_choice = random.randrange(sum(count for _, count in candidates))
+        for key1, count in candidates:
+            random_choice -= count
+            if random_choice < 0: break
+
+    # generate a message based on probability chains
+    token_list = []
+    while True:
+        row = db_connection.execute("SELECT count, successors FROM counts WHERE key1 = ? AND key2 = ?", (key1, key2)).fetchone()
+        if row is None: raise KeyError("Key not in chain: {}".format(initial_state + tuple(token_list)))
+        count, successors = row
+
+        # pick a random token weighted on the number of times it has occurred previously, using the key's alias table
+        position, random_choice = divmod(random.randrange(successors * count), count)
+        row = db_connection.execute(
+            "SELECT alias.threshold, alias.next_id, next_vocab.token, alias.alias_id, alias_vocab.token FROM alias LEFT JOIN vocab next_vocab ON next_vocab.id = alias.next_id LEFT JOIN vocab alias_vocab ON alias_vocab.id = alias.alias_id WHERE key1 = ? AND key2 = ? AND position = ?",
+            (key1, key2, position)
+        ).fetchone()
+        if row is None: raise ValueError("Bad choice for key: {}".format(initial_state + tuple(token_list))) # this should never happen but would otherwise be hard to detect if it did
+        next_id, new_token = row[1:3] if random_choice < row[0] else row[3:5]
+
+        # add the token to the message
+        if next_id == 0: break
+        token_list.append(new_token)
+        key1, key2 = key2, next_id
+    return token_list
+
+def train_db(db_connection, markov):
+    """
+    Add the chain counts in the Markov model `markov` to the chain database `db_connection` in a single transaction, and rebuild the alias tables of the affected keys.
+
+    Returns a mapping from affected keys to `(next words, occurrences)` tuples containing their updated successors.
+    """
+    assert markov.lookbehind_length == 2, "Chain databases only support a lookbehind length of 2 rather than {}".format(markov.lookbehind_length)
+    updated_successors = {}
+    with db_connection: # commits the transaction if successful, rolls it back otherwise
+        # add new tokens to the vocabulary
+        tokens = {token for key, next_mapping in markov.chain.items() for token in key + tuple(next_mapping) if token is not None}
+        db_connection.executemany("INSERT OR IGNORE INTO vocab (token) VALUES (?)", ((token,) for token in tokens))
+        token_ids = {None: 0}
+        for token in tokens: token_ids[token] = db_connection.execute("SELECT id FROM vocab WHERE token = ?", (token,)).fetchone()[0]
+        def get_key_ids(key): return ((0, 0) + tuple(token_ids[token] for token in key))[-2:]
+
+        # upsert the new counts by incrementing existing rows, then inserting the rows that don't exist yet
+        chain_rows = [get_key_ids(key) + (token_ids[next_word], occurrences) for key, next_mapping in markov.chain.items() for next_word, occurrences in next_mapping.items()]
+        counts_rows = [get_key_ids(key) + (occurrences,) for key, occurrences in markov.counts.items()]
+        db_connection.executemany("UPDATE chain SET occurrences = occurrences + ?4 WHERE key1 = ?1 AND key2 = ?2 AND next_id = ?3", chain_rows)
+        db_connection.executemany("INSERT OR IGNORE INTO chain VALUES (?1, ?2, ?3, ?4)", chain_rows)
+        db_connection.executemany("UPDATE counts SET count = count + ?3 WHERE key1 = ?1 AND key2 = ?2", counts_rows)
+        db_connection.executemany("INSERT OR IGNORE INTO counts VALUES (?1, ?2, ?3, 0)", counts_rows)
+
+        # rebuild the alias tables of the affected keys
+        alias_rows = []
+        for key in markov.chain:
+            key1, key2 = get_key_ids(key)
+            next_ids, next_words, weights = zip(*db_connection.execute("SELECT chain.next_id, vocab.token, chain.occurrences FROM chain LEFT JOIN vocab ON vocab.id = chain.next_id WHERE key1 = ? AND key2 = ?", (key1, key2)))
+            thresholds, aliases = build_alias_table(weights)
+            alias_rows.extend((key1, key2, position, next_id, threshold, next_ids[alias]) for position, (next_id, threshold, alias) in enumerate(zip(next_ids, thresholds, aliases)))
+            updated_successors[key] = (next_words, weights)
+        db_connection.executemany("UPDATE counts SET successors = ? WHERE key1 = ? AND key2 = ?", [(len(next_words),) + get_key_ids(key) for key, (next_words, _) in updated_successors.items()])
+        db_connection.executemany("DELETE FROM alias WHERE key1 = ? AND key2 = ?", [get_key_ids(key) for key in markov.chain])
+        db_connection.executemany("INSERT INTO alias VALUES (?, ?, ?, ?, ?, ?)", alias_rows)
+        db_connection.executemany("INSERT OR IGNORE INTO updated_keys VALUES (?, ?)", [get_key_ids(key) for key in markov.chain])
+    return updated_successors
+
 class Markov:
     PUNCTUATION = r"[`~@#$%_\\'+\-/]" # punctuation that is a part of text
     STANDALONE = r"(?:[!.,;()^&\[\]{}|*=<>?]|[dDpP][:8]|:\S)" # standalone characters or emoticons that wouldn't otherwise be captured
@@ -12,6 +110,7 @@ class Markov:
 
         self.chain = defaultdict(lambda: defaultdict(int))
         self.counts = defaultdict(int)
+        self.alias_tables = {} # mapping from keys to (token list, thresholds, alias tokens) tuples, built when first needed and discarded when the key is trained
 
     @staticmethod
     def tokenize_text(text):
@@ -31,12 +130,14 @@ class Markov:
         for i, token in enumerate(message): # loop through every index except the highest one
             self.chain[current_key][token] += importance # update the Markov model with current token
             self.counts[current_key] += importance
-            
+            self.alias_tables.pop(current_key, None)
+
             if i < self.lookbehind_length: current_key += (token,) # add current token to key if just starting
             else: current_key = current_key[1:] + (token,) # shift token onto key if inside message
 
         self.chain[current_key][None] += importance # update the Markov model with end of message
         self.counts[current_key] += importance
+        self.alias_tables.pop(current_key, None)
 
     def speak(self, initial_state = ()):
         if len(self.counts) == 0: raise ValueError("Markov model is not trained yet")
@@ -47,15 +148,14 @@ class Markov:
         while True:
             # pick a random token weighted on the number of times it has occurred previously
             if current_key not in self.chain: raise KeyError("Key not in chain: {}".format(current_key))
-            choices = self.chain[current_key]
-            random_choice = random.randrange(0, self.counts[current_key])
-            for current_choice, occurrences in choices.items():
-                random_choice -= occurrences
-                if random_choice < 0:
-                    new_token = current_choice
-                    break
-            else: # couldn't find the choice somehow
-                raise ValueError("Bad choice for key: {}".format(current_key)) # this should never happen but would otherwise be hard to detect if it did
+            alias_table = self.alias_tables.get(current_key)
+            if alias_table is None:
+                tokens, weights = zip(*self.chain[current_key].items())
+                thresholds, aliases = build_alias_table(weights)
+                alias_table = self.alias_tables[current_key] = (tokens, thresholds, [tokens[i] for i in aliases])
+            tokens, thresholds, alias_tokens = alias_table
+            position, random_choice = divmod(random.randrange(len(tokens) * self.counts[current_key]), self.counts[current_key])
+            new_token = tokens[position] if random_choice < thresholds[position] else alias_tokens[position]
 
             # add the token to the message
             if new_token == None: break
@@ -64,3 +164,251 @@ class Markov:
             if len(current_key) < self.lookbehind_length: current_key += (new_token,) # add current token to key if just starting
             else: current_key = current_key[1:] + (new_token,) # shift token onto key if inside message
         return token_list
+
+class CompiledMarkov:
+    """
+    Markov chain compiled into a compact in-memory form for fast text generation, loaded from a chain database generated by `generate_chains_db.py`.
+
+    Tokens are interned as integer IDs, with ID 0 representing the end of a message. Keys (tuples of token IDs) are packed into single integers, 32 bits per token ID. Each key maps to its Walker alias table (see `build_alias_table`), stored as arrays of successor token IDs, thresholds, and alias token IDs, so choosing a successor takes constant time regardless of how many successors the key has.
+
+    Keys are also indexed by their last token ID, so that generating text from a key that isn't in the chain can back off to a known key with the same last token, rather than failing. The index is built by `build_suffix_index`, and doesn't include keys added afterwards.
+    """
+    def __init__(self, lookbehind_length = 2):
+        self.lookbehind_length = lookbehind_length
+        self.tokens = [None] # mapping from token IDs to tokens
+        self.token_ids = {} # mapping from tokens to token IDs
+        self.chain = {} # mapping from packed keys to (successor token ID array, threshold array, alias token ID array, total occurrences) tuples
+        self.suffix_index = {} # mapping from token IDs to (packed key array, cumulative occurrences array) tuples for keys ending with that token ID
+
+    @staticmethod
+    def from_database(connection, lookbehind_length = 2):
+        """Returns a `CompiledMarkov` instance containing the chain in the SQLite database connection `connection`, using the alias tables stored by `generate_chains_db.py`."""
+        assert lookbehind_length == 2, "Chain databases only support a lookbehind length of 2 rather than {}".format(lookbehind_length)
+        model = CompiledMarkov(lookbehind_length)
+        token_id_mapping = {0: 0} # mapping from token IDs in the database to token IDs in the model, which are usually the same
+        for token_id, token in connection.execute("SELECT id, token FROM vocab ORDER BY id"): token_id_mapping[token_id] = model.intern(token)
+        rows = connection.execute("SELECT key1, key2, counts.count, alias.next_id, alias.threshold, alias.alias_id FROM alias JOIN counts USING (key1, key2) ORDER BY key1, key2, alias.position")
+        for (key1, key2, total), key_rows in groupby(rows, lambda row: row[:3]):
+            successors, thresholds, alias_successors = array("I"), array("Q"), array("I")
+            for _, _, _, next_id, threshold, alias_id in key_rows:
+                successors.append(token_id_mapping[next_id])
+                thresholds.append(threshold)
+                alias_successors.append(token_id_mapping[alias_id])
+            model.chain[model.pack_key([token_id_mapping[key1], token_id_mapping[key2]])] = (successors, thresholds, alias_successors, total) # padding with 0 doesn't change the packed key
+        model.build_suffix_index()
+        return model
+
+    def build_suffix_index(self):
+        suffix_keys = defaultdict(list)
+        for packed_key, entry in self.chain.items():
+            if packed_key != 0: suffix_keys[packed_key & 0xFFFFFFFF].append((packed_key, entry[3])) # the empty key doesn't end with any token
+        self.suffix_index = {}
+        for token_id, keys in suffix_keys.items():
+            packed_keys, cumulative_occurrences, total = array("Q"), array("Q"), 0
+            for packed_key, occurrences in keys:
+                total += occurrences
+                packed_keys.append(packed_key)
+                cumulative_occurrences.append(total)
+            self.suffix_index[token_id] = (packed_keys, cumulative_occurrences)
+
+    def update_key(self, key, next_words, weights):
+        """Replace the successors of `key` (a tuple of tokens) with the tokens in `next_words`, which occur `weights` times respectively."""
+        thresholds, aliases = build_alias_table(weights)
+        successors = array("I", (self.intern(next_word) for next_word in next_words))
+        alias_successors = array("I", (successors[alias] for alias in aliases))
+        self.chain[self.pack_key([self.intern(token) for token in key])] = (successors, array("Q", thresholds), alias_successors, sum(weights))
+
+    def intern(self, token):
+        """Returns the token ID of `token`, assigning it a new one if it doesn't have one yet."""
+        if token is None: return 0
+        token_id = self.token_ids.get(token)
+        if token_id is None:
+            token_id = self.token_ids[token] = len(self.tokens)
+            self.tokens.append(token)
+        return token_id
+
+    def pack_key(self, key_ids):
+        packed_key = 0
+        for token_id in key_ids: packed_key = (packed_key << 32) | token_id
+        return packed_key
+
+    def shift_key(self, packed_key, key_length, token_id):
+        """Returns the packed key and key length resulting from appending `token_id` to the key `packed_key` of length `key_length`, dropping the first token ID if the key is already at the lookbehind length."""
+        if key_length < self.lookbehind_length: return (packed_key << 32) | token_id, key_length + 1 # add current token to key if just starting
+        return ((packed_key << 32) | token_id) & ((1 << (32 * self.lookbehind_length)) - 1), key_length # shift token onto key if inside message
+
+    def get_token_id(self, token): return self.token_ids.get(token)
+    def get_token(self, token_id): return self.tokens[token_id]
+    def get_entry(self, packed_key): return self.chain.get(packed_key)
+    def get_suffix_keys(self, token_id): return self.suffix_index.get(token_id)
+
+    def speak(self, initial_state = ()):
+        initial_state = tuple(initial_state)[-self.lookbehind_length:]
+        key_ids = [self.get_token_id(token) for token in initial_state]
+        if None not in key_ids and self.get_entry(self.pack_key(key_ids)) is not None:
+            current_key, key_length = self.pack_key(key_ids), len(key_ids)
+        else: # back off to a key that ends with the same token, chosen with probability proportional to its number of occurrences
+            suffix_keys = None if not key_ids or key_ids[-1] is None else self.get_suffix_keys(key_ids[-1])
+            if suffix_keys is None: raise KeyError("Key not in chain: {}".format(initial_state))
+            packed_keys, cumulative_occurrences = suffix_keys
+            current_key = packed_keys[bisect.bisect_right(cumulative_occurrences, random.randrange(cumulative_occurrences[-1]))]
+            key_length = sum(1 for i in range(self.lookbehind_length) if (current_key >> (32 * i)) & 0xFFFFFFFF != 0)
+
+        # generate a message based on probability chains
+        token_list = []
+        while True:
+            entry = self.get_entry(current_key)
+            if entry is None: raise KeyError("Key not in chain: {}".format(initial_state + tuple(token_list)))
+
+            # pick a random token weighted on the number of times it has occurred previously
+            successors, thresholds, alias_successors, total = entry
+            position, random_choice = divmod(random.randrange(len(successors) * total), total)
+            token_id = successors[position] if random_choice < thresholds[position] else alias_successors[position]
+
+            # add the token to the message
+            if token_id == 0: break
+            token_list.append(self.get_token(token_id))
+            current_key, key_length = self.shift_key(current_key, key_length, token_id)
+        return token_list
+
+SUFFIX_INDEX_SCHEMA = "CREATE INDEX IF NOT EXISTS counts_suffix_index ON counts (key2)" # used to back off to a key ending with the same token when a key isn't in the chain database, see `speak_db`
+UPDATED_KEYS_SCHEMA = "CREATE TABLE IF NOT EXISTS updated_keys (key1 INTEGER, key2 INTEGER, PRIMARY KEY (key1, key2)) WITHOUT ROWID" # keys in the chain database trained since the model file was exported, see `MappedMarkov`
+
+MODEL_FILE_MAGIC = b"BOTTYMKV"
+MODEL_FILE_VERSION = 2
+MODEL_FILE_HEADER = struct.Struct("=8sIIQQQQ") # magic, version, byte order marker, token count, key count, transition count, string data size
+MODEL_FILE_BYTE_ORDER_MARKER = 0x01020304 # reads back differently if the file was written on a machine with a different byte order
+
+def write_model_file(db_connection, path):
+    """
+    Export the chain in the chain database `db_connection` to the file at `path`, in the flat binary format read by `MappedMarkov`. Arrays are stored in native byte order, each section padded to a multiple of 8 bytes:
+
+    * Header (`MODEL_FILE_HEADER`).
+    * Sorted packed keys (64-bit), then CSR-style offsets of each key's transitions (64-bit, one more than the number of keys), then total occurrences of each key (64-bit).
+    * Alias table thresholds (64-bit), successor token IDs (32-bit), and alias token IDs (32-bit) of every transition.
+    * Suffix index: CSR-style offsets into the following arrays for each token ID (64-bit, two more than the number of tokens), then packed keys sorted by their last token ID (64-bit), then the cumulative total occurrences of those keys, restarting at each token ID (64-bit).
+    * Token IDs sorted by token (32-bit), for looking up token IDs by token.
+    * String table: offsets of the end of each token (64-bit, one more than the number of tokens, starting with 0), followed by the UTF-8 encoded tokens.
+
+    The file is written to a temporary file next to `path`, then atomically renamed over it, so processes that have the old file memory-mapped keep reading the old file. The `updated_keys` table (which tracks keys that were trained after the export) is cleared in the same transaction, so that it's consistent with the exported file. Returns the number of keys and transitions written.
+    """
+    with db_connection: # commits the transaction if successful, rolls it back otherwise
+        db_connection.execute("BEGIN IMMEDIATE") # prevent live training from changing the chain while it's being exported
+        encoded_tokens, token_id_mapping = [], {0: 0} # mapping from token IDs in the database to token IDs in the file, which are usually the same
+        for token_id, token in db_connection.execute("SELECT id, token FROM vocab ORDER BY id"):
+            encoded_tokens.append(token.encode("utf-8"))
+            token_id_mapping[token_id] = len(encoded_tokens)
+        keys, key_offsets, key_totals = array("Q"), array("Q", [0]), array("Q")
+        thresholds, successors, alias_successors = array("Q"), array("I"), array("I")
+        rows = db_connection.execute("SELECT key1, key2, counts.count, alias.next_id, alias.threshold, alias.alias_id FROM alias JOIN counts USING (key1, key2) ORDER BY key1, key2, alias.position")
+        for (key1, key2, total), key_rows in groupby(rows, lambda row: row[:3]):
+            for _, _, _, next_id, threshold, alias_id in key_rows:
+                thresholds.append(threshold)
+                successors.append(token_id_mapping[next_id])
+                alias_successors.append(token_id_mapping[alias_id])
+            keys.append((token_id_mapping[key1] << 32) | token_id_mapping[key2])
+            key_offsets.append(len(successors))
+            key_totals.append(total)
+        db_connection.execute("DELETE FROM updated_keys")
+
+        suffix_offsets, suffix_keys, suffix_cumulative_occurrences = array("Q", [0] * (len(encoded_tokens) + 2)), array("Q"), array("Q")
+        for index in sorted((index for index in range(len(keys)) if keys[index] != 0), key=lambda index: keys[index] & 0xFFFFFFFF): # the empty key doesn't end with any token
+            token_id = keys[index] & 0xFFFFFFFF
+            previous_total = suffix_cumulative_occurrences[-1] if suffix_offsets[token_id + 1] > 0 else 0 # restart the cumulative total for each token ID
+            suffix_keys.append(keys[index])
+            suffix_cumulative_occurrences.append(previous_total + key_totals[index])
+            suffix_offsets[token_id + 1] += 1
+        for token_id in range(1, len(suffix_offsets)): suffix_offsets[token_id] += suffix_offsets[token_id - 1]
+
+        sorted_token_ids = array("I", sorted(range(1, len(encoded_tokens) + 1), key=lambda token_id: encoded_tokens[token_id - 1]))
+        string_offsets = array("Q", [0])
+        for encoded_token in encoded_tokens: string_offsets.append(string_offsets[-1] + len(encoded_token))
+        string_data = b"".join(encoded_tokens)
+
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as f:
+            f.write(MODEL_FILE_HEADER.pack(MODEL_FILE_MAGIC, MODEL_FILE_VERSION, MODEL_FILE_BYTE_ORDER_MARKER, len(encoded_tokens), len(keys), len(successors), len(string_data)))
+            for section in [keys, key_offsets, key_totals, thresholds, successors, alias_successors, suffix_offsets, suffix_keys, suffix_cumulative_occurrences, sorted_token_ids, string_offsets, string_data]:
+                data = section if isinstance(section, bytes) else section.tobytes()
+                f.write(data)
+                f.write(b"\0" * (-len(data) % 8))
+            f.flush()
+            os.fsync(f.fileno()) # make sure the data is on disk before the rename, so a crash can't leave a truncated file at `path`
+        os.replace(temporary_path, path) # overwriting the file in place would crash processes that have it memory-mapped
+    return len(keys), len(successors)
+
+class MappedMarkov(CompiledMarkov):
+    """
+    Markov chain read directly from a memory-mapped model file written by `write_model_file`, for fast text generation with near-instant loading.
+
+    Nothing is copied out of the file except the tokens of generated messages, so the chain lives in the page cache and is shared by every process using the same file. Keys updated after the file was exported (using `update_key`) are stored in memory, in the same form as in `CompiledMarkov`, and take precedence over the keys in the file.
+    """
+    def __init__(self, path, lookbehind_length = 2):
+        assert lookbehind_length == 2, "Model files only support a lookbehind length of 2 rather than {}".format(lookbehind_length)
+        super().__init__(lookbehind_length)
+        with open(path, "rb") as f: self.file_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, byte_order_marker, self.file_token_count, key_count, transition_count, string_data_size = MODEL_FILE_HEADER.unpack_from(self.file_map)
+        if magic != MODEL_FILE_MAGIC or version != MODEL_FILE_VERSION: raise ValueError("Unsupported model file: {}".format(path))
+        if byte_order_marker != MODEL_FILE_BYTE_ORDER_MARKER: raise ValueError("Model file was written on a machine with a different byte order: {}".format(path))
+
+        # set up typed views into each section of the file, which read directly from the memory map
+        view, offset = memoryview(self.file_map), MODEL_FILE_HEADER.size
+        def get_section(format, count):
+            nonlocal offset
+            size = count * struct.calcsize(format)
+            section = view[offset:offset + size].cast(format)
+            offset += size + (-size % 8)
+            return section
+        self.keys, self.key_offsets, self.key_totals = get_section("Q", key_count), get_section("Q", key_count + 1), get_section("Q", key_count)
+        self.thresholds, self.successors, self.alias_successors = get_section("Q", transition_count), get_section("I", transition_count), get_section("I", transition_count)
+        self.suffix_offsets = get_section("Q", self.file_token_count + 2)
+        self.suffix_keys, self.suffix_cumulative_occurrences = get_section("Q", self.suffix_offsets[-1]), get_section("Q", self.suffix_offsets[-1])
+        self.sorted_token_ids, self.string_offsets = get_section("I", self.file_token_count), get_section("Q", self.file_token_count + 1)
+        self.string_data = view[offset:offset + string_data_size]
+
+    def load_updated_keys(self, db_connection):
+        """Load keys that were trained in the chain database `db_connection` after this model's file was exported. Returns the number of keys loaded."""
+        updated_keys = db_connection.execute("SELECT key1_vocab.token, key2_vocab.token, key1, key2 FROM updated_keys LEFT JOIN vocab key1_vocab ON key1_vocab.id = key1 LEFT JOIN vocab key2_vocab ON key2_vocab.id = key2").fetchall()
+        for key1_token, key2_token, key1, key2 in updated_keys:
+            next_words, weights = zip(*db_connection.execute("SELECT vocab.token, chain.occurrences FROM chain LEFT JOIN vocab ON vocab.id = chain.next_id WHERE key1 = ? AND key2 = ?", (key1, key2)))
+            self.update_key(tuple(token for token in (key1_token, key2_token) if token is not None), next_words, weights)
+        return len(updated_keys)
+
+    def get_encoded_file_token(self, token_id): return self.string_data[self.string_offsets[token_id - 1]:self.string_offsets[token_id]].tobytes()
+
+    def get_token_id(self, token):
+        # binary search for the token in the file, falling back to tokens added after the file was exported
+        encoded_token = token.encode("utf-8")
+        low, high = 0, self.file_token_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.get_encoded_file_token(self.sorted_token_ids[middle]) < encoded_token: low = middle + 1
+            else: high = middle
+        if low < self.file_token_count and self.get_encoded_file_token(self.sorted_token_ids[low]) == encoded_token: return self.sorted_token_ids[low]
+        return self.token_ids.get(token)
+
+    def get_token(self, token_id):
+        if token_id <= self.file_token_count: return self.get_encoded_file_token(token_id).decode("utf-8")
+        return self.tokens[token_id - self.file_token_count]
+
+    def intern(self, token):
+        if token is None: return 0
+        token_id = self.get_token_id(token)
+        if token_id is None:
+            token_id = self.token_ids[token] = self.file_token_count + len(self.tokens)
+            self.tokens.append(token)
+        return token_id
+
+    def get_entry(self, packed_key):
+        entry = self.chain.get(packed_key)
+        if entry is not None: return entry
+        index = bisect.bisect_left(self.keys, packed_key)
+        if index == len(self.keys) or self.keys[index] != packed_key: return None
+        start, end = self.key_offsets[index], self.key_offsets[index + 1]
+        return self.successors[start:end], self.thresholds[start:end], self.alias_successors[start:end], self.key_totals[index]
+
+    def get_suffix_keys(self, token_id):
+        if token_id > self.file_token_count: return None
+        start, end = self.suffix_offsets[token_id], self.suffix_offsets[token_id + 1]
+        if start == end: return None
+        return self.suffix_keys[start:end], self.suffix_cumulative_occurrences[start:end]
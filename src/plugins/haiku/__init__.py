@@ -1,10 +1,16 @@
 #!/usr/bin/env python3
 
-import os, json, re, random
+import os, re, time
+import sqlite3
 
 from ..utilities import BasePlugin
+from ..lexicon import load_lexicon
+from .lines import HaikuLineStore, count_syllables
 
-JSON_LINES_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "haiku_lines.json") # haiku candidate lines, generated by `src/plugins/haiku/generate_haiku_lines.py`
+LINES_DATABASE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "haiku_lines.db") # haiku candidate lines, generated by `src/plugins/haiku/generate_haiku_lines.py`
+JSON_LINES_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "haiku_lines.json") # haiku candidate lines generated by older versions of `src/plugins/haiku/generate_haiku_lines.py`, migrated into `LINES_DATABASE`
+LINES_FLUSH_INTERVAL = 60 # number of seconds between writes of new candidate lines to the lines database
+LINES_WRITE_TIMEOUT = 0.05 # maximum number of seconds to wait for other processes (such as `generate_haiku_lines.py`) to finish writing to the lines database before trying again at the next write, so the bot loop never stalls on them
 
 class HaikuPlugin(BasePlugin):
     """
@@ -14,6 +20,8 @@ class HaikuPlugin(BasePlugin):
 
     The `mhyph.txt` file is the [MOBY Hyphenation List](http://www.gutenberg.org/ebooks/3204), taken from the MOBY English language project.
 
+    Candidate lines are stored in a SQLite database, so they don't need to be loaded into memory. New messages with five or seven syllables are added to it in batches every `LINES_FLUSH_INTERVAL` seconds.
+
     Example invocations:
 
         #general    | Me: pls haiku me
@@ -32,29 +40,45 @@ class HaikuPlugin(BasePlugin):
     def __init__(self, bot):
         super().__init__(bot)
 
-        try:
-            with open(JSON_LINES_FILE) as f:
-                result = json.load(f)
-                self.five_syllable_messages = result["five_syllables"] or ["refrigerator"]
-                self.seven_syllable_messages = result["seven_syllables"] or ["seven refrigerators"]
-        except FileNotFoundError:
-            self.logger.warning("can't find haiku lines JSON file `{}` - try running `python3 src/plugins/haiku/generate_haiku_lines.py`".format(JSON_LINES_FILE))
-            self.five_syllable_messages = []
-            self.seven_syllable_messages = []
+        self.store = HaikuLineStore(LINES_DATABASE)
+        if os.path.exists(JSON_LINES_FILE):
+            migrated_count = self.store.migrate_json_lines(JSON_LINES_FILE)
+            if migrated_count > 0: self.logger.info("migrated {} haiku lines from `{}` to `{}`".format(migrated_count, JSON_LINES_FILE, LINES_DATABASE))
+        if self.store.count(5) == 0 or self.store.count(7) == 0:
+            self.logger.warning("haiku lines database `{}` is empty - try running `python3 src/plugins/haiku/generate_haiku_lines.py`".format(LINES_DATABASE))
+        self.lexicon = load_lexicon() # for counting syllables in new messages
+        self.pending_lines = [] # `(syllables, text, channel_id, timestamp)` tuples for candidate lines received since the last write to the lines database
+        self.last_lines_flush_time = time.monotonic()
+
+    def on_step(self):
+        if time.monotonic() - self.last_lines_flush_time < LINES_FLUSH_INTERVAL: return False
+        self.last_lines_flush_time = time.monotonic()
+        if not self.pending_lines: return False
+        start_time = time.monotonic()
+        try: added_count = self.store.add_lines(self.pending_lines, timeout=LINES_WRITE_TIMEOUT) # all in a single transaction
+        except sqlite3.OperationalError as e: # most likely the database is locked by `generate_haiku_lines.py`, so keep the lines for the next write
+            self.logger.info("couldn't add {} new haiku lines, trying again in {} seconds: {}".format(len(self.pending_lines), LINES_FLUSH_INTERVAL, e))
+            return False
+        self.logger.debug("added {} of {} new haiku lines in {:.2f} seconds".format(added_count, len(self.pending_lines), time.monotonic() - start_time))
+        self.pending_lines = []
+        return False
 
     def on_message(self, m):
         if not m.is_user_text_message: return False
-        if not re.search(r"\b(?:pls\s+haiku\s+me|haiku\s+me\s+pls)\b", m.text, re.IGNORECASE): return False
+        if not re.search(r"\b(?:pls\s+haiku\s+me|haiku\s+me\s+pls)\b", m.text, re.IGNORECASE):
+            # add the message as a candidate line if it has the right number of syllables
+            text = self.sendable_text_to_text(m.text)
+            syllables = count_syllables(text, self.lexicon)
+            if syllables in {5, 7}: self.pending_lines.append((syllables, text, m.channel_id, m.timestamp)) # written to the database from `on_step`
+            return False
 
         # fail gracefully if user has not configured this plugin yet
-        if not self.five_syllable_messages or not self.seven_syllable_messages:
+        five_syllable_lines = [self.store.random_line(5), self.store.random_line(5)]
+        seven_syllable_line = self.store.random_line(7)
+        if None in five_syllable_lines or seven_syllable_line is None:
             self.respond_raw("```\nthis poem is shown\nwhen there are no haiku lines\nrefrigerator\n```\n(try running `python3 src/plugins/haiku/generate_haiku_lines.py` to generate the haiku lines)")
             return True
 
         # generate haiku
-        self.respond_raw("```\n{}\n{}\n{}\n```".format(
-            random.choice(self.five_syllable_messages),
-            random.choice(self.seven_syllable_messages),
-            random.choice(self.five_syllable_messages)
-        ))
+        self.respond_raw("```\n{}\n{}\n{}\n```".format(five_syllable_lines[0], seven_syllable_line, five_syllable_lines[1]))
         return True
@@ -1,26 +1,15 @@
 #!/usr/bin/env python3
 
-import os, json, re
-
-JSON_LINES_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "haiku_lines.json")
-
-PUNCTUATION = r"[`~@#$%_\\'+\-/]" # punctuation that is a part of text
-STANDALONE = r"(?:[!.,;()^&\[\]{}|*=<>?]|[dDpP][:8]|:\S)" # standalone characters or emoticons that wouldn't otherwise be captured
-WORD_PATTERN = STANDALONE + r"\S*|https?://\S+|(?:\w|" + PUNCTUATION + r")+" # token pattern
-WORD_MATCHER = re.compile(WORD_PATTERN, re.IGNORECASE)
-def tokenize_text(text):
-    return (m.lower() for m in WORD_MATCHER.findall(text))
-
-def load_word_syllable_counts():
-    word_syllable_counts = {}
-    hyphenation_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), "mhyph.txt")
-    with open(hyphenation_file, "rb") as f:
-        for line in f.readlines():
-            try: word = line.rstrip(b"\r\n").replace(b"\xA5", b"").decode("UTF-8")
-            except UnicodeDecodeError: continue
-            syllables = 1 + line.count(b"\xA5") + line.count(b" ") + line.count(b"-")
-            word_syllable_counts[word] = syllables
-    return word_syllable_counts
+import os, sys, json, re, time
+import argparse
+import multiprocessing
+
+from lines import HaikuLineStore, count_syllables
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")) # the lexicon is shared with other plugins, so it's in the parent directory
+from lexicon import load_lexicon
+
+LINES_DATABASE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "haiku_lines.db")
+JSON_LINES_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "haiku_lines.json") # haiku lines generated by older versions of this script, migrated into `LINES_DATABASE`
 
 CHAT_HISTORY_DIRECTORY = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "..", "@history")
 
@@ -78,32 +67,55 @@ def get_history_files():
         return result
     return {}
 
-# obtain mapping from words to the number of syllables in those words
-word_syllable_counts = load_word_syllable_counts()
-
-# find messages with 5 syllables and 7 syllables
-five_syllable_messages = []
-seven_syllable_messages = []
-for channel_id, history_file in get_history_files().items():
+def find_haiku_lines(channel_id, history_file, after_timestamp = None):
+    """Returns a tuple containing the messages in the history file `history_file` (for the channel with ID `channel_id`) that have 5 or 7 syllables, as `(syllables, text, channel_id, timestamp)` tuples, and the latest message timestamp in the file (or `None` if there are no messages). If `after_timestamp` is specified, messages at or before that timestamp are skipped."""
+    haiku_lines, latest_timestamp = [], None
     with open(history_file, "r") as f:
         for entry in f:
-            text = get_message_text(json.loads(entry))
+            message = json.loads(entry)
+            text = get_message_text(message)
             if text is None: continue
-
-            # count syllables in the text
-            syllables = 0
-            for token in tokenize_text(text):
-                if token in word_syllable_counts:
-                    syllables += word_syllable_counts[token]
-                else: # unknown word, ignore the whole message
-                    break
-            else:
-                if syllables == 5:
-                    five_syllable_messages.append(text)
-                elif syllables == 7:
-                    seven_syllable_messages.append(text)
-
-# store result
-result = {"five_syllables": five_syllable_messages, "seven_syllables": seven_syllable_messages}
-with open(JSON_LINES_FILE, "w") as f:
-    json.dump(result, f)
+            timestamp = float(message["ts"])
+            if latest_timestamp is None or timestamp > latest_timestamp: latest_timestamp = timestamp
+            if after_timestamp is not None and timestamp <= after_timestamp: continue
+            syllables = count_syllables(text, lexicon)
+            if syllables in {5, 7}: haiku_lines.append((syllables, text, channel_id, message["ts"]))
+    return haiku_lines, latest_timestamp
+
+def find_haiku_lines_in_channel(entry):
+    """Same as `find_haiku_lines`, but takes a tuple of the arguments so it can be used with `multiprocessing.Pool.imap`."""
+    return find_haiku_lines(*entry)
+
+# obtain the syllable counts of words (loaded before starting worker processes, so they share it)
+lexicon = load_lexicon()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find messages with 5 and 7 syllables in the chat history in `@history`, for use as haiku lines.")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="Number of worker processes that read history files (defaults to the number of CPUs).")
+    parser.add_argument("--incremental", action="store_true", help="Rather than processing all of the chat history, add lines from messages sent since the last run to the existing haiku lines.")
+    args = parser.parse_args()
+    start_time = time.monotonic()
+
+    store = HaikuLineStore(LINES_DATABASE)
+    if args.incremental and os.path.exists(JSON_LINES_FILE):
+        migrated_count = store.migrate_json_lines(JSON_LINES_FILE)
+        if migrated_count > 0: print("Migrated {} lines from `{}`".format(migrated_count, JSON_LINES_FILE))
+    latest_timestamps = store.get_latest_timestamps() if args.incremental else {} # mapping from channel IDs to the latest message timestamp that's been processed in that channel
+    if args.incremental and not latest_timestamps:
+        print("No timestamps from a previous run in `{}`, processing all of the chat history".format(LINES_DATABASE))
+    replace_lines = not latest_timestamps
+
+    # find messages with 5 syllables and 7 syllables in each channel in parallel
+    history_files = get_history_files()
+    new_haiku_lines = []
+    with multiprocessing.Pool(args.workers) as pool:
+        channel_results = pool.imap(find_haiku_lines_in_channel, [(channel_id, history_file, latest_timestamps.get(channel_id)) for channel_id, history_file in history_files.items()])
+        for channel_id, (haiku_lines, latest_timestamp) in zip(history_files, channel_results):
+            new_haiku_lines += haiku_lines
+            if latest_timestamp is not None: latest_timestamps[channel_id] = latest_timestamp
+
+    # store result, replacing the existing lines if we processed all of the chat history
+    if replace_lines: store.clear() # committed in the same transaction that adds the new lines, so the plugin never sees an empty store
+    added_count = store.add_lines(new_haiku_lines)
+    store.set_latest_timestamps(latest_timestamps)
+    print("Added {} lines in {:.1f} seconds, for a total of {} lines with 5 syllables and {} lines with 7 syllables".format(added_count, time.monotonic() - start_time, store.count(5), store.count(7)))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+"""
+Syllable counting and haiku line storage, shared by the haiku plugin and `generate_haiku_lines.py`.
+"""
+
+import json, re, random
+import sqlite3
+
+PUNCTUATION = r"[`~@#$%_\\'+\-/]" # punctuation that is a part of text
+STANDALONE = r"(?:[!.,;()^&\[\]{}|*=<>?]|[dDpP][:8]|:\S)" # standalone characters or emoticons that wouldn't otherwise be captured
+WORD_PATTERN = STANDALONE + r"\S*|https?://\S+|(?:\w|" + PUNCTUATION + r")+" # token pattern
+WORD_MATCHER = re.compile(WORD_PATTERN, re.IGNORECASE)
+def tokenize_text(text):
+    return (m.lower() for m in WORD_MATCHER.findall(text))
+
+def count_syllables(text, lexicon):
+    """Returns the number of syllables in `text`, or `None` if it contains any words that `lexicon` (a `lexicon.Lexicon` instance) doesn't know the syllable counts of."""
+    syllables = 0
+    for token in tokenize_text(text):
+        token_syllables = lexicon.get_syllables(token)
+        if token_syllables is None: return None
+        syllables += token_syllables
+    return syllables
+
+class HaikuLineStore:
+    """
+    Haiku candidate lines stored in the SQLite database at `path`, keyed by syllable count and position, so that a random line can be looked up without loading the rest of them.
+
+    Lines can be associated with the message they came from, given by its channel ID and timestamp, in which case each message is only stored once. The database also stores the latest message timestamp processed in each channel by `generate_haiku_lines.py`.
+    """
+    def __init__(self, path, timeout=10):
+        self.timeout = timeout # number of seconds to wait for other processes to finish writing before giving up
+        self.connection = sqlite3.connect(path, timeout=timeout)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS lines (syllables INTEGER, position INTEGER, text TEXT, channel_id TEXT, timestamp TEXT, PRIMARY KEY (syllables, position), UNIQUE (channel_id, timestamp)) WITHOUT ROWID") # positions for each syllable count are 0, 1, 2, and so on
+        self.connection.execute("CREATE TABLE IF NOT EXISTS latest_timestamps (channel_id TEXT PRIMARY KEY, timestamp REAL) WITHOUT ROWID")
+        self.connection.commit()
+
+    def add_lines(self, lines, timeout=None):
+        """
+        Add lines from the iterable `lines`, which contains `(syllables, text, channel_id, timestamp)` tuples (where the channel ID and timestamp can be `None` if the message isn't known). Lines from messages that are already stored are skipped. Returns the number of lines added.
+
+        If `timeout` is given, this waits at most `timeout` seconds rather than the store's usual timeout for other processes to finish writing, raising `sqlite3.OperationalError` (without adding anything) if they don't.
+        """
+        if timeout is not None: self.connection.execute("PRAGMA busy_timeout = {}".format(int(timeout * 1000)))
+        try:
+            with self.connection: # commits the transaction if successful, rolls it back otherwise
+                # allocating the next position within the insert keeps positions contiguous, even with several processes adding lines (the maximum position is looked up from the primary key index)
+                cursor = self.connection.executemany("INSERT OR IGNORE INTO lines SELECT ?, coalesce(max(position) + 1, 0), ?, ?, ? FROM lines WHERE syllables = ?", (line + (line[0],) for line in lines))
+            return cursor.rowcount
+        finally:
+            if timeout is not None: self.connection.execute("PRAGMA busy_timeout = {}".format(int(self.timeout * 1000)))
+
+    def clear(self):
+        """Delete all lines and timestamps. This isn't committed until the next call to `add_lines`, so other processes never see an empty store."""
+        self.connection.execute("DELETE FROM lines")
+        self.connection.execute("DELETE FROM latest_timestamps")
+
+    def count(self, syllables):
+        """Returns the number of stored lines with `syllables` syllables."""
+        position, = self.connection.execute("SELECT max(position) FROM lines WHERE syllables = ?", (syllables,)).fetchone()
+        return 0 if position is None else position + 1
+
+    def random_line(self, syllables):
+        """Returns a random line with `syllables` syllables, or `None` if there aren't any."""
+        count = self.count(syllables)
+        if count == 0: return None
+        text, = self.connection.execute("SELECT text FROM lines WHERE syllables = ? AND position = ?", (syllables, random.randrange(count))).fetchone()
+        return text
+
+    def get_latest_timestamps(self):
+        """Returns a mapping from channel IDs to the latest message timestamp processed in that channel by `generate_haiku_lines.py`."""
+        return dict(self.connection.execute("SELECT channel_id, timestamp FROM latest_timestamps"))
+
+    def set_latest_timestamps(self, latest_timestamps):
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO latest_timestamps VALUES (?, ?)", latest_timestamps.items())
+
+    def migrate_json_lines(self, json_lines_file):
+        """Add the lines in `json_lines_file`, a haiku lines JSON file generated by an older version of `generate_haiku_lines.py`, if this store is empty. Returns the number of lines added."""
+        if self.connection.execute("SELECT 1 FROM lines LIMIT 1").fetchone() is not None: return 0
+        with open(json_lines_file) as f:
+            result = json.load(f)
+        added_count = self.add_lines(
+            [(5, text, None, None) for text in result["five_syllables"]] +
+            [(7, text, None, None) for text in result["seven_syllables"]]
+        )
+        self.set_latest_timestamps(result.get("latest_timestamps", {}))
+        return added_count
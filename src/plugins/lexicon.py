@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+"""
+Shared English lexicon for Botty plugins, built from the word lists of the MOBY English language project.
+
+The word lists are compiled into a single flat binary file, `lexicon.bin`, which is memory-mapped rather than loaded, so loading it is near-instant, and every process using it shares the same copy through the page cache. The file is recompiled automatically whenever one of the word lists changes.
+
+Should be imported by plugins using `from ..lexicon import load_lexicon` (or `from .lexicon import load_lexicon` for plugins that are a single file).
+"""
+
+import os, mmap, struct, zlib, tempfile
+import fcntl
+from array import array
+
+PLUGINS_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+LEXICON_FILE = os.path.join(PLUGINS_DIRECTORY, "lexicon.bin")
+HYPHENATION_FILE = os.path.join(PLUGINS_DIRECTORY, "haiku", "mhyph.txt") # MOBY Hyphenation List, for syllable counts
+PARTS_OF_SPEECH_FILE = os.path.join(PLUGINS_DIRECTORY, "now_i_am_dude", "mobypos.txt") # MOBY Part-of-Speech List
+PRONOUNCIATION_FILE = os.path.join(PLUGINS_DIRECTORY, "now_i_am_dude", "mobypron.txt") # MOBY Pronounciator, re-encoded to UTF-8, for rhyme classes
+SOURCE_FILES = [HYPHENATION_FILE, PARTS_OF_SPEECH_FILE, PRONOUNCIATION_FILE]
+
+PARTS_OF_SPEECH = "NphVtiAvCP!rDIo" # part of speech codes used in the MOBY Part-of-Speech List, stored as a bitmask in this order
+VOWEL_SOUNDS = {"a", "e", "i", "o", "u", "A", "E", "I", "O", "U", "aI", "eI", "Oi", "oU", "AU", "@", "(@)", "[@]", "&"}
+
+LEXICON_FILE_MAGIC = b"BOTTYLEX"
+LEXICON_FILE_VERSION = 1
+LEXICON_FILE_HEADER = struct.Struct("=8sIIQQQ" + "qq" * len(SOURCE_FILES)) # magic, version, byte order marker, word count, hash table size, string data size, then the modification time and size of each source file
+LEXICON_FILE_BYTE_ORDER_MARKER = 0x01020304 # reads back differently if the file was written on a machine with a different byte order
+
+def get_sources():
+    """Returns a list containing the modification time and size of each source file (-1 for both if it's missing), which changes whenever any of them changes."""
+    sources = []
+    for source_file in SOURCE_FILES:
+        try: source_stat = os.stat(source_file)
+        except FileNotFoundError: sources += [-1, -1]
+        else: sources += [source_stat.st_mtime_ns, source_stat.st_size]
+    return sources
+
+def get_last_syllables(pronounciation):
+    """Returns the last two syllables (or the only syllable) of the pronounciation `pronounciation`, in MOBY Pronounciator notation, as a hashable value. Words rhyme if their last syllables are equal."""
+    syllables, index = [[]], 0
+    for phoneme in pronounciation.strip("/\n").split("/"):
+        if phoneme in VOWEL_SOUNDS:
+            index += 1
+            syllables.append([phoneme])
+        elif phoneme != "": # consonant sound
+            syllables[index].append(phoneme)
+    if len(syllables[-1]) == 0: del syllables[-1] # delete last blank syllable if present
+    if len(syllables) > 1: return (tuple(syllables[-2]), tuple(syllables[-1]))
+    return tuple(syllables[-1])
+
+def compile_lexicon(path):
+    """
+    Compile the source word lists into a lexicon file at `path`, in the flat binary format read by `Lexicon`. The file is written to a temporary file next to `path`, then atomically renamed over it, so processes that have the old file memory-mapped keep reading the old file. Missing source files are skipped. Returns the number of words written.
+
+    Arrays are stored in native byte order, each section padded to a multiple of 8 bytes:
+
+    * Header (`LEXICON_FILE_HEADER`).
+    * String table offsets of the end of each word (64-bit, one more than the number of words, starting with 0), with words sorted by their UTF-8 encoding.
+    * Syllable count of each word (8-bit, 0 if unknown), then parts of speech of each word (16-bit bitmask, see `PARTS_OF_SPEECH`), then rhyme class of each word (32-bit, 0 if unknown).
+    * Hash table mapping the CRC-32 of each word to its index plus one (32-bit, 0 for empty slots), with linear probing.
+    * String table: the UTF-8 encoded words.
+    """
+    sources = get_sources()
+    syllable_counts, parts_of_speech, rhyme_classes = {}, {}, {}
+    if os.path.exists(HYPHENATION_FILE):
+        with open(HYPHENATION_FILE, "rb") as f:
+            for line in f:
+                try: word = line.rstrip(b"\r\n").replace(b"\xA5", b"").decode("UTF-8")
+                except UnicodeDecodeError: continue
+                syllable_counts[word] = min(255, 1 + line.count(b"\xA5") + line.count(b" ") + line.count(b"-"))
+    if os.path.exists(PARTS_OF_SPEECH_FILE):
+        with open(PARTS_OF_SPEECH_FILE, "r") as f:
+            for line in f:
+                word, codes = line.rstrip("\r\n").split("\\")
+                parts_of_speech[word] = sum(1 << PARTS_OF_SPEECH.index(code) for code in set(codes) if code in PARTS_OF_SPEECH)
+    if os.path.exists(PRONOUNCIATION_FILE):
+        rhyme_class_ids = {} # mapping from last syllables to rhyme class IDs, numbered from 1 in order of first appearance
+        with open(PRONOUNCIATION_FILE, "r") as f:
+            for line in f:
+                word, pronounciation = line.split(" ", 1)
+                rhyme_classes[word] = rhyme_class_ids.setdefault(get_last_syllables(pronounciation), len(rhyme_class_ids) + 1)
+
+    encoded_words = sorted({word.encode("utf-8") for word in syllable_counts.keys() | parts_of_speech.keys() | rhyme_classes.keys()})
+    string_offsets, word_syllables, word_parts_of_speech, word_rhyme_classes = array("Q", [0]), array("B"), array("H"), array("I")
+    hash_size = 1 << (2 * len(encoded_words)).bit_length() # keep the load factor at or below 50%, so probe sequences stay short
+    hash_slots = array("I", [0]) * hash_size
+    for index, encoded_word in enumerate(encoded_words):
+        word = encoded_word.decode("utf-8")
+        string_offsets.append(string_offsets[-1] + len(encoded_word))
+        word_syllables.append(syllable_counts.get(word, 0))
+        word_parts_of_speech.append(parts_of_speech.get(word, 0))
+        word_rhyme_classes.append(rhyme_classes.get(word, 0))
+        slot = zlib.crc32(encoded_word) & (hash_size - 1)
+        while hash_slots[slot] != 0: slot = (slot + 1) & (hash_size - 1)
+        hash_slots[slot] = index + 1
+    string_data = b"".join(encoded_words)
+
+    # every compile gets its own temporary file, so processes compiling at the same time never write to each other's files or replace the lexicon with a partially written one
+    file_descriptor, temporary_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path))
+    try:
+        with open(file_descriptor, "wb") as f:
+            f.write(LEXICON_FILE_HEADER.pack(LEXICON_FILE_MAGIC, LEXICON_FILE_VERSION, LEXICON_FILE_BYTE_ORDER_MARKER, len(encoded_words), hash_size, len(string_data), *sources))
+            for section in [string_offsets, word_syllables, word_parts_of_speech, word_rhyme_classes, hash_slots, string_data]:
+                data = section if isinstance(section, bytes) else section.tobytes()
+                f.write(data)
+                f.write(b"\0" * (-len(data) % 8))
+        os.chmod(temporary_path, 0o644) # `mkstemp` only gives the owner access
+        os.replace(temporary_path, path) # overwriting the file in place would crash processes that have it memory-mapped
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+    return len(encoded_words)
+
+class Lexicon:
+    """
+    Lexicon read directly from a memory-mapped lexicon file written by `compile_lexicon`. Use `load_lexicon` to get an up-to-date instance.
+
+    Words are case sensitive, and iterating over the lexicon yields its words in order of their UTF-8 encoding. Nothing is copied out of the file except the words that are looked up or iterated over.
+    """
+    def __init__(self, path):
+        with open(path, "rb") as f: self.file_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = LEXICON_FILE_HEADER.unpack_from(self.file_map)
+        magic, version, byte_order_marker, self.word_count, self.hash_size, string_data_size = header[:6]
+        self.sources = list(header[6:])
+        if magic != LEXICON_FILE_MAGIC or version != LEXICON_FILE_VERSION: raise ValueError("Unsupported lexicon file: {}".format(path))
+        if byte_order_marker != LEXICON_FILE_BYTE_ORDER_MARKER: raise ValueError("Lexicon file was written on a machine with a different byte order: {}".format(path))
+
+        # set up typed views into each section of the file, which read directly from the memory map
+        view, offset = memoryview(self.file_map), LEXICON_FILE_HEADER.size
+        def get_section(format, count):
+            nonlocal offset
+            size = count * struct.calcsize(format)
+            section = view[offset:offset + size].cast(format)
+            offset += size + (-size % 8)
+            return section
+        self.string_offsets = get_section("Q", self.word_count + 1)
+        self.syllables, self.parts_of_speech, self.rhyme_classes = get_section("B", self.word_count), get_section("H", self.word_count), get_section("I", self.word_count)
+        self.hash_slots = get_section("I", self.hash_size)
+        self.string_data = view[offset:offset + string_data_size]
+
+    def __len__(self): return self.word_count
+    def __contains__(self, word): return self.get_index(word) is not None
+    def __iter__(self): return (self.get_word(index) for index in range(self.word_count))
+
+    def get_index(self, word):
+        """Returns the index of `word` in the lexicon, or `None` if it isn't in the lexicon."""
+        encoded_word = word.encode("utf-8")
+        slot = zlib.crc32(encoded_word) & (self.hash_size - 1)
+        while True:
+            index = self.hash_slots[slot] - 1
+            if index < 0: return None
+            if self.string_data[self.string_offsets[index]:self.string_offsets[index + 1]] == encoded_word: return index
+            slot = (slot + 1) & (self.hash_size - 1)
+
+    def entries(self):
+        """Yields a `(word, syllables, parts_of_speech, rhyme_class)` tuple for each word in the lexicon, in the same form as returned by `get_syllables`, `get_parts_of_speech`, and `get_rhyme_class`."""
+        for index in range(self.word_count):
+            parts_of_speech = "".join(code for bit, code in enumerate(PARTS_OF_SPEECH) if self.parts_of_speech[index] & (1 << bit))
+            yield self.get_word(index), self.syllables[index] or None, parts_of_speech, self.rhyme_classes[index] or None
+
+    def get_word(self, index): return self.string_data[self.string_offsets[index]:self.string_offsets[index + 1]].tobytes().decode("utf-8")
+
+    def get_syllables(self, word):
+        """Returns the number of syllables in `word`, or `None` if it's unknown."""
+        index = self.get_index(word)
+        return None if index is None or self.syllables[index] == 0 else self.syllables[index]
+
+    def get_parts_of_speech(self, word):
+        """Returns the parts of speech of `word` as a string of MOBY part of speech codes (such as "N" for noun and "A" for adjective, see `PARTS_OF_SPEECH`), which is empty if they're unknown."""
+        index = self.get_index(word)
+        if index is None: return ""
+        return "".join(code for bit, code in enumerate(PARTS_OF_SPEECH) if self.parts_of_speech[index] & (1 << bit))
+
+    def get_rhyme_class(self, word):
+        """Returns the rhyme class of `word`, a positive integer that's the same for words that rhyme, or `None` if it's unknown."""
+        index = self.get_index(word)
+        return None if index is None or self.rhyme_classes[index] == 0 else self.rhyme_classes[index]
+
+def open_lexicon_if_up_to_date(path):
+    """Returns the lexicon in the lexicon file at `path`, or `None` if it's missing or out of date."""
+    try:
+        lexicon = Lexicon(path)
+        if lexicon.sources == get_sources(): return lexicon
+    except (FileNotFoundError, ValueError): pass # missing, or written by an older version of this module
+    return None
+
+def load_lexicon(path = LEXICON_FILE):
+    """
+    Returns the lexicon in the lexicon file at `path`, compiling it first if it's missing or out of date.
+
+    Compiling is done while holding a lock on `path` + ".lock", so when several bot processes start at once, only one of them compiles the lexicon, and the rest wait for it and then map the result.
+    """
+    lexicon = open_lexicon_if_up_to_date(path)
+    if lexicon is not None: return lexicon
+    with open(path + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        lexicon = open_lexicon_if_up_to_date(path) # another process might have compiled it while we were waiting for the lock
+        if lexicon is not None: return lexicon
+        compile_lexicon(path)
+    return Lexicon(path)
+
+if __name__ == "__main__":
+    import time
+    start_time = time.monotonic()
+    word_count = compile_lexicon(LEXICON_FILE)
+    print("Compiled {} words into `{}` in {:.1f} seconds".format(word_count, LEXICON_FILE, time.monotonic() - start_time))
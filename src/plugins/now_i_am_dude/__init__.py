@@ -1,12 +1,11 @@
 #!/usr/bin/env python3
 
-import re, random
-from os import path
+import re, time
+import threading
 
 from ..utilities import BasePlugin
-
-PARTS_OF_SPEECH_FILE = path.join(path.dirname(path.realpath(__file__)), "mobypos.txt")
-PRONOUNCIATION_FILE = path.join(path.dirname(path.realpath(__file__)), "mobypron.txt")
+from ..lexicon import load_lexicon
+from .rhyming_pairs import RhymingPairs, RHYMING_PAIRS_DATABASE
 
 class NowIAmDudePlugin(BasePlugin):
     """
@@ -14,7 +13,7 @@ class NowIAmDudePlugin(BasePlugin):
 
     Generates sentences of the form "I was born A but now I am B", where A is an adjective, B is a noun, and A and B rhyme.
 
-    Uses `mobypos.txt` and `mobypron.txt` from the MOBY English language project (`mobypron.txt` is a copy of `mobyron.unc` in the original project, but re-encoded to UTF-8).
+    Uses `mobypos.txt` and `mobypron.txt` from the MOBY English language project (`mobypron.txt` is a copy of `mobyron.unc` in the original project, but re-encoded to UTF-8), through the shared lexicon in `src/plugins/lexicon.py`. Rhyming pairs are indexed into `rhyming_pairs.db` if it's missing or the lexicon has changed, on a background thread when the plugin starts.
 
     Example invocations:
 
@@ -23,51 +22,36 @@ class NowIAmDudePlugin(BasePlugin):
     """
     def __init__(self, bot):
         super().__init__(bot)
-
-        vowel_sounds = {"a", "e", "i", "o", "u", "A", "E", "I", "O", "U", "aI", "eI", "Oi", "oU", "AU", "@", "(@)", "[@]", "&"}
-
-        nouns, adjectives = [], []
-        with open(PARTS_OF_SPEECH_FILE, "r") as f:
-            for line in f:
-                word, parts_of_speech = line.split("\\")
-                if "A" in parts_of_speech: adjectives.append(word)
-                if "N" in parts_of_speech: nouns.append(word)
-        self.nouns, self.adjectives = nouns, adjectives
-
-        last_syllable_words, word_last_syllables = {}, {}
-        with open(PRONOUNCIATION_FILE, "r") as f:
-            for line in f:
-                word, pronounciation = line.split(" ", 1)
-                syllables, index = [[]], 0
-                for phoneme in pronounciation.strip("/\n").split("/"):
-                    if phoneme in vowel_sounds:
-                        index += 1
-                        syllables.append([phoneme])
-                    elif phoneme != "": # consonant sound
-                        syllables[index].append(phoneme)
-                if len(syllables[-1]) == 0: del syllables[-1] # delete last blank syllable if present
-                if len(syllables) > 1: last_syllable = (tuple(syllables[-2]), tuple(syllables[-1]))
-                else: last_syllable = tuple(syllables[-1])
-                if last_syllable not in last_syllable_words: last_syllable_words[last_syllable] = []
-                last_syllable_words[last_syllable].append(word)
-                word_last_syllables[word] = last_syllable
-        self.last_syllable_words, self.word_last_syllables = last_syllable_words, word_last_syllables
+        self.rhyming_pairs = None # loaded on a background thread, since compiling the lexicon and building the index can take several seconds
+        self.loader = threading.Thread(target=self.load_rhyming_pairs, daemon=True)
+        self.loader.start()
+
+    def load_rhyming_pairs(self):
+        start_time = time.monotonic()
+        try: rhyming_pairs = RhymingPairs(RHYMING_PAIRS_DATABASE, load_lexicon())
+        except Exception:
+            self.logger.exception("loading rhyming pairs failed")
+            return
+        self.logger.info("loaded {} rhyming pairs in {:.2f} seconds".format(len(rhyming_pairs), time.monotonic() - start_time))
+        self.rhyming_pairs = rhyming_pairs
 
     def get_rhyming_pair(self):
-        while True:
-            first_word = random.choice(self.adjectives)
-            if first_word not in self.word_last_syllables: continue # word is in part of speech dictionary, but not the pronounciation dictionary
-            rhyming_words = self.last_syllable_words[self.word_last_syllables[first_word]]
-            for word in rhyming_words:
-                if word in self.nouns and word != first_word:
-                    return first_word, word
+        """Returns a random rhyming pair as an `(adjective, noun)` tuple, or `None` if there aren't any."""
+        if self.rhyming_pairs is None or len(self.rhyming_pairs) == 0: return None
+        return self.rhyming_pairs.sample()
 
     def on_message(self, m):
         if not m.is_user_text_message: return False
 
         if re.search(r"\bdu+de+\s+me+\b", m.text, re.IGNORECASE):
-            first, second = self.get_rhyming_pair()
-            self.respond_raw("I was born {} but now I am {}".format(first, second))
+            if self.loader.is_alive(): # still loading
+                self.respond_raw("I was born just now but now I am still waking up, try again in a few seconds")
+                return True
+            rhyming_pair = self.get_rhyming_pair()
+            if rhyming_pair is None: # fail gracefully if the dictionaries are missing
+                self.respond_raw("I was born without `mobypos.txt` and `mobypron.txt` but now I am broken :( put them in `src/plugins/now_i_am_dude` to fix me")
+                return True
+            self.respond_raw("I was born {} but now I am {}".format(*rhyming_pair))
             return True
 
         return False
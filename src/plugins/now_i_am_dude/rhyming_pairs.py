@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+"""
+Index of rhyming (adjective, noun) pairs for the "I was born A but now I am B" plugin.
+
+The index is built from the shared lexicon (see `src/plugins/lexicon.py`) into a SQLite database, which stores the adjectives and nouns of each rhyme class, rather than every pair, since large rhyme classes have millions of pairs between them. It's rebuilt automatically when the lexicon's word lists change, or manually by running `python3 src/plugins/now_i_am_dude/rhyming_pairs.py`.
+"""
+
+import os, sys, random, bisect, time, tempfile
+import fcntl
+import sqlite3
+
+RHYMING_PAIRS_DATABASE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "rhyming_pairs.db")
+
+def get_rhyme_classes(lexicon):
+    """Returns a list of `(adjectives, nouns)` tuples for each rhyme class in `lexicon`, a `lexicon.Lexicon` instance."""
+    rhyme_classes = {} # mapping from rhyme classes to `(adjectives, nouns)` tuples
+    for word, _, parts_of_speech, rhyme_class in lexicon.entries():
+        if rhyme_class is None: continue
+        rhyme_class_adjectives, rhyme_class_nouns = rhyme_classes.setdefault(rhyme_class, ([], []))
+        if "A" in parts_of_speech: rhyme_class_adjectives.append(word)
+        if "N" in parts_of_speech: rhyme_class_nouns.append(word)
+    return [rhyme_classes[rhyme_class] for rhyme_class in sorted(rhyme_classes)]
+
+def build_rhyming_pairs(path, lexicon):
+    """Build the rhyming pair index from `lexicon`, a `lexicon.Lexicon` instance, and atomically replace the SQLite database at `path` with it. Returns the number of rhyming pairs."""
+    # every build gets its own temporary file, so processes building at the same time never write to each other's files or replace the index with a partially written one
+    file_descriptor, temporary_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path))
+    os.close(file_descriptor) # SQLite treats the empty file as a new database
+    try:
+        cumulative_pairs = write_rhyming_pairs(temporary_path, lexicon)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+    return cumulative_pairs
+
+def write_rhyming_pairs(path, lexicon):
+    """Write the rhyming pair index for `lexicon`, a `lexicon.Lexicon` instance, into the empty SQLite database at `path`. Returns the number of rhyming pairs."""
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE sources (position INTEGER PRIMARY KEY, value INTEGER)") # the lexicon's `sources` when the index was built
+    connection.execute("CREATE TABLE rhyme_classes (id INTEGER PRIMARY KEY, adjective_count INTEGER, noun_count INTEGER, cumulative_pairs INTEGER)") # `cumulative_pairs` is the number of pairs in this rhyme class and all previous ones
+    connection.execute("CREATE TABLE words (rhyme_class INTEGER, is_noun INTEGER, position INTEGER, word TEXT, PRIMARY KEY (rhyme_class, is_noun, position)) WITHOUT ROWID")
+    connection.executemany("INSERT INTO sources VALUES (?, ?)", enumerate(lexicon.sources))
+    cumulative_pairs = 0
+    for adjectives, nouns in get_rhyme_classes(lexicon):
+        if not adjectives or not nouns or (len(adjectives) == 1 and nouns == adjectives): continue # no pairs of different words in this rhyme class
+        cumulative_pairs += len(adjectives) * len(nouns)
+        rhyme_class = connection.execute("INSERT INTO rhyme_classes VALUES (NULL, ?, ?, ?)", (len(adjectives), len(nouns), cumulative_pairs)).lastrowid
+        connection.executemany("INSERT INTO words VALUES (?, 0, ?, ?)", [(rhyme_class, position, word) for position, word in enumerate(adjectives)])
+        connection.executemany("INSERT INTO words VALUES (?, 1, ?, ?)", [(rhyme_class, position, word) for position, word in enumerate(nouns)])
+    connection.commit()
+    connection.close()
+    return cumulative_pairs
+
+class RhymingPairs:
+    """
+    Rhyming (adjective, noun) pairs, read from the SQLite database at `path`, which is built from `lexicon` (a `lexicon.Lexicon` instance) first if it's missing or out of date.
+
+    Building is done while holding a lock on `path` + ".lock", so when several bot processes start at once, only one of them builds the index, and the rest wait for it and then use it. The instance can be created on one thread and used on another.
+    """
+    def __init__(self, path, lexicon):
+        if not self.is_up_to_date(path, lexicon):
+            with open(path + ".lock", "w") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                if not self.is_up_to_date(path, lexicon): build_rhyming_pairs(path, lexicon) # another process might have built it while we were waiting for the lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.rhyme_classes, self.noun_counts, self.cumulative_pairs = [], [], [] # rhyme class IDs, their noun counts, and their cumulative pair counts, for finding the rhyme class containing a given pair
+        for rhyme_class, noun_count, cumulative_pairs in self.connection.execute("SELECT id, noun_count, cumulative_pairs FROM rhyme_classes ORDER BY id"):
+            self.rhyme_classes.append(rhyme_class)
+            self.noun_counts.append(noun_count)
+            self.cumulative_pairs.append(cumulative_pairs)
+
+    @classmethod
+    def is_up_to_date(cls, path, lexicon): return os.path.exists(path) and cls.read_sources(path) == lexicon.sources
+
+    @staticmethod
+    def read_sources(path):
+        connection = sqlite3.connect(path)
+        try: return [value for value, in connection.execute("SELECT value FROM sources ORDER BY position")]
+        except sqlite3.DatabaseError: return None # not a rhyming pair database, so it'll be rebuilt
+        finally: connection.close()
+
+    def __len__(self): return self.cumulative_pairs[-1] if self.cumulative_pairs else 0
+
+    def sample(self):
+        """Returns a uniformly random rhyming pair of different words, as an `(adjective, noun)` tuple. There must be at least one pair."""
+        while True:
+            # find the rhyme class containing the pair with a random index, then the pair's position within the rhyme class
+            pair_index = random.randrange(len(self))
+            class_index = bisect.bisect_right(self.cumulative_pairs, pair_index)
+            pair_index -= self.cumulative_pairs[class_index - 1] if class_index > 0 else 0
+            adjective_position, noun_position = divmod(pair_index, self.noun_counts[class_index])
+            adjective, = self.connection.execute("SELECT word FROM words WHERE rhyme_class = ? AND is_noun = 0 AND position = ?", (self.rhyme_classes[class_index], adjective_position)).fetchone()
+            noun, = self.connection.execute("SELECT word FROM words WHERE rhyme_class = ? AND is_noun = 1 AND position = ?", (self.rhyme_classes[class_index], noun_position)).fetchone()
+            if adjective != noun: return adjective, noun # words that are both adjectives and nouns don't rhyme with themselves
+
+if __name__ == "__main__":
+    sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")) # the lexicon is shared with other plugins, so it's in the parent directory
+    from lexicon import load_lexicon
+    start_time = time.monotonic()
+    pair_count = build_rhyming_pairs(RHYMING_PAIRS_DATABASE, load_lexicon())
+    print("Indexed {} rhyming pairs in {:.1f} seconds".format(pair_count, time.monotonic() - start_time))
@@ -42,7 +42,7 @@ class PersonalityPlugin(BasePlugin):
     def __init__(self, bot):
         super().__init__(bot)
         
-        self.last_entries = {} # mapping from (channel ID, thread ID) to [last message in that channel, sender of last message, number of repetitions]
+        # the plugin state maps "last_entry:CHANNEL_ID:THREAD_ID" keys to [last message in that channel, sender of last message, number of repetitions]
         self.message_repeated_threshold = 2 # minimum number of message repeats in a channel before we repeat it as well
 
         self.simple_pattern_actions = {
@@ -78,13 +78,15 @@ class PersonalityPlugin(BasePlugin):
 
     def on_message(self, m):
         if not m.is_user_text_message: return False
-        key = (m.channel_id, m.thread_id) # index states by channel and thread
+        key = "last_entry:{}:{}".format(m.channel_id, m.thread_id or "") # index states by channel and thread
 
         # compute the number of times different people have repeated it
-        if key in self.last_entries and m.text == self.last_entries[key][0] and m.user_id != self.last_entries[key][1]:
-            self.last_entries[key][2] += 1
+        last_entry = self.state.get(key)
+        if last_entry is not None and m.text == last_entry[0] and m.user_id != last_entry[1]:
+            last_entry[2] += 1
         else:
-            self.last_entries[key] = [m.text, m.user_id, 1]
+            last_entry = [m.text, m.user_id, 1]
+        self.state.set(key, last_entry)
 
         for pattern, action in self.simple_pattern_actions.items():
             match = re.search(pattern, m.text)
@@ -99,9 +101,9 @@ class PersonalityPlugin(BasePlugin):
             self.reply(random.choice(["lenny", "boredparrot", "pugrun", "chart_with_downwards_trend"]))
 
         # repeat this message if other people have repeated it enough times, 50% of the time
-        if self.last_entries[key][2] >= self.message_repeated_threshold and random.random() < 0.5:
+        if last_entry[2] >= self.message_repeated_threshold and random.random() < 0.5:
             self.respond(m.text) # repeat the message
-            del self.last_entries[key]
+            self.state.delete(key)
             return True
 
         return False
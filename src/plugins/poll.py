@@ -1,26 +1,57 @@
 #!/usr/bin/env python3
 
-import re
+import re, time
 
 from .utilities import BasePlugin
 from .utilities import untag_word
 
+POLL_UPDATE_INTERVAL = 5 # minimum time in seconds between edits of a poll message, so votes coming in quickly are shown in a single edit
+
+class PollTally:
+    """Running tally of the votes in a poll, which is updated one vote at a time rather than recounted."""
+    def __init__(self, votes):
+        self.votes = dict(votes) # mapping from user names to votes (1 to agree, 0 to disagree)
+        self.agree = sum(self.votes.values())
+
+    def set_vote(self, user_name, vote):
+        """Record `vote` as the vote of the user named `user_name`, returning `True` if this changed the tally, `False` otherwise."""
+        previous_vote = self.votes.get(user_name)
+        if previous_vote == vote: return False
+        self.votes[user_name] = vote
+        self.agree += vote - (previous_vote or 0)
+        return True
+
+    def format_status(self, show_voters):
+        """Returns the results of the poll as sendable text, listing how each user voted if `show_voters` is truthy."""
+        if not self.votes: return "Nobody voted :("
+        disagree = len(self.votes) - self.agree
+        agree_percent, disagree_percent = round(100 * self.agree / len(self.votes)), round(100 * disagree / len(self.votes))
+        status = "of the {} people who voted, {} people agree ({}%), and {} disagree ({}%)\n".format(
+            len(self.votes), self.agree, agree_percent, disagree, disagree_percent
+        ) + "`|" + agree_percent * "#" + (100 - agree_percent) * "-"  + "|`"
+        if show_voters:
+            status += "\n" + "\n".join("> *{}* votes {}".format(untag_word(user_name), "yes" if vote else "no") for user_name, vote in self.votes.items())
+        return status
+
 class PollPlugin(BasePlugin):
     """
     Polling plugin for Botty.
 
-    Per-channel polling, with one vote per user.
+    Per-channel polling, with one vote per user. The poll message is edited to show the current results as votes come in, with votes arriving in quick succession combined into a single edit.
 
     Example invocations:
 
         #general    | Me: poll start stuff?
         #general    | Botty: *POLL STARTED:* stuff?
-        • Say `poll y` to publicly agree
-        • Say `poll n` to publicly disagree
+        • React with :+1: or say `poll y` to publicly agree
+        • React with :-1: or say `poll n` publicly disagree
         • Say `poll status` to check results
+        Nobody voted :(
         #general    | Me: poll yep
-        #general    | Me: poll status
-        #general    | Botty: *POLL STATUS:* stuff?
+        #general    | Botty edited a message: *POLL STARTED:* stuff?
+        • React with :+1: or say `poll y` to publicly agree
+        • React with :-1: or say `poll n` publicly disagree
+        • Say `poll status` to check results
         of the 1 people who voted, 1 people agree (100%), and 0 disagree (0%)
         `|####################################################################################################|`
         > *Me* votes yes
@@ -29,13 +60,83 @@ class PollPlugin(BasePlugin):
         • Say `/msg @botty poll y #POLL_CHANNEL` to secretly agree
         • Say `/msg @botty poll n #POLL_CHANNEL` to secretly disagree
         • Say `poll status` to check results
-        #general    | Me: poll check
-        #general    | Botty: *POLL STATUS:* test
         Nobody voted :(
+        #general    | Me: poll check
+        #general    | Botty reacted to "poll check" with :point_up:
     """
     def __init__(self, bot):
         super().__init__(bot)
-        self.current_polls = {} # mapping from channel IDs to poll entries
+
+        # polls are stored in the plugin state under "poll:CHANNEL_ID", and each vote is stored separately under "vote:CHANNEL_ID:USER_NAME"
+        # storing votes separately means that bot processes sharing the state never overwrite each other's votes
+
+        self.tallies = {} # mapping from `(channel ID, poll message timestamp)` tuples to `PollTally` instances for polls that this process has seen, loaded from the plugin state the first time they're needed
+        self.pending_updates = set() # channel IDs of polls whose messages need to be edited to show new votes
+        self.last_update_times = {} # mapping from channel IDs to the last time their poll message was edited
+
+    def get_poll(self, channel_id):
+        """Returns the poll entry for the channel with ID `channel_id`, or `None` if there's no poll going on in that channel."""
+        return self.state.get("poll:{}".format(channel_id))
+
+    def start_poll(self, channel_id, description, is_secret, message_timestamp, status_message_timestamp):
+        for key in self.state.keys("vote:{}:".format(channel_id)): self.state.delete(key) # clear votes from the previous poll in the channel
+        self.state.set("poll:{}".format(channel_id), {
+            "description": description,
+            "is_secret": is_secret,
+            "message_timestamp": message_timestamp, # message that can be reacted to in order to vote, if any
+            "status_message_timestamp": status_message_timestamp, # message that's edited to show the results
+        })
+        self.tallies[(channel_id, status_message_timestamp)] = PollTally({})
+        self.pending_updates.discard(channel_id)
+
+    def vote(self, channel_id, user_name, vote):
+        self.state.set("vote:{}:{}".format(channel_id, user_name), vote)
+        if self.get_tally(channel_id).set_vote(user_name, vote): self.pending_updates.add(channel_id)
+
+    def get_votes(self, channel_id):
+        """Returns a mapping from user names to votes (1 to agree, 0 to disagree) for the poll in the channel with ID `channel_id`."""
+        prefix = "vote:{}:".format(channel_id)
+        return {key[len(prefix):]: vote for key, vote in self.state.items(prefix)}
+
+    def get_tally(self, channel_id, recount=False):
+        """Returns the `PollTally` for the poll in the channel with ID `channel_id`, counting the votes in the plugin state if this process hasn't seen the poll before or `recount` is truthy."""
+        poll = self.get_poll(channel_id)
+        key = (channel_id, poll and poll.get("status_message_timestamp")) # polls started by other bot processes have different poll messages, so they get a new tally
+        if recount or key not in self.tallies: self.tallies[key] = PollTally(self.get_votes(channel_id))
+        return self.tallies[key]
+
+    def format_poll_message(self, poll, tally):
+        """Returns the text of the message for the poll entry `poll`, including the current results from `tally`, as sendable text."""
+        if poll["is_secret"]:
+            return (
+                ("*ANONYMOUS POLL STARTED*\n" if poll["description"] is None else "*ANONYMOUS POLL STARTED:* {}\n".format(poll["description"])) +
+                "\u2022 Say `/msg @botty poll y #POLL_CHANNEL` to secretly agree\n" +
+                "\u2022 Say `/msg @botty poll n #POLL_CHANNEL` to secretly disagree\n" +
+                "\u2022 Say `poll status` to check results\n" +
+                tally.format_status(False)
+            )
+        return (
+            ("*POLL STARTED*\n" if poll["description"] is None else "*POLL STARTED:* {}\n".format(poll["description"])) +
+            "\u2022 React with :+1: or say `poll y` to publicly agree\n" +
+            "\u2022 React with :-1: or say `poll n` publicly disagree\n" +
+            "\u2022 Say `poll status` to check results\n" +
+            tally.format_status(True)
+        )
+
+    def update_poll_message(self, channel_id):
+        """Edit the poll message in the channel with ID `channel_id` to show the current results, returning `False` if the poll doesn't have a message that can be edited, `True` otherwise."""
+        self.pending_updates.discard(channel_id)
+        poll = self.get_poll(channel_id)
+        if poll is None or poll.get("status_message_timestamp") is None: return False # no poll, or the poll was started by an older version of this plugin
+        self.update_message(self.format_poll_message(poll, self.get_tally(channel_id)), channel_id=channel_id, timestamp=poll["status_message_timestamp"])
+        self.last_update_times[channel_id] = time.monotonic()
+        return True
+
+    def on_step(self):
+        for channel_id in list(self.pending_updates):
+            if time.monotonic() - self.last_update_times.get(channel_id, 0) >= POLL_UPDATE_INTERVAL:
+                self.update_poll_message(channel_id)
+        return False
 
     def on_message(self, m):
         if not m.is_user_message: return False
@@ -43,18 +144,18 @@ class PollPlugin(BasePlugin):
 
         # reaction voting
         if m.is_reaction_addition and m.user_id != self.get_bot_user_id():
-            if m.channel_id not in self.current_polls: return False # check if reaction was posted in a channel with an active poll
-            message_timestamp = self.current_polls[m.channel_id]["message_timestamp"]
+            poll = self.get_poll(m.channel_id)
+            if poll is None: return False # check if reaction was posted in a channel with an active poll
             try: # check if message is a reaction on the poll message
-                if m.timestamp != message_timestamp: return False
+                if m.timestamp != poll["message_timestamp"]: return False
             except ValueError: # reaction doesn't have a timestamp
                 return False
 
             if m.reaction == "+1": # vote to agree
-                self.current_polls[m.channel_id]["user_votes"][user_name] = 1
+                self.vote(m.channel_id, user_name, 1)
                 return True
             elif m.reaction == "-1": # vote to disagree
-                self.current_polls[m.channel_id]["user_votes"][user_name] = 0
+                self.vote(m.channel_id, user_name, 0)
                 return True
             return False
 
@@ -65,20 +166,9 @@ class PollPlugin(BasePlugin):
         match = re.search(r"^\s*\bpoll\s+(?:start|begin|create)\b(?:\s+(.+))?", m.text, re.IGNORECASE)
         if match:
             description = match.group(1)
-
-            message_timestamp = self.respond_complete(
-                ("*POLL STARTED*\n" if description is None else "*POLL STARTED:* {}\n".format(description)) +
-                "\u2022 React with :+1: or say `poll y` to publicly agree\n" +
-                "\u2022 React with :-1: or say `poll n` publicly disagree\n" +
-                "\u2022 Say `poll status` to check results"
-            )
-
-            self.current_polls[m.channel_id] = {
-                "description": description,
-                "user_votes": {},
-                "is_secret": False,
-                "message_timestamp": message_timestamp,
-            }
+            poll = {"description": description, "is_secret": False}
+            message_timestamp = self.respond_complete(self.format_poll_message(poll, PollTally({})))
+            self.start_poll(m.channel_id, description, False, message_timestamp, message_timestamp)
 
             # add reactions so people can click on them
             self.react(m.channel_id, message_timestamp, "+1")
@@ -88,20 +178,9 @@ class PollPlugin(BasePlugin):
         match = re.search(r"^\s*\bpoll\s+(?:private|privately|secret|secretly|anon|anonymous|anonymously)\b(?:\s+(.+))?", m.text, re.IGNORECASE)
         if match:
             description = match.group(1)
-
-            self.respond(
-                ("*ANONYMOUS POLL STARTED*\n" if description is None else "*ANONYMOUS POLL STARTED:* {}\n".format(description)) +
-                "\u2022 Say `/msg @botty poll y #POLL_CHANNEL` to secretly agree\n" +
-                "\u2022 Say `/msg @botty poll n #POLL_CHANNEL` to secretly disagree\n" +
-                "\u2022 Say `poll status` to check results"
-            )
-
-            self.current_polls[m.channel_id] = {
-                "description": description,
-                "user_votes": {},
-                "is_secret": True,
-                "message_timestamp": None,
-            }
+            poll = {"description": description, "is_secret": True}
+            message_timestamp = self.respond_complete(self.format_poll_message(poll, PollTally({})))
+            self.start_poll(m.channel_id, description, True, None, message_timestamp) # reactions on the message would be public, so they aren't counted as votes
             return True
 
         # poll voting command
@@ -117,43 +196,31 @@ class PollPlugin(BasePlugin):
             else:
                 new_channel = m.channel_id
 
-            if new_channel not in self.current_polls:
+            if self.get_poll(new_channel) is None:
                 self.respond_raw("there's no poll going on right now in {}".format(self.get_channel_name_by_id(new_channel)), as_thread=True)
                 return True
 
-            self.current_polls[new_channel]["user_votes"][user_name] = 1 if match_y else 0 # apply the vote
+            self.vote(new_channel, user_name, 1 if match_y else 0) # apply the vote
             return True
 
         # poll checking command
         match = re.search(r"^\s*\bpoll\s+(?:check|status|ready)\b", m.text, re.IGNORECASE)
         if match:
-            if m.channel_id not in self.current_polls:
+            poll = self.get_poll(m.channel_id)
+            if poll is None:
                 self.respond_raw("there's no poll going on right now in {}".format(self.get_channel_name_by_id(m.channel_id)), as_thread=True)
                 return True
 
-            poll = self.current_polls[m.channel_id]
-            voters = poll["user_votes"]
-            if not voters:
-                self.respond(("*POLL STATUS*\n" if poll["description"] is None else "*POLL STATUS:* {}\n".format(poll["description"])) + "Nobody voted :(")
+            tally = self.get_tally(m.channel_id, recount=True) # other bot processes sharing the plugin state might have recorded votes that this one hasn't seen
+            if self.update_poll_message(m.channel_id):
+                self.reply("point_up") # the poll message now shows the results
                 return True
-            agree = sum(voters.values())
-            disagree = len(voters) - agree
-            agree_percent, disagree_percent = round(100 * agree / len(voters)), round(100 * disagree / len(voters))
-            if poll["is_secret"]:
-                self.respond(
-                    ("*ANONYMOUS POLL STATUS*\n" if poll["description"] is None else "*ANONYMOUS POLL STATUS:* {}\n".format(poll["description"])) +
-                    "of the {} people who voted, {} people agree ({}%), and {} disagree ({}%)\n".format(
-                        len(voters), agree, agree_percent, disagree, disagree_percent
-                    ) + "`|" + agree_percent * "#" + (100 - agree_percent) * "-"  + "|`"
-                )
-            else:
-                self.respond(
-                    ("*POLL STATUS*\n" if poll["description"] is None else "*POLL STATUS:* {}\n".format(poll["description"])) +
-                    "of the {} people who voted, {} people agree ({}%), and {} disagree ({}%)\n".format(
-                        len(voters), agree, agree_percent, disagree, disagree_percent
-                    ) + "`|" + agree_percent * "#" + (100 - agree_percent) * "-"  + "|`\n" +
-                    "\n".join("> *{}* votes {}".format(untag_word(user_name), "yes" if vote else "no") for user_name, vote in voters.items())
-                )
+
+            # the poll doesn't have a message to edit, so post the results in a new message
+            self.respond(
+                ("*{}POLL STATUS*\n" if poll["description"] is None else "*{}POLL STATUS:* {}\n").format("ANONYMOUS " if poll["is_secret"] else "", poll["description"]) +
+                tally.format_status(not poll["is_secret"])
+            )
             return True
 
         return False
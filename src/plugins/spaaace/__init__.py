@@ -1,22 +1,261 @@
 #!/usr/bin/env python3
 
-import re, os, random, io, json
+import re, os, random, io, json, base64, math, time
+import threading, queue
+import collections
+import multiprocessing
+import concurrent.futures
 
+import requests
 from PIL import Image, ImageFont, ImageDraw, ImageFilter
-from imgurpython import ImgurClient
-from imgurpython.helpers.error import ImgurClientError
 
 from ..utilities import BasePlugin
 
 IMAGE_FOLDER = os.path.join(os.path.dirname(os.path.realpath(__file__)), "backgrounds")
 FONT_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "typewriter.ttf")
-GENERATED_IMAGE_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "generated_image.jpg")
 IMGUR_CREDENTIALS_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "imgur_credentials.json")
+IMAGE_SIZE = (1920, 1080) # size of generated images, which backgrounds are resized to
+REGION_MARGIN = 16 # margin in pixels around the text boxes when blurring and rotating them, which must be wider than the blur and the bicubic filter can reach
+IMGUR_API_URL = "https://api.imgur.com/3/" # can be overridden with "api_url" in `IMGUR_CREDENTIALS_FILE`, such as to use the stand-in endpoint in `utils/imgur-standin.py`
+RENDER_PROCESSES = 2 # number of render processes, which is the number of quotes that can be rendered at the same time
+UPLOAD_THREADS = 2 # number of upload threads, which is the number of images that can be uploaded at the same time
+UPLOAD_ATTEMPTS = 3 # number of times to try uploading an image before giving up
+UPLOAD_RETRY_DELAY = 1 # time in seconds to wait before retrying a failed upload, doubled for every retry after that
+UPLOAD_TIMEOUT = 30 # maximum time in seconds to wait for Imgur to respond to an upload request
+
+def load_background(path):
+    """Returns the background image at `path`, resized to `IMAGE_SIZE`."""
+    return Image.open(path).convert("RGB").resize(IMAGE_SIZE, Image.BICUBIC)
+
+def load_backgrounds():
+    """Returns a list of all of the background images in `IMAGE_FOLDER`, resized to `IMAGE_SIZE`. Each one takes up about 6 MiB of memory."""
+    return [load_background(os.path.join(IMAGE_FOLDER, name)) for name in sorted(os.listdir(IMAGE_FOLDER))]
+
+def load_font(): return ImageFont.truetype(FONT_FILE, 48)
+
+def get_segments(query, user_name):
+    """Returns a list of the pieces of text to draw for the quote `query` by the user named `user_name`, each of which is drawn in its own box."""
+    segments = []
+    for segment in query.split():
+        if random.randint(0, 3) > 0 or not segments:
+            segments.append(segment)
+        else:
+            segments[-1] += " " + segment
+    segments.append("- " + user_name)
+    return segments
+
+def get_region_box(box, size):
+    """Returns the bounding box `box` expanded by `REGION_MARGIN` pixels on each side, clipped to an image of size `size`."""
+    left, top, right, bottom = box
+    width, height = size
+    return (max(left - REGION_MARGIN, 0), max(top - REGION_MARGIN, 0), min(right + REGION_MARGIN, width), min(bottom + REGION_MARGIN, height))
+
+def rotate_region(region, region_box, size, angle):
+    """
+    Returns the part of an image of size `size` that would contain `region` (the part of the image in the bounding box `region_box`, with the rest of the image being transparent) after rotating the image by `angle` degrees counterclockwise around its center, as a `(rotated_region, rotated_region_box)` tuple.
+
+    This gives the same result as `Image.rotate` with bicubic resampling on the whole image, but only computes the pixels that the region can end up in.
+    """
+    # matrix mapping coordinates in the rotated image to coordinates in the original image, the same one that `Image.rotate` uses
+    center_x, center_y = size[0] / 2, size[1] / 2
+    radians = -math.radians(angle)
+    a, b, d, e = round(math.cos(radians), 15), round(math.sin(radians), 15), round(-math.sin(radians), 15), round(math.cos(radians), 15)
+    c, f = center_x - a * center_x - b * center_y, center_y - d * center_x - e * center_y
+
+    # find where the corners of the region end up after rotating, using the inverse of the matrix (its transpose, since it's a rotation)
+    left, top, right, bottom = region_box
+    corners = [(a * (x - c) + d * (y - f), b * (x - c) + e * (y - f)) for x, y in [(left, top), (right, top), (left, bottom), (right, bottom)]]
+    rotated_region_box = get_region_box((
+        math.floor(min(x for x, _ in corners)), math.floor(min(y for _, y in corners)),
+        math.ceil(max(x for x, _ in corners)), math.ceil(max(y for _, y in corners)),
+    ), size)
+
+    # offset the matrix so that it maps coordinates in the rotated region to coordinates in the region
+    rotated_left, rotated_top, rotated_right, rotated_bottom = rotated_region_box
+    matrix = (a, b, a * rotated_left + b * rotated_top + c - left, d, e, d * rotated_left + e * rotated_top + f - top)
+    rotated_region = region.transform((rotated_right - rotated_left, rotated_bottom - rotated_top), Image.AFFINE, matrix, Image.BICUBIC)
+    return rotated_region, rotated_region_box
+
+def render_quote(background, font, segments):
+    """Returns a JPEG image of the text segments `segments` (as returned by `get_segments`) drawn with the font `font` over the background image `background` (as returned by `load_background`), which isn't modified."""
+    background = background.copy()
+    overlay = Image.new("RGBA", background.size, (0, 0, 0, 0))
+    overlay_draw = ImageDraw.Draw(overlay)
+
+    # draw quote on the background
+    padding = 20
+    x, y = random.randint(20, 400), random.randint(200, 300)
+    offset_x = x
+    for segment in segments:
+        w, h = overlay_draw.textsize(segment, font=font)
+        w += padding * 2; h += padding * 2
+        if offset_x + w > 1600 or segment.startswith("-"):
+            x += random.randint(20, 200)
+            offset_x = x
+            y += 150
+        offset_y = y + random.randint(-30, 30)
+        overlay_draw.rectangle([(offset_x, offset_y), (offset_x + w, offset_y + h)], fill=(250, 240, 230))
+        overlay_draw.text((offset_x + padding, offset_y + padding), segment, fill=(0, 0, 0), font=font)
+        offset_x += w + random.randint(5, 40)
+        overlay_draw = ImageDraw.Draw(overlay)
+
+    # blur and rotate the overlay, only processing the area around the text boxes, since the overlay is transparent everywhere else
+    region_box = get_region_box(overlay.getbbox(), overlay.size)
+    region = overlay.crop(region_box).filter(ImageFilter.GaussianBlur(radius=2))
+    rotated_region, rotated_region_box = rotate_region(region, region_box, overlay.size, random.randint(-10, 10))
+    background.paste(rotated_region, rotated_region_box[:2], mask=rotated_region)
+
+    # encode the image in memory, so concurrent requests never share an output file
+    output = io.BytesIO()
+    background.save(output, "JPEG")
+    return output.getvalue()
+
+def upload_image(session, api_url, client_id, image_data):
+    """
+    Upload the image `image_data` (the contents of an image file) anonymously to the Imgur API at `api_url` using the `requests.Session` instance `session`, returning the response data, which includes the image URL under "link".
+
+    Connection errors, timeouts, and responses saying that Imgur is overloaded are retried up to `UPLOAD_ATTEMPTS` times in total, after which the last error is raised. Other error responses raise a `ValueError` right away.
+    """
+    data = {"image": base64.b64encode(image_data), "type": "base64"} # this is the same request that `ImgurClient.upload_from_path` makes, but without needing the image to be in a file
+    for attempt in range(UPLOAD_ATTEMPTS):
+        if attempt > 0: time.sleep(UPLOAD_RETRY_DELAY * 2 ** (attempt - 1))
+        try: response = session.post(api_url + "upload", headers={"Authorization": "Client-ID {}".format(client_id)}, data=data, timeout=UPLOAD_TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+            continue
+        if response.status_code == 429 or response.status_code >= 500: # rate limited or overloaded
+            error = ValueError("Imgur responded with status {}".format(response.status_code))
+            continue
+        try: response_data = response.json()
+        except ValueError: raise ValueError("Imgur responded with status {} and invalid JSON".format(response.status_code))
+        if not response_data.get("success"):
+            raise ValueError("Imgur responded with status {}: {}".format(response.status_code, (response_data.get("data") or {}).get("error")))
+        return response_data["data"]
+    raise error
+
+render_process_backgrounds, render_process_font = None, None # backgrounds and font loaded by `start_render_process` in each render process
+
+def start_render_process():
+    """Load the backgrounds and font in a render process, called once when each process in the render pool starts."""
+    global render_process_backgrounds, render_process_font
+    random.seed() # render processes are all forked from the same fork server process, so make sure they don't draw the same sequence of random layouts
+    render_process_backgrounds, render_process_font = load_backgrounds(), load_font()
+
+def render_quote_in_render_process(query, user_name):
+    """Returns a JPEG image of the quote `query` by the user named `user_name`, along with the time in seconds it took to render, as an `(image_data, render_time)` tuple. Must be called in a render process."""
+    start_time = time.perf_counter()
+    image_data = render_quote(random.choice(render_process_backgrounds), render_process_font, get_segments(query, user_name))
+    return image_data, time.perf_counter() - start_time
+
+class QuotePipeline:
+    """
+    Pipeline that renders quote images in a pool of `render_processes` processes and uploads them to the Imgur API at `api_url` (using the client ID `client_id`) in `upload_threads` threads, so the caller never waits for either.
+
+    Quotes are submitted with `submit`, and the resulting image links are collected later with `poll`. Each upload thread has its own `requests.Session`, which keeps its connection to Imgur open between uploads.
+    """
+    def __init__(self, client_id, api_url, *, render_processes, upload_threads):
+        self.client_id, self.api_url = client_id, api_url
+        self.render_processes = render_processes
+        self.render_pool = self.start_render_pool()
+        self.upload_queue = queue.Queue() # `(task_id, image_data, render_time)` tuples waiting for an upload thread to become available
+        self.finished_tasks = queue.Queue() # `(task_id, link, error_message, render_time, upload_time)` tuples for tasks that finished, where `link` is `None` if the task failed
+        self.upload_threads = [threading.Thread(target=self.run_upload_thread, daemon=True) for _ in range(upload_threads)]
+        for thread in self.upload_threads: thread.start()
+
+        # only accessed from the thread that calls `submit` and `poll`
+        self.submit_times = {} # mapping from task IDs of unfinished tasks to the times they were submitted
+        self.next_task_id = 0
+        self.render_times, self.upload_times, self.total_times = collections.deque(maxlen=200), collections.deque(maxlen=200), collections.deque(maxlen=200) # times of the most recent successful tasks, in seconds
+        self.completed_count, self.failed_count = 0, 0
+
+        # accessed from the render pool's callback thread and the upload threads too
+        self.lock = threading.Lock()
+        self.rendering_count, self.uploading_count = 0, 0 # number of tasks being rendered or waiting to be rendered, and number of tasks being uploaded or waiting to be uploaded
+
+    def start_render_pool(self):
+        # render processes are started by a fork server process rather than forked from the bot, since forking while another thread (such as an upload thread) holds a lock leaves that lock held forever in the child
+        render_pool = concurrent.futures.ProcessPoolExecutor(self.render_processes, mp_context=multiprocessing.get_context("forkserver"), initializer=start_render_process)
+        for _ in range(self.render_processes): render_pool.submit(int) # start the render processes now, so the first quote doesn't have to wait for them to load the backgrounds
+        return render_pool
+
+    def submit_render(self, query, user_name):
+        """Submit the quote `query` by the user named `user_name` to the render pool, replacing the pool first if it's unusable, returning the render task's future."""
+        if self.render_pool is None: self.render_pool = self.start_render_pool()
+        try: return self.render_pool.submit(render_quote_in_render_process, query, user_name)
+        except concurrent.futures.process.BrokenProcessPool: # a render process died, which makes the whole pool unusable, so replace it
+            self.render_pool.shutdown(wait=False)
+            self.render_pool = None # if starting the new pool fails, try again on the next submit
+            self.render_pool = self.start_render_pool()
+            return self.render_pool.submit(render_quote_in_render_process, query, user_name)
+
+    def submit(self, query, user_name):
+        """Queue the quote `query` by the user named `user_name` for rendering and uploading, returning a task ID that its result will be returned with by `poll`."""
+        task_id = self.next_task_id
+        self.next_task_id += 1
+        self.submit_times[task_id] = time.monotonic()
+        try: future = self.submit_render(query, user_name)
+        except Exception as e: # even the replacement render pool couldn't take the task
+            self.finished_tasks.put((task_id, None, "rendering failed ({})".format(e), None, None))
+            return task_id
+        with self.lock: self.rendering_count += 1 # counted before adding the callback, which decrements it
+        future.add_done_callback(lambda future: self.on_rendered(task_id, future))
+        return task_id
+
+    def on_rendered(self, task_id, future):
+        """Called by the render pool when the task with ID `task_id` finishes rendering, passing the image along to the upload threads."""
+        try: image_data, render_time = future.result()
+        except Exception as e: # the render process raised an exception or died
+            with self.lock: self.rendering_count -= 1
+            self.finished_tasks.put((task_id, None, "rendering failed ({})".format(e), None, None))
+            return
+        with self.lock: self.rendering_count, self.uploading_count = self.rendering_count - 1, self.uploading_count + 1
+        self.upload_queue.put((task_id, image_data, render_time))
+
+    def run_upload_thread(self):
+        session = requests.Session()
+        while True:
+            task_id, image_data, render_time = self.upload_queue.get()
+            start_time = time.perf_counter()
+            try: link, error_message = upload_image(session, self.api_url, self.client_id, image_data)["link"], None
+            except Exception as e: link, error_message = None, "uploading failed ({})".format(e)
+            with self.lock: self.uploading_count -= 1
+            self.finished_tasks.put((task_id, link, error_message, render_time, time.perf_counter() - start_time))
+
+    def poll(self):
+        """Returns a list of `(task_id, link, error_message)` tuples for each quote that finished since the last call, where `link` is the URL of the uploaded image, or `None` if rendering or uploading failed (in which case `error_message` says why)."""
+        finished_tasks = []
+        while True:
+            try: task_id, link, error_message, render_time, upload_time = self.finished_tasks.get_nowait()
+            except queue.Empty: break
+            total_time = time.monotonic() - self.submit_times.pop(task_id)
+            if link is None: self.failed_count += 1
+            else:
+                self.completed_count += 1
+                self.render_times.append(render_time); self.upload_times.append(upload_time); self.total_times.append(total_time)
+            finished_tasks.append((task_id, link, error_message))
+        return finished_tasks
+
+    def get_statistics(self):
+        """Returns a dictionary of statistics about the pipeline, including the number of tasks in each stage, and the average and 90th percentile render, upload, and total times in seconds for recent successful tasks (these are `None` if no tasks have succeeded yet)."""
+        def summarize(times):
+            samples = sorted(times)
+            return {"average": sum(samples) / len(samples) if samples else None, "p90": samples[min(len(samples) - 1, int(len(samples) * 0.9))] if samples else None}
+        with self.lock: rendering_count, uploading_count = self.rendering_count, self.uploading_count
+        return {
+            "rendering": rendering_count, "uploading": uploading_count, "pending": len(self.submit_times),
+            "completed": self.completed_count, "failed": self.failed_count,
+            "render_time": summarize(self.render_times), "upload_time": summarize(self.upload_times), "total_time": summarize(self.total_times),
+        }
+
+    def close(self):
+        if self.render_pool is not None: self.render_pool.shutdown(wait=False)
 
 class SpaaacePlugin(BasePlugin):
     """
     Post images of a given quote set dramatically over a background.
 
+    Quotes are rendered in a pool of render processes (which each load the backgrounds and font once when they start) and uploaded to Imgur in background threads, and the image is posted from `on_step` once it's ready, so the bot keeps running while images are being made. To test without Imgur, set "api_url" in `IMGUR_CREDENTIALS_FILE` to the stand-in endpoint started by `utils/imgur-standin.py`.
+
     Example Invocations:
 
         #general    | Me: don't quote me on this, but botty's really got some cool features
@@ -26,11 +265,27 @@ class SpaaacePlugin(BasePlugin):
         super().__init__(bot)
         with open(IMGUR_CREDENTIALS_FILE, "r") as f:
             credentials = json.load(f)
-            try:
-                self.imgur_client = ImgurClient(credentials["client_id"], credentials["client_secret"])
-            except ImgurClientError as e:
-                self.logger.warning("Imgur client creation failed with `{}`, try checking the values in `{}`".format(e, IMGUR_CREDENTIALS_FILE))
-                self.imgur_client = e
+        client_id = credentials.get("client_id")
+        if not isinstance(client_id, str) or client_id in {"", "INSERT YOUR IMGUR CLIENT ID HERE"}:
+            self.logger.warning("Imgur client ID not set, try checking the values in `{}`".format(IMGUR_CREDENTIALS_FILE))
+            self.pipeline = None
+        else:
+            self.pipeline = QuotePipeline(client_id, credentials.get("api_url", IMGUR_API_URL), render_processes=RENDER_PROCESSES, upload_threads=UPLOAD_THREADS)
+        self.pending_quotes = {} # mapping from pipeline task IDs to the messages that requested them
+
+    def on_step(self):
+        if self.pipeline is None: return False
+        for task_id, link, error_message in self.pipeline.poll():
+            m = self.pending_quotes.pop(task_id)
+            if link is None:
+                self.logger.warning("quote image failed: {}".format(error_message))
+                self.say_raw("oops, something went wrong while making that image :(", channel_id=m.channel_id, thread_id=m.thread_id or m.timestamp)
+            else:
+                self.say_raw(link, channel_id=m.channel_id, thread_id=m.thread_id)
+        return False
+
+    def on_unload(self):
+        if self.pipeline is not None: self.pipeline.close()
 
     def on_message(self, m):
         if not m.is_user_text_message: return False
@@ -40,47 +295,13 @@ class SpaaacePlugin(BasePlugin):
         user_name = self.get_user_name_by_id(m.user_id)
 
         # fail gracefully if user has not configured this plugin yet
-        if isinstance(self.imgur_client, ImgurClientError):
-            self.respond_raw("oops, I don't have valid Imgur API credentials (`{}`) :( try checking the values in `{}`".format(self.imgur_client, IMGUR_CREDENTIALS_FILE))
-
-        # generate segments of text
-        segments = []
-        for segment in query.split():
-            if random.randint(0, 3) > 0 or not segments:
-                segments.append(segment)
-            else:
-                segments[-1] += " " + segment
-        segments.append("- " + user_name)
-
-        # set up image for drawing
-        image_file = os.path.join(IMAGE_FOLDER, random.choice(os.listdir(IMAGE_FOLDER)))
-        background = Image.open(image_file).resize((1920, 1080), Image.BICUBIC)
-        overlay = Image.new("RGBA", background.size, (0, 0, 0, 0))
-        font = ImageFont.truetype(FONT_FILE, 48)
-        overlay_draw = ImageDraw.Draw(overlay)
+        if self.pipeline is None:
+            self.respond_raw("oops, I don't have valid Imgur API credentials :( try checking the values in `{}`".format(IMGUR_CREDENTIALS_FILE))
+            return True
 
-        # draw quote on the background
-        padding = 20
-        x, y = random.randint(20, 400), random.randint(200, 300)
-        offset_x = x
-        for segment in segments:
-            w, h = overlay_draw.textsize(segment, font=font)
-            w += padding * 2; h += padding * 2
-            if offset_x + w > 1600 or segment.startswith("-"):
-                x += random.randint(20, 200)
-                offset_x = x
-                y += 150
-            offset_y = y + random.randint(-30, 30)
-            overlay_draw.rectangle([(offset_x, offset_y), (offset_x + w, offset_y + h)], fill=(250, 240, 230))
-            overlay_draw.text((offset_x + padding, offset_y + padding), segment, fill=(0, 0, 0), font=font)
-            offset_x += w + random.randint(5, 40)
-            overlay_draw = ImageDraw.Draw(overlay)
-        overlay = overlay.filter(ImageFilter.GaussianBlur(radius=2))
-        overlay = overlay.rotate(random.randint(-10, 10), resample=Image.BICUBIC)
-        background.paste(overlay, mask=overlay)
-        background.save(GENERATED_IMAGE_FILE, "JPEG")
-        
-        # upload image to imgur and post it in the channel
-        result = self.imgur_client.upload_from_path(GENERATED_IMAGE_FILE, anon=True)
-        self.respond_raw(result["link"])
+        self.pending_quotes[self.pipeline.submit(query, user_name)] = m # the image is posted from `on_step` once it's rendered and uploaded
         return True
+
+    def get_pipeline_statistics(self):
+        """Returns a dictionary of statistics about quote rendering and uploading (see `QuotePipeline.get_statistics`), or `None` if Imgur credentials aren't set."""
+        return None if self.pipeline is None else self.pipeline.get_statistics()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+"""
+Plugin state storage for Botty.
+
+Plugins store their state through `self.state` (a `PluginState` instance, set up by `BasePlugin`), rather than in instance attributes, so that it survives plugin reloads, and can be shared between processes when using `SQLiteStateBackend`.
+"""
+
+import time, json
+import sqlite3
+
+MISSING = object() # sentinel for cached lookups of keys that don't exist
+
+class MemoryStateBackend:
+    """State backend that keeps values in memory. State survives plugin reloads, but not restarts, and isn't shared between processes."""
+    def __init__(self):
+        self.values = {} # mapping from (namespace, key) tuples to values
+
+    def get(self, namespace, key, default=None): return self.values.get((namespace, key), default)
+    def set(self, namespace, key, value): self.values[(namespace, key)] = json.loads(json.dumps(value)) # round trip through JSON so values behave the same way as in other backends
+    def delete(self, namespace, key): self.values.pop((namespace, key), None)
+    def keys(self, namespace, prefix=""): return [key for entry_namespace, key in self.values if entry_namespace == namespace and key.startswith(prefix)]
+    def flush(self): pass
+    def flush_if_due(self): pass
+
+class SQLiteStateBackend:
+    """
+    State backend that stores values in the SQLite database at `path`, which can be shared by several bot processes.
+
+    Writes are buffered and flushed together in a single transaction every `flush_interval` seconds (or when `flush` is called). Reads go through a cache, which is refreshed from the database after `cache_ttl` seconds, so changes made by other processes show up after at most `cache_ttl` plus their `flush_interval` seconds.
+    """
+    def __init__(self, path, *, cache_ttl=1, flush_interval=0.5):
+        assert float(cache_ttl) >= 0, "`cache_ttl` must be a non-negative number rather than \"{}\"".format(cache_ttl)
+        assert float(flush_interval) >= 0, "`flush_interval` must be a non-negative number rather than \"{}\"".format(flush_interval)
+        self.cache_ttl, self.flush_interval = cache_ttl, flush_interval
+        self.connection = sqlite3.connect(path, timeout=10)
+        self.connection.execute("PRAGMA journal_mode = WAL") # readers don't block writers and vice versa, so several processes can use the database at once
+        self.connection.execute("PRAGMA synchronous = NORMAL") # in WAL mode, this is still safe from corruption, but avoids syncing on every commit
+        self.connection.execute("CREATE TABLE IF NOT EXISTS state (namespace TEXT, key TEXT, value TEXT, PRIMARY KEY (namespace, key)) WITHOUT ROWID")
+        self.connection.commit()
+
+        self.cache = {} # mapping from (namespace, key) tuples to (load time, value) tuples, where value is `MISSING` for keys that don't exist
+        self.pending_writes = {} # mapping from (namespace, key) tuples to JSON-encoded values, or `None` for deletions
+        self.last_flush_time = time.monotonic()
+
+    def get(self, namespace, key, default=None):
+        entry = self.cache.get((namespace, key))
+        if entry is None or ((namespace, key) not in self.pending_writes and time.monotonic() - entry[0] > self.cache_ttl):
+            row = self.connection.execute("SELECT value FROM state WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+            entry = (time.monotonic(), MISSING if row is None else json.loads(row[0]))
+            self.cache[(namespace, key)] = entry
+        return default if entry[1] is MISSING else entry[1]
+
+    def set(self, namespace, key, value):
+        encoded_value = json.dumps(value)
+        self.pending_writes[(namespace, key)] = encoded_value
+        self.cache[(namespace, key)] = (time.monotonic(), json.loads(encoded_value)) # round trip through JSON so values read back from the cache and the database behave the same way
+
+    def delete(self, namespace, key):
+        self.pending_writes[(namespace, key)] = None
+        self.cache[(namespace, key)] = (time.monotonic(), MISSING)
+
+    def keys(self, namespace, prefix=""):
+        # keys starting with `prefix` are exactly the keys from `prefix` up to (but not including) `prefix` with its last character incremented, since text is compared by code point (like `str.startswith` in `MemoryStateBackend`, and unlike `LIKE`), and a range lets SQLite use the primary key index
+        if prefix == "" or prefix[-1] == chr(0x10FFFF): # there's no character after the last one, so the range has no upper bound and the keys are checked afterwards instead
+            rows = self.connection.execute("SELECT key FROM state WHERE namespace = ? AND key >= ?", (namespace, prefix))
+        else:
+            next_character = chr(ord(prefix[-1]) + 1) if prefix[-1] != "\ud7ff" else "\ue000" # skip over surrogates, which can't be stored in the database
+            rows = self.connection.execute("SELECT key FROM state WHERE namespace = ? AND key >= ? AND key < ?", (namespace, prefix, prefix[:-1] + next_character))
+        keys = {key for key, in rows if key.startswith(prefix)}
+
+        # include buffered changes without flushing them, so callers can list keys often without forcing a commit each time
+        for (entry_namespace, key), value in self.pending_writes.items():
+            if entry_namespace != namespace or not key.startswith(prefix): continue
+            if value is None: keys.discard(key)
+            else: keys.add(key)
+        return list(keys)
+
+    def flush(self):
+        """Write all buffered changes to the database in a single transaction."""
+        self.last_flush_time = time.monotonic()
+        if not self.pending_writes: return
+        with self.connection: # commits the transaction if successful, rolls it back otherwise
+            self.connection.executemany("DELETE FROM state WHERE namespace = ? AND key = ?", [key for key, value in self.pending_writes.items() if value is None])
+            self.connection.executemany("INSERT OR REPLACE INTO state VALUES (?, ?, ?)", [(namespace, key, value) for (namespace, key), value in self.pending_writes.items() if value is not None])
+        self.pending_writes.clear()
+
+    def flush_if_due(self):
+        """Flush buffered changes if `flush_interval` seconds have passed since the last flush."""
+        if time.monotonic() - self.last_flush_time >= self.flush_interval: self.flush()
+
+class PluginState:
+    """
+    Key-value store for the state of a single plugin, with string keys and JSON-serializable values, stored in `backend` under the namespace `namespace`.
+
+    Values are only stored when passed to `set` - modifying a value returned by `get` doesn't store it, so call `set` again after modifying it.
+    """
+    def __init__(self, backend, namespace):
+        assert isinstance(namespace, str), "`namespace` must be a string rather than \"{}\"".format(namespace)
+        self.backend, self.namespace = backend, namespace
+
+    def get(self, key, default=None): return self.backend.get(self.namespace, key, default)
+    def set(self, key, value): return self.backend.set(self.namespace, key, value)
+    def delete(self, key): return self.backend.delete(self.namespace, key)
+    def keys(self, prefix=""): return self.backend.keys(self.namespace, prefix)
+    def items(self, prefix=""): return [(key, self.get(key)) for key in self.keys(prefix)]
@@ -9,6 +9,8 @@ Should be imported by all Botty plugins.
 import os, re
 import functools
 
+from .state import PluginState, MemoryStateBackend
+
 CHAT_HISTORY_DIRECTORY = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "@history")
 
 class BasePlugin:
@@ -17,6 +19,10 @@ class BasePlugin:
         self.bot = bot
         self.logger = bot.logger.getChild(self.__class__.__name__)
 
+        # plugin state lives in the bot's state backend rather than the plugin instance, so that it survives plugin reloads and can be shared between bot processes
+        if not hasattr(bot, "state_backend"): bot.state_backend = MemoryStateBackend()
+        self.state = PluginState(bot.state_backend, self.__class__.__name__)
+
         self.flows = {}
 
     def get_history_files(self):
@@ -32,6 +38,7 @@ class BasePlugin:
 
     def on_step(self): return False
     def on_message(self, message): return False
+    def on_unload(self): pass # called when the plugin is removed (e.g., by `reload_plugin` in the administrator console), to stop any processes or threads it started
 
     def say(self, sendable_text, *, channel_id, thread_id=None):          return self.bot.say(sendable_text, channel_id=channel_id, thread_id=thread_id)
     def say_raw(self, text, *, channel_id, thread_id=None):               return self.bot.say(self.text_to_sendable_text(text), channel_id=channel_id, thread_id=thread_id)
@@ -41,6 +48,9 @@ class BasePlugin:
     def respond_raw(self, text, *, as_thread=False):                      return self.bot.respond(self.text_to_sendable_text(text), as_thread=as_thread)
     def respond_complete(self, sendable_text, *, as_thread=False):        return self.bot.respond_complete(sendable_text, as_thread=as_thread)
     def respond_raw_complete(self, text, *, as_thread=False):             return self.bot.respond_complete(self.text_to_sendable_text(text), as_thread=as_thread)
+    def update_message(self, sendable_text, *, channel_id, timestamp):    return self.bot.update_message(sendable_text, channel_id=channel_id, timestamp=timestamp)
+    def update_message_raw(self, text, *, channel_id, timestamp):         return self.bot.update_message(self.text_to_sendable_text(text), channel_id=channel_id, timestamp=timestamp)
+    def has_send_budget(self):                                            return self.bot.has_send_budget()
     def react(self, channel_id, timestamp, emoticon):                     return self.bot.react(channel_id, timestamp, emoticon)
     def unreact(self, channel_id, timestamp, emoticon):                   return self.bot.unreact(channel_id, timestamp, emoticon)
     def reply(self, emoticon):                                            return self.bot.reply(emoticon)
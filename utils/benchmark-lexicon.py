@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for the shared lexicon in `src/plugins/lexicon.py`, comparing its load time, memory usage, and lookup speed against parsing the MOBY word lists directly, the way plugins did before the lexicon was added.
+
+Each loader runs in its own freshly started process, so memory usage is measured separately for each one. Memory usage is reported as private memory (RssAnon) and shared file-backed memory (RssFile), which for the lexicon is the page cache shared with every other process using it.
+
+Usage: `python3 utils/benchmark-lexicon.py`.
+"""
+
+import os, sys, time, random
+import multiprocessing
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src", "plugins"))
+import lexicon
+
+def parse_hyphenation_file():
+    word_syllable_counts = {}
+    with open(lexicon.HYPHENATION_FILE, "rb") as f:
+        for line in f.readlines():
+            try: word = line.rstrip(b"\r\n").replace(b"\xA5", b"").decode("UTF-8")
+            except UnicodeDecodeError: continue
+            syllables = 1 + line.count(b"\xA5") + line.count(b" ") + line.count(b"-")
+            word_syllable_counts[word] = syllables
+    return word_syllable_counts
+
+def parse_parts_of_speech_and_pronounciation_files():
+    nouns, adjectives = [], []
+    with open(lexicon.PARTS_OF_SPEECH_FILE, "r") as f:
+        for line in f:
+            word, parts_of_speech = line.split("\\")
+            if "A" in parts_of_speech: adjectives.append(word)
+            if "N" in parts_of_speech: nouns.append(word)
+    last_syllable_words, word_last_syllables = {}, {}
+    with open(lexicon.PRONOUNCIATION_FILE, "r") as f:
+        for line in f:
+            word, pronounciation = line.split(" ", 1)
+            last_syllable = lexicon.get_last_syllables(pronounciation)
+            if last_syllable not in last_syllable_words: last_syllable_words[last_syllable] = []
+            last_syllable_words[last_syllable].append(word)
+            word_last_syllables[word] = last_syllable
+    return nouns, adjectives, last_syllable_words, word_last_syllables
+
+def compile_lexicon_file(): return lexicon.compile_lexicon(lexicon.LEXICON_FILE)
+
+def get_memory_usage():
+    """Returns the private and file-backed resident memory of this process in kilobytes, or `None` for both if they're unavailable."""
+    usage = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                if key in {"RssAnon", "RssFile"}: usage[key] = int(value.split()[0])
+    except FileNotFoundError: pass
+    return usage.get("RssAnon"), usage.get("RssFile")
+
+def measure(name, load, lookup_words, connection):
+    private_before, file_before = get_memory_usage()
+    start_time = time.perf_counter()
+    result = load()
+    load_time = time.perf_counter() - start_time
+
+    if lookup_words is not None:
+        get_syllables = result.get if isinstance(result, dict) else result.get_syllables
+        start_time = time.perf_counter()
+        for word in lookup_words: get_syllables(word)
+        lookup_time = (time.perf_counter() - start_time) / len(lookup_words)
+    else: lookup_time = None
+    private_after, file_after = get_memory_usage()
+    connection.send((name, load_time, lookup_time, private_before, private_after, file_before, file_after))
+
+if __name__ == "__main__":
+    if not os.path.exists(lexicon.HYPHENATION_FILE): sys.exit("Can't find `{}`".format(lexicon.HYPHENATION_FILE))
+    lexicon.load_lexicon() # make sure the lexicon is compiled before benchmarking loading it
+    random.seed(0)
+    lookup_words = random.choices(list(parse_hyphenation_file()), k=100000) + ["xqzzy"] * 10000 # mostly known words, plus some unknown ones
+
+    benchmarks = [
+        ("compile lexicon", compile_lexicon_file, None),
+        ("parse mhyph.txt", parse_hyphenation_file, lookup_words),
+        ("load lexicon", lexicon.load_lexicon, lookup_words),
+    ]
+    if os.path.exists(lexicon.PARTS_OF_SPEECH_FILE) and os.path.exists(lexicon.PRONOUNCIATION_FILE):
+        benchmarks.insert(2, ("parse mobypos.txt and mobypron.txt", parse_parts_of_speech_and_pronounciation_files, None))
+    else:
+        print("Can't find `{}` and `{}`, skipping parsing them".format(lexicon.PARTS_OF_SPEECH_FILE, lexicon.PRONOUNCIATION_FILE))
+
+    print("{:<36} {:>10} {:>12} {:>14} {:>14}".format("", "load", "lookup", "private RSS", "shared RSS"))
+    context = multiprocessing.get_context("spawn") # forked processes would reuse memory freed by this process, hiding some of the memory usage
+    for name, load, benchmark_lookup_words in benchmarks:
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=measure, args=(name, load, benchmark_lookup_words, sender))
+        process.start()
+        name, load_time, lookup_time, private_before, private_after, file_before, file_after = receiver.recv()
+        process.join()
+        print("{:<36} {:>8.1f}ms {:>12} {:>14} {:>14}".format(
+            name, load_time * 1000,
+            "-" if lookup_time is None else "{:.2f}us".format(lookup_time * 1e6),
+            "-" if private_before is None else "{:+.1f} MiB".format((private_after - private_before) / 1024),
+            "-" if file_before is None else "{:+.1f} MiB".format((file_after - file_before) / 1024),
+        ))
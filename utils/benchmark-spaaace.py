@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for quote image rendering in `src/plugins/spaaace`, comparing the current rendering (backgrounds and the font loaded ahead of time, only blurring and rotating the area around the text, encoding in memory) against the way the plugin used to render quotes (loading the background and font for every image, blurring and rotating the whole overlay, saving to a file).
+
+Nothing is uploaded, so Imgur credentials aren't needed.
+
+Usage: `python3 utils/benchmark-spaaace.py [IMAGE_COUNT]` (defaults to 20 images).
+"""
+
+import os, sys, time, random, tempfile
+import warnings
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
+from plugins.spaaace import IMAGE_FOLDER, load_background, load_backgrounds, load_font, get_segments, render_quote
+from PIL import Image, ImageDraw, ImageFilter
+
+QUOTE = "botty's really got some cool features, and this is a fairly long quote to make sure there are a few lines of text"
+
+def render_uncached(output_file):
+    background = load_background(os.path.join(IMAGE_FOLDER, random.choice(os.listdir(IMAGE_FOLDER))))
+    font, segments = load_font(), get_segments(QUOTE, "botty")
+    overlay = Image.new("RGBA", background.size, (0, 0, 0, 0))
+    overlay_draw = ImageDraw.Draw(overlay)
+    padding = 20
+    x, y = random.randint(20, 400), random.randint(200, 300)
+    offset_x = x
+    for segment in segments:
+        w, h = overlay_draw.textsize(segment, font=font)
+        w += padding * 2; h += padding * 2
+        if offset_x + w > 1600 or segment.startswith("-"):
+            x += random.randint(20, 200)
+            offset_x = x
+            y += 150
+        offset_y = y + random.randint(-30, 30)
+        overlay_draw.rectangle([(offset_x, offset_y), (offset_x + w, offset_y + h)], fill=(250, 240, 230))
+        overlay_draw.text((offset_x + padding, offset_y + padding), segment, fill=(0, 0, 0), font=font)
+        offset_x += w + random.randint(5, 40)
+    overlay = overlay.filter(ImageFilter.GaussianBlur(radius=2))
+    overlay = overlay.rotate(random.randint(-10, 10), resample=Image.BICUBIC)
+    background.paste(overlay, mask=overlay)
+    background.save(output_file, "JPEG")
+
+def render_cached(backgrounds, font):
+    return render_quote(random.choice(backgrounds), font, get_segments(QUOTE, "botty"))
+
+if __name__ == "__main__":
+    image_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    random.seed(0)
+    warnings.simplefilter("ignore", DeprecationWarning) # newer versions of Pillow warn about `ImageDraw.textsize`
+
+    start_time = time.perf_counter()
+    backgrounds, font = load_backgrounds(), load_font()
+    print("loading {} backgrounds and the font: {:.1f}ms (once, when the plugin starts)".format(len(backgrounds), (time.perf_counter() - start_time) * 1000))
+
+    with tempfile.TemporaryDirectory() as directory:
+        start_time = time.perf_counter()
+        for _ in range(image_count): render_uncached(os.path.join(directory, "generated_image.jpg"))
+        uncached_time = (time.perf_counter() - start_time) / image_count
+    start_time = time.perf_counter()
+    for _ in range(image_count): render_cached(backgrounds, font)
+    cached_time = (time.perf_counter() - start_time) / image_count
+
+    print("{:<24} {:>10.1f}ms per image".format("previous rendering", uncached_time * 1000))
+    print("{:<24} {:>10.1f}ms per image".format("current rendering", cached_time * 1000))
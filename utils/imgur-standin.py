@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-in for the Imgur image upload endpoint, for testing the Spaaace plugin without Imgur credentials or network access.
+
+Uploaded images are kept in memory and served back at the links returned in the upload responses. To use it, start this script and set "api_url" to "http://localhost:8000/3/" (or wherever this is listening) in `src/plugins/spaaace/imgur_credentials.json`, along with any non-placeholder "client_id".
+
+Usage: `python3 utils/imgur-standin.py [--port PORT] [--delay SECONDS] [--failure-rate RATE]`.
+"""
+
+import sys, json, time, random, base64, binascii
+import argparse
+import threading
+import urllib.parse
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+class ImgurStandInRequestHandler(BaseHTTPRequestHandler):
+    """Handles uploads to "/3/upload" (or "/3/image") like the Imgur API does, and serves uploaded images at "/IMAGE_ID.jpg"."""
+    def do_POST(self):
+        if self.path not in {"/3/upload", "/3/image"}: return self.send_error_response(404, "Not found")
+        try: body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        except ValueError: return self.send_error_response(400, "Bad content length")
+        time.sleep(self.server.delay)
+        if random.random() < self.server.failure_rate: return self.send_error_response(503, "Over capacity") # simulated overload, which clients should retry
+        if not self.headers.get("Authorization", "").startswith("Client-ID "): return self.send_error_response(403, "Authentication required")
+
+        fields = urllib.parse.parse_qs(body.decode("ascii", "replace"))
+        try: image_data = base64.b64decode(fields["image"][0], validate=True)
+        except (KeyError, binascii.Error): return self.send_error_response(400, "No image data was sent to the upload api")
+        with self.server.lock:
+            image_id = "{:07x}".format(len(self.server.images))
+            self.server.images[image_id] = image_data
+        link = "http://{}:{}/{}.jpg".format(self.server.server_address[0], self.server.server_address[1], image_id)
+        print("uploaded {} bytes as {}".format(len(image_data), link), file=sys.stderr)
+        self.send_json_response(200, {"data": {"id": image_id, "type": "image/jpeg", "size": len(image_data), "link": link}, "success": True, "status": 200})
+
+    def do_GET(self):
+        image_id = self.path.lstrip("/").rsplit(".", 1)[0]
+        with self.server.lock: image_data = self.server.images.get(image_id)
+        if image_data is None: return self.send_error_response(404, "Not found")
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(image_data)))
+        self.end_headers()
+        self.wfile.write(image_data)
+
+    def send_error_response(self, status, error):
+        self.send_json_response(status, {"data": {"error": error, "request": self.path, "method": self.command}, "success": False, "status": status})
+
+    def send_json_response(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class ImgurStandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, server_address, delay, failure_rate):
+        super().__init__(server_address, ImgurStandInRequestHandler)
+        self.delay, self.failure_rate = delay, failure_rate
+        self.images = {} # mapping from image IDs to uploaded image data
+        self.lock = threading.Lock() # requests are handled in separate threads
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the Imgur image upload endpoint.")
+    parser.add_argument("--host", default="localhost", help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on.")
+    parser.add_argument("--delay", type=float, default=0.5, help="Time in seconds to wait before responding to each upload, to simulate a slow connection.")
+    parser.add_argument("--failure-rate", type=float, default=0, help="Fraction of uploads to fail with a 503 response, to exercise retries (e.g., 0.3).")
+    args = parser.parse_args()
+
+    server = ImgurStandInServer((args.host, args.port), args.delay, args.failure_rate)
+    print("Imgur stand-in listening at http://{}:{}/3/".format(args.host, args.port), file=sys.stderr)
+    try: server.serve_forever()
+    except KeyboardInterrupt: pass
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+import os, sys, json, time
+import argparse
+import urllib.request, urllib.error
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
+from events_api import sign_request
+
+# process command line arguments
+parser = argparse.ArgumentParser(description="Send simulated Slack Events API message events to a Botty Events API endpoint, signed like real requests from Slack. Each line of standard input is sent as a message.")
+parser.add_argument("signing_secret", help="Signing secret that the endpoint was started with.")
+parser.add_argument("--url", default="http://localhost:3000/", help="URL of the Events API endpoint (e.g., \"http://localhost:3000/\").")
+parser.add_argument("-c", "--channel", default="C0GENERAL", help="ID of the channel that the messages are sent in.")
+parser.add_argument("-u", "--user", default="U0TESTER", help="ID of the user that sends the messages.")
+parser.add_argument("-n", "--repeat", type=int, default=1, help="Send each message this many times, as separate events (useful for load testing).")
+parser.add_argument("-d", "--duplicate", action="store_true", help="Send each event twice with the same event ID, like Slack does when retrying events (the endpoint should ignore the second one).")
+args = parser.parse_args()
+
+def send_payload(payload):
+    body = json.dumps(payload).encode("utf-8")
+    timestamp = str(int(time.time()))
+    request = urllib.request.Request(args.url, data=body, headers={
+        "Content-Type": "application/json",
+        "X-Slack-Request-Timestamp": timestamp,
+        "X-Slack-Signature": sign_request(args.signing_secret, timestamp, body),
+    })
+    try:
+        with urllib.request.urlopen(request) as response: return response.status, response.read().decode("utf-8")
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode("utf-8")
+
+# check that the endpoint is up and uses the same signing secret
+status, body = send_payload({"type": "url_verification", "challenge": "botty"})
+if status != 200 or body != "botty":
+    print("Endpoint failed URL verification with status {}: {}".format(status, body), file=sys.stderr)
+    sys.exit(1)
+
+event_count = 0
+for line in sys.stdin:
+    text = line.rstrip("\n")
+    if text == "": continue
+    for _ in range(args.repeat):
+        event_count += 1
+        event_time = time.time()
+        payload = {
+            "type": "event_callback",
+            "event_id": "EvTEST{:08}".format(event_count),
+            "event_time": int(event_time),
+            "event": {
+                "type": "message",
+                "channel": args.channel,
+                "user": args.user,
+                "text": text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;"),
+                "ts": "{:.6f}".format(event_time),
+                "event_ts": "{:.6f}".format(event_time),
+            },
+        }
+        for _ in range(2 if args.duplicate else 1):
+            status, body = send_payload(payload)
+            if status != 200: print("Event {} failed with status {}: {}".format(payload["event_id"], status, body), file=sys.stderr)
+print("Sent {} events".format(event_count))